@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import gc
+import os
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+import json
+from Server import ChatServer, ClientConnection
+from Discovery import DiscoveryResponder
+from Protocol import FORMAT_BINARY, BinaryCodec, FrameDecoder, JsonCodec, StringTable, pack_message
+
+DEFAULT_ROOM_SIZES = (10, 100, 1000)
+MIN_FANOUT_MESSAGES = 20
+DEFAULT_THRESHOLD = 10.0  # Percent slower than the baseline that counts as a regression
+CASES = ('broadcast', 'fanout', 'handshake', 'rooms', 'discovery', 'wire')
+
+class NullConnection(ClientConnection):
+    """Client connection whose writer discards frames at once, so only server work is timed"""
+    def __init__(self, wire_format=None, strings=None):
+        super().__init__()
+        if wire_format is not None:
+            self.set_wire_format(wire_format, strings)
+
+    def wake_writer(self):
+        for _ in iter(self.next_batch, []):
+            pass
+
+    def close(self):
+        pass
+
+def make_server(users, rooms, wire_format=None):
+    """Build a server with users spread evenly over rooms, without any real sockets"""
+    with quiet():
+        # Without flood control, which would otherwise refuse most of what is timed here
+        server = ChatServer(host='127.0.0.1', port=0, discovery_port=None, rate_limits={}, max_rooms=None)
+    room_names = [f"room{i}" for i in range(rooms)]
+    for room in room_names:
+        server.registry.create_room(room)
+        server.strings.add(room)
+    for i in range(users):
+        client = NullConnection(wire_format, server.strings)
+        server.strings.add(f"user{i}")
+        server.registry.add_client(client, f"user{i}", room_names[i % rooms])
+    return server, room_names
+
+@contextlib.contextmanager
+def quiet():
+    """Send the server's startup banner nowhere, so it doesn't clutter the results"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def legacy_broadcast(clients, message, room, sender_socket=None):
+    """The original broadcast: scan every client and serialize once per recipient"""
+    for client_socket, (_, client_room) in clients.items():
+        if client_room == room and client_socket != sender_socket:
+            client_socket.sendall(pack_message(message))
+
+def run(broadcast, server, room_names, messages):
+    """Send messages round-robin over every room and return the elapsed seconds"""
+    start = time.perf_counter()
+    for i in range(messages):
+        room = room_names[i % len(room_names)]
+        message = {'type': 'message', 'sender': 'bench', 'content': f'message {i}', 'room': room}
+        broadcast(message, room)
+    return time.perf_counter() - start
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def sample(fn, ops, warmup, repeat):
+    """Microseconds per operation over repeat timed runs of fn, after warmup untimed ones
+
+    Like timeit, the garbage collector is paused while timing so its pauses don't
+    land on whichever sample happens to trigger them.
+    """
+    for _ in range(warmup):
+        fn()
+    gc.collect()
+    gc.disable()
+    try:
+        return [timed(fn) / ops * 1e6 for _ in range(repeat)]
+    finally:
+        gc.enable()
+
+def bench_broadcast(users, rooms, messages, warmup, repeat):
+    """Room-indexed broadcast against the original scan over every client"""
+    server, room_names = make_server(users, rooms)
+    # The old server kept a plain {client_socket: (username, room)} dict
+    clients = dict(server.registry.clients())
+    return {
+        'broadcast/legacy_scan': sample(lambda: run(lambda m, r: legacy_broadcast(clients, m, r),
+                                                    server, room_names, messages), messages, warmup, repeat),
+        'broadcast/indexed': sample(lambda: run(server.broadcast, server, room_names, messages),
+                                    messages, warmup, repeat)
+    }
+
+def bench_fanout(room_sizes, messages, warmup, repeat):
+    """Cost of one chat message, logged and sent to every member, by room size"""
+    results = {}
+    for size in room_sizes:
+        server, room_names = make_server(size, 1)
+        message = {'type': 'message', 'sender': 'bench', 'content': 'see you in five minutes', 'room': room_names[0]}
+        count = max(MIN_FANOUT_MESSAGES, messages // size)
+        fan_out = lambda: [server.broadcast(message, room_names[0], record=True) for _ in range(count)]
+        results[f'fanout/room_{size}'] = sample(fan_out, count, warmup, repeat)
+    return results
+
+def bench_handshake(handshakes, warmup, repeat):
+    """Connect, handshake and disconnect through handle_client over a socketpair"""
+    server, _ = make_server(0, 1)
+
+    def handshake():
+        client_side, server_side = socket.socketpair()
+        server.admit_connection()  # As the accept loop does before handing a socket over
+        handler = threading.Thread(target=server.handle_client, args=(server_side, ('bench', 0)))
+        handler.start()
+        client_side.sendall(pack_message({'type': 'username', 'username': 'bench'}))
+        decoder = FrameDecoder()
+        while not decoder.feed(client_side.recv(65536)):
+            pass
+        client_side.close()
+        handler.join()
+
+    def handshakes_run():
+        for _ in range(handshakes):
+            handshake()
+    return {'handshake': sample(handshakes_run, handshakes, warmup, repeat)}
+
+def bench_rooms(users, operations, warmup, repeat):
+    """Room creation, announced to every connected user, and switching between two rooms"""
+    server, room_names = make_server(users, 10)
+    client = NullConnection()
+    server.registry.add_client(client, 'bench', 'General')
+    created = iter(range(10**9))
+
+    def create():
+        for _ in range(operations):
+            server.handle_message(client, 'bench', {'type': 'create_room', 'room': f"bench{next(created)}",
+                                                    'password': None})
+
+    def join():
+        for i in range(operations):
+            server.handle_message(client, 'bench', {'type': 'join_room', 'room': room_names[i % 2],
+                                                    'password': None})
+    return {
+        'rooms/create': sample(create, operations, warmup, repeat),
+        'rooms/join': sample(join, operations, warmup, repeat)
+    }
+
+def bench_discovery(replies, warmup, repeat):
+    """Deciding whether to answer a discovery request, sending the cached reply, and refreshing it"""
+    server, _ = make_server(100, 10)
+    server.discovery = DiscoveryResponder(port=0)
+    server.refresh_discovery()
+    responder = server.discovery
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    sources = [f"10.0.{i // 250}.{i % 250}" for i in range(replies)]
+
+    def send():
+        for _ in range(replies):
+            responder.sock.sendto(responder.reply, sink.getsockname())
+            try:
+                sink.recv(2048)
+            except BlockingIOError:
+                pass
+    try:
+        return {
+            'discovery/allow': sample(lambda: [responder.allow(source) for source in sources],
+                                      replies, warmup, repeat),
+            'discovery/send': sample(send, replies, warmup, repeat),
+            'discovery/refresh': sample(lambda: [server.refresh_discovery() for _ in range(replies)],
+                                        replies, warmup, repeat)
+        }
+    finally:
+        sink.close()
+        responder.sock.close()
+
+def bench_wire_formats(messages, warmup, repeat):
+    """Encode and decode cost of a chat message in each wire format"""
+    strings = StringTable()
+    strings.add('user42')
+    strings.add('room7')
+    sample_message = {'type': 'message', 'sender': 'user42', 'content': 'see you in five minutes', 'room': 'room7'}
+    results = {}
+    for codec in (JsonCodec(), BinaryCodec(strings)):
+        payload = codec.encode(sample_message)
+        decoder = JsonCodec() if codec.name != FORMAT_BINARY else BinaryCodec()
+        decoder.known = dict(enumerate(strings.values))
+        results[f'wire/{codec.name}/encode'] = sample(lambda: [codec.encode(sample_message) for _ in range(messages)],
+                                                      messages, warmup, repeat)
+        results[f'wire/{codec.name}/decode'] = sample(lambda: [decoder.decode(payload) for _ in range(messages)],
+                                                      messages, warmup, repeat)
+    return results
+
+def summarize(samples):
+    return {
+        'median_us': statistics.median(samples),
+        'min_us': min(samples),
+        'max_us': max(samples),
+        'stdev_us': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'samples': len(samples)
+    }
+
+def run_suite(args):
+    """Run the selected cases and return {metric: summary} in microseconds per operation"""
+    benches = {
+        'broadcast': lambda: bench_broadcast(args.users, args.rooms, args.messages, args.warmup, args.repeat),
+        'fanout': lambda: bench_fanout(args.room_sizes, args.messages * 10, args.warmup, args.repeat),
+        'handshake': lambda: bench_handshake(args.handshakes, args.warmup, args.repeat),
+        'rooms': lambda: bench_rooms(args.users // 10, args.messages // 10, args.warmup, args.repeat),
+        'discovery': lambda: bench_discovery(args.messages, args.warmup, args.repeat),
+        'wire': lambda: bench_wire_formats(args.messages * 10, args.warmup, args.repeat)
+    }
+    results = {}
+    for case in args.cases:
+        with quiet():
+            samples = benches[case]()
+        for metric, values in samples.items():
+            results[metric] = summarize(values)
+            print(f"{metric:28} {results[metric]['median_us']:12.2f} us/op  "
+                  f"(min {results[metric]['min_us']:.2f}, stdev {results[metric]['stdev_us']:.2f})")
+    return results
+
+def compare(results, baseline, threshold):
+    """Print each metric's change against the baseline; returns the metrics slower by more than threshold"""
+    regressions = []
+    for metric, summary in results.items():
+        before = baseline.get(metric)
+        if before is None:
+            print(f"{metric:28} new")
+            continue
+        change = (summary['median_us'] - before['median_us']) / before['median_us'] * 100
+        if change > threshold:
+            verdict = "REGRESSION"
+            regressions.append(metric)
+        elif change < -threshold:
+            verdict = "improved"
+        else:
+            verdict = "ok"
+        print(f"{metric:28} {before['median_us']:12.2f} -> {summary['median_us']:12.2f} us/op  {change:+6.1f}%  {verdict}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server hot path benchmarks")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rooms', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--handshakes', type=int, default=200)
+    parser.add_argument('--room-sizes', type=int, nargs='+', default=list(DEFAULT_ROOM_SIZES))
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs of each case before sampling")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs of each case")
+    parser.add_argument('--save', metavar='PATH', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="percent slower than the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results
+            }, baseline_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nAgainst {args.compare} ({baseline.get('time')}), threshold {args.threshold:.0f}%:")
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
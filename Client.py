@@ -1,18 +1,111 @@
 import socket
 import threading
+import hashlib
 import json
+import logging
+import os
+import random
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import sys
 import time
 import tkinter.font as tkFont
+import queue
+import collections
+from Discovery import DiscoveryClient
+from Logs import setup_logging
+from Protocol import (FrameDecoder, FrameError, RECV_BUFFER_SIZE, SUPPORTED_FORMATS, SUPPORTED_COMPRESSION, FORMAT_JSON,
+                      JsonCodec, StreamCompressor, StreamDecompressor, encode_frame, make_codec)
+
+REPROBE_INTERVAL_MS = 15000  # How often the launcher looks for servers again on its own
+UI_PUMP_INTERVAL_MS = 16     # How often the Tk loop takes received messages off the queue
+UI_FRAME_BUDGET = 0.008      # Seconds of message handling allowed per pump before yielding
+# A dropped connection is retried after a random delay of up to BASE * 2**attempt seconds,
+# capped, so clients cut off together don't all come back at the same moment
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+RECONNECT_ATTEMPTS = 12
+CONNECT_TIMEOUT = 10.0
+# Chat display scrollback: lines kept in the Text widget, trimmed in bulk once this
+# many over, with trimmed lines kept in memory and brought back a page at a time
+DEFAULT_SCROLLBACK_LINES = 2000
+SCROLLBACK_SLACK = 200
+ARCHIVE_LINES = 50000
+ARCHIVE_PAGE_LINES = 200
+MESSAGE_TAGS = ('my_message', 'other_message', 'server_message')
+ROOM_BAR_MAX_SLOTS = 40  # Most room buttons ever created, however many rooms there are
+# System font families are cached on disk until a font directory changes
+FONT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.webchat_fonts.json')
+FONT_DIRS = [
+    '/usr/share/fonts', '/usr/local/share/fonts', '~/.fonts', '~/.local/share/fonts', '/etc/fonts',
+    '/Library/Fonts', '/System/Library/Fonts', '~/Library/Fonts',
+    os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+    os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')
+]
+FONT_PICKER_ROWS = 20   # Rows shown by the font picker, each previewed in its own font
+FONT_PREVIEW_SIZE = 10
+# Widget options each registered role takes from the theme, as {option: theme key}
+ROLE_OPTIONS = {
+    'window': {'bg': 'bg'},
+    'frame': {'bg': 'bg'},
+    'label': {'bg': 'bg', 'fg': 'fg'},
+    'entry': {'bg': 'entry_bg', 'fg': 'entry_fg', 'insertbackground': 'fg',
+              'selectbackground': 'button_bg', 'selectforeground': 'fg'},
+    'button': {'bg': 'button_bg', 'fg': 'fg', 'activebackground': 'input_bg', 'activeforeground': 'fg'},
+    'text': {'bg': 'chat_bg', 'fg': 'fg', 'insertbackground': 'fg',
+             'selectbackground': 'button_bg', 'selectforeground': 'fg'},
+    'listbox': {'bg': 'entry_bg', 'fg': 'entry_fg', 'selectbackground': 'button_bg', 'selectforeground': 'fg'},
+    'scrollbar': {'bg': 'scrollbar_bg', 'activebackground': 'scrollbar_bg', 'troughcolor': 'bg'},
+    'menu': {'bg': 'menu_bg', 'fg': 'menu_fg', 'activebackground': 'button_bg', 'activeforeground': 'fg'}
+}
+# Roles that show text in the UI font
+FONT_ROLES = ('label', 'entry', 'button', 'text', 'listbox', 'menu')
+# Of the per-message debug records, only one in this many is logged
+MESSAGE_LOG_SAMPLE = 100
+
+logger = logging.getLogger('chat.client')
+
+def font_fingerprint():
+    """A hash that changes when fonts are installed or removed
+
+    Covers each font directory and the directories directly inside it, which is
+    where font packages and per-user installs add their files.
+    """
+    stamps = [sys.platform, tk.TkVersion]
+    for directory in FONT_DIRS:
+        directory = os.path.expanduser(directory)
+        try:
+            stamps.append((directory, os.stat(directory).st_mtime_ns))
+            stamps += sorted((entry.path, entry.stat().st_mtime_ns)
+                             for entry in os.scandir(directory) if entry.is_dir())
+        except OSError:
+            continue
+    return hashlib.sha1(json.dumps(stamps).encode()).hexdigest()
+
+def system_font_families(root, cache_path=FONT_CACHE_PATH):
+    """Sorted system font families, read from the cache while its fingerprint matches"""
+    fingerprint = font_fingerprint()
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        if cached['fingerprint'] == fingerprint:
+            return cached['families']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    families = sorted(set(tkFont.families(root)))
+    try:
+        with open(cache_path, 'w') as cache_file:
+            json.dump({'fingerprint': fingerprint, 'families': families}, cache_file)
+    except OSError as e:
+        logger.warning("Could not save font cache: %s", e)
+    return families
 
 def main():
     try:
         # Create server discovery window
         discovery_window = tk.Tk()
         discovery_window.title("Connect to Server")
-        discovery_window.geometry("400x300")
+        discovery_window.geometry("400x340")
         
         frame = tk.Frame(discovery_window)
         frame.pack(expand=True, fill='both', padx=20, pady=20)
@@ -40,54 +133,87 @@ def main():
         ip_entry.pack(side='left', padx=5, fill='x', expand=True)
         ip_entry.insert(0, "localhost")
         
-        # Dictionary to store server info
-        available_servers = {}
+        # Optional network to probe host by host, for networks that block broadcast
+        cidr_frame = tk.Frame(frame)
+        cidr_frame.pack(fill='x')
         
-        def refresh_servers():
-            # Clear existing servers
+        tk.Label(cidr_frame, text="Also scan network (CIDR):").pack(side='left')
+        cidr_entry = tk.Entry(cidr_frame)
+        cidr_entry.pack(side='left', padx=5, fill='x', expand=True)
+        
+        # Dictionary to store server info
+        available_servers = {}  # {list line: "host" or "host:port"}
+        found_servers = {}      # {"host:port": server reported by discovery}
+        
+        # Discovery runs on its own thread and hands results over through this queue,
+        # which the Tk loop drains, so the window never waits on the network
+        results = queue.Queue()
+        discovery = DiscoveryClient(results.put)
+        for server in discovery.cached_servers():
+            found_servers[f"{server['host']}:{server['port']}"] = server
+        
+        def show_servers():
+            """Redraw the list fastest first, keeping the selection"""
+            selection = servers_list.curselection()
+            selected = available_servers.get(servers_list.get(selection[0])) if selection else None
             servers_list.delete(0, tk.END)
             available_servers.clear()
-            
-            # Create UDP socket for discovery
-            discover_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            discover_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            discover_socket.settimeout(1)
-            
-            # Broadcast discovery message
-            discover_socket.sendto(b"CHAT_DISCOVER", ('<broadcast>', 5556))
-            
-            # Wait for responses
-            start_time = time.time()
-            while time.time() - start_time < 2:  # Search for 2 seconds
-                try:
-                    data, addr = discover_socket.recvfrom(1024)
-                    try:
-                        server_info = json.loads(data.decode())
-                        server_name = f"{server_info['name']} ({addr[0]}) - Users: {server_info['users']}"
-                        available_servers[server_name] = addr[0]
-                        servers_list.insert(tk.END, server_name)
-                    except:
-                        pass
-                except socket.timeout:
-                    continue
-            
-            discover_socket.close()
-            
+            for server in sorted(found_servers.values(), key=lambda server: server['rtt']):
+                info = server['info']
+                users = info.get('users', '?')
+                if info.get('capacity'):
+                    users = f"{users}/{info['capacity']}"
+                server_name = f"{info.get('name', server['host'])} ({server['host']}) - Users: {users} - {server['rtt'] * 1000:.0f} ms"
+                if server['cached']:
+                    server_name += " (cached)"
+                address = server['host'] if server['port'] == 5555 else f"{server['host']}:{server['port']}"
+                available_servers[server_name] = address
+                servers_list.insert(tk.END, server_name)
+                if address == selected:
+                    servers_list.selection_set(tk.END)
             if not available_servers:
-                servers_list.insert(tk.END, "No servers found")
+                servers_list.insert(tk.END, "No servers found yet")
+        
+        def pump_results():
+            changed = False
+            while True:
+                try:
+                    server = results.get_nowait()
+                except queue.Empty:
+                    break
+                found_servers[f"{server['host']}:{server['port']}"] = server
+                changed = True
+            if changed:
+                show_servers()
+            discovery_window.after(100, pump_results)
+        
+        def refresh_servers():
+            """Refresh button: probe again, sweeping the CIDR range if one is entered"""
+            try:
+                discovery.probe(cidr_entry.get().strip() or None)
+            except ValueError:
+                messagebox.showerror("Error", "Enter the network as address/prefix, for example 192.168.1.0/24")
+        
+        def reprobe():
+            # Broadcast and multicast only, so a typed range is neither swept nor
+            # complained about every interval, and never over a sweep still running
+            if not discovery.probing():
+                discovery.probe()
+            discovery_window.after(REPROBE_INTERVAL_MS, reprobe)
         
         def on_server_select(event):
-            selection = servers_list.get(servers_list.curselection())
-            if selection in available_servers:
+            selection = servers_list.curselection()
+            if selection and servers_list.get(selection[0]) in available_servers:
                 ip_entry.delete(0, tk.END)
-                ip_entry.insert(0, available_servers[selection])
+                ip_entry.insert(0, available_servers[servers_list.get(selection[0])])
         
         def connect():
             server_ip = ip_entry.get().strip()
             if server_ip:
+                host, _, port = server_ip.rpartition(':') if server_ip.count(':') == 1 else (server_ip, '', '')
                 discovery_window.destroy()
                 client = ChatClient()
-                client.connect_to_server(server_ip, 5555)
+                client.connect_to_server(host, int(port) if port.isdigit() else 5555)
         
         # Bind server selection
         servers_list.bind('<<ListboxSelect>>', on_server_select)
@@ -102,8 +228,10 @@ def main():
         connect_btn = ttk.Button(button_frame, text="Connect", command=connect)
         connect_btn.pack(side='right', padx=5)
         
-        # Initial server search
-        refresh_servers()
+        # Show cached servers at once, then search now and every so often
+        show_servers()
+        pump_results()
+        reprobe()
         
         discovery_window.mainloop()
         
@@ -112,6 +240,83 @@ def main():
         input("Press Enter to exit...")
         sys.exit(1)
 
+class StyleRegistry:
+    """Widgets registered by role when created, restyled together on a theme or font change
+
+    A theme switch resolves each role's options once and configures only the registered
+    widgets, instead of walking the whole widget tree. Fonts are named Tk fonts, so a
+    font change is one configure per font and Tk redraws every widget using it. ttk
+    widgets share one ttk.Style. Every switch is timed against one UI frame.
+    """
+    def __init__(self, root, theme, font_family, font_size):
+        self.root = root
+        self.widgets = {role: {} for role in ROLE_OPTIONS}  # {role: {widget path: widget}}
+        self.font = tkFont.Font(root=root, family=font_family, size=font_size)
+        self.fonts = [self.font]  # Every named font follows the chosen family and size
+        self.ttk_style = ttk.Style(root)
+        self.last_switch_ms = None
+        self.set_theme(theme)
+
+    def set_theme(self, theme):
+        self.options = {role: {option: theme[key] for option, key in options.items()}
+                        for role, options in ROLE_OPTIONS.items()}
+        self.ttk_style.configure('TScrollbar', background=theme["scrollbar_bg"],
+                                 troughcolor=theme["bg"], arrowcolor=theme["fg"])
+
+    def named_font(self, family, size):
+        """A named font of its own size that still follows font changes"""
+        font = tkFont.Font(root=self.root, family=family, size=size)
+        self.fonts.append(font)
+        return font
+
+    def add(self, widget, role, font=None):
+        """Style widget for role and keep it until it is destroyed; returns widget
+
+        Text roles get the UI font unless another font is given, or font=False.
+        """
+        widget.configure(**self.options[role])
+        if font is None and role in FONT_ROLES:
+            font = self.font
+        if font:
+            widget.configure(font=font)
+        path = str(widget)
+        self.widgets[role][path] = widget
+        # Destroy events of children also reach a Toplevel's bindings, so check the path
+        widget.bind('<Destroy>', lambda event: self.forget(role, path) if str(event.widget) == path else None,
+                    add='+')
+        return widget
+
+    def forget(self, role, path):
+        self.widgets[role].pop(path, None)
+
+    def apply(self, theme):
+        """Restyle every registered widget for theme"""
+        start = time.perf_counter()
+        self.set_theme(theme)
+        for role, widgets in self.widgets.items():
+            options = self.options[role]
+            for widget in widgets.values():
+                try:
+                    widget.configure(**options)
+                except tk.TclError:
+                    pass  # Destroyed before its Destroy event was handled
+        self.root.update_idletasks()
+        self.probe("Theme switch", start)
+
+    def set_font(self, family, size):
+        start = time.perf_counter()
+        for font in self.fonts:
+            font.configure(family=family, size=size)
+        self.root.update_idletasks()
+        self.probe("Font change", start)
+
+    def probe(self, what, start):
+        """Record how long a switch took, including the redraw, and flag it if over a frame"""
+        self.last_switch_ms = (time.perf_counter() - start) * 1000
+        count = sum(len(widgets) for widgets in self.widgets.values())
+        over = " - over one frame" if self.last_switch_ms > UI_PUMP_INTERVAL_MS else ""
+        logger.debug("%s took %.1f ms for %d widgets%s", what, self.last_switch_ms, count, over)
+
 class Settings:
     def __init__(self, client):
         self.client = client
@@ -162,85 +367,12 @@ class Settings:
         theme = self.themes["dark" if self.dark_mode else "light"]
         self.client.current_theme = theme  # Update current theme
         
-        # Configure root window
-        self.client.root.configure(bg=theme["bg"])
-        
-        # Update all widgets recursively
-        def update_widget_colors(widget):
-            try:
-                if isinstance(widget, tk.Frame):
-                    widget.configure(bg=theme["bg"])
-                
-                elif isinstance(widget, tk.Label):
-                    widget.configure(bg=theme["bg"], fg=theme["fg"])
-                
-                elif isinstance(widget, tk.Entry):
-                    widget.configure(
-                        bg=theme["entry_bg"],
-                        fg=theme["entry_fg"],
-                        insertbackground=theme["fg"],
-                        selectbackground=theme["button_bg"],
-                        selectforeground=theme["fg"]
-                    )
-                
-                elif isinstance(widget, tk.Button):
-                    widget.configure(
-                        bg=theme["button_bg"],
-                        fg=theme["fg"],
-                        activebackground=theme["input_bg"],
-                        activeforeground=theme["fg"]
-                    )
-                
-                elif isinstance(widget, scrolledtext.ScrolledText):
-                    widget.configure(
-                        bg=theme["chat_bg"],
-                        fg=theme["fg"],
-                        insertbackground=theme["fg"],
-                        selectbackground=theme["button_bg"],
-                        selectforeground=theme["fg"]
-                    )
-                    # Configure scrollbar colors
-                    for child in widget.winfo_children():
-                        if isinstance(child, tk.Scrollbar):
-                            child.configure(
-                                bg=theme["scrollbar_bg"],
-                                activebackground=theme["scrollbar_bg"],
-                                troughcolor=theme["bg"]
-                            )
-                
-                elif isinstance(widget, tk.Menu):
-                    widget.configure(
-                        bg=theme["menu_bg"],
-                        fg=theme["menu_fg"],
-                        activebackground=theme["button_bg"],
-                        activeforeground=theme["fg"]
-                    )
-                
-                # Recursively update all child widgets
-                for child in widget.winfo_children():
-                    update_widget_colors(child)
-                    
-            except:
-                pass  # Skip widgets that don't support certain configurations
-        
-        # Update all widgets starting from root
-        update_widget_colors(self.client.root)
-        
-        # Update all existing message tags
-        for tag in self.client.chat_display.tag_names():
-            if tag.startswith('msg_'):
-                if 'right' in self.client.chat_display.tag_cget(tag, 'justify'):
-                    self.client.chat_display.tag_config(tag, foreground=theme["my_message"])
-                elif 'center' in self.client.chat_display.tag_cget(tag, 'justify'):
-                    self.client.chat_display.tag_config(tag, foreground=theme["server_message"])
-                else:
-                    self.client.chat_display.tag_config(tag, foreground=theme["other_message"])
-        
-        # Update room buttons
-        self.client.update_room_buttons()
+        # Only registered widgets are restyled, see StyleRegistry
+        self.client.style.apply(theme)
         
-        # Force update
-        self.client.root.update_idletasks()
+        # Messages share one tag per style, so recoloring them is three calls
+        for tag in MESSAGE_TAGS:
+            self.client.chat_display.tag_config(tag, foreground=theme[tag])
 
 class ChatClient:
     def __init__(self):
@@ -253,14 +385,50 @@ class ChatClient:
             self.username = None
             self.current_room = "General"
             self.client_socket = None
+            self.server_address = None
+            self.session = None  # Token the server issued, presented to resume after a drop
+            # What a resume presents, kept by whichever thread reads the socket as frames are
+            # decoded, since the Tk thread's view lags behind by whatever is still queued
+            self.received_room = 'General'
+            self.received_seqs = {}  # {room: sequence number of the newest message received}
+            self.received_version = None  # Room list version, as of the frames decoded so far
+            self.reconnecting = False  # Set while the receive thread reconnects, sends fail meanwhile
+            self.closing = False
             self.available_rooms = []
             self.room_passwords = {}
             self.protected_rooms = set()
             self.room_backgrounds = {"General": None}
+            self.decoder = FrameDecoder()
+            self.codec = JsonCodec()  # Replaced by the format the server picks in the handshake
+            self.pending_payloads = []  # Frames that arrived together with the handshake reply
+            self.compressor = None  # Set if the server agrees to compress, see connect_to_server
+            self.send_lock = threading.Lock()
+            self.history_remaining = 0  # Messages still to come in a replayed backlog
+            self.history_resumed = False  # That backlog is what we missed while reconnecting
+            self.history_before = {}  # {room: sequence number of the oldest message shown}
+            self.room_version = None  # Version of the room list we hold, see apply_room_change
+            self.room_snapshot_pending = False  # A room_list_request is out, so later gaps wait for it
+            # Tk is not thread-safe: the receive thread only decodes and queues messages,
+            # and pump_events handles them on the Tk thread
+            self.ui_events = queue.Queue()
+            self.ui_pumping = False      # True while pump_events handles a batch
+            self.scroll_pending = False  # A message in the batch wants the view scrolled down
+            self.scrollback_limit = DEFAULT_SCROLLBACK_LINES
+            self.archive = collections.deque()  # (text, tags) trimmed off the top of the display
+            self.archived_lines = 0
+            self.restore_scheduled = False
+            # The room bar reuses a few button slots for the rooms scrolled into view
+            self.room_slots = []          # [button, (room, label, state) it shows or None]
+            self.filtered_rooms = []      # Rooms matching the filter box
+            self.room_offset = 0          # Index in filtered_rooms of the first visible room
+            self.room_bar_pending = False
+            self.system_fonts = None  # Loaded on first use, see system_font_families
             self.settings = Settings(self)  # Pass self reference to Settings
             
             # Set initial theme
             self.current_theme = self.settings.themes["light"]
+            self.style = StyleRegistry(self.root, self.current_theme,
+                                       self.settings.font_family, self.settings.font_size)
             
             # Create clock
             self.clock_label = None
@@ -268,11 +436,12 @@ class ChatClient:
             self.setup_gui()
             self.update_clock()
         except Exception as e:
-            print(f"Error initializing chat client: {e}")
+            logger.error("Error initializing chat client: %s", e)
             raise
 
     def on_closing(self):
         """Handle window closing"""
+        self.closing = True
         if self.client_socket:
             try:
                 self.client_socket.close()
@@ -282,40 +451,43 @@ class ChatClient:
         sys.exit(0)
 
     def setup_gui(self):
-        # Get current theme
-        theme = self.current_theme
-        
-        # Configure the main window
-        self.root.configure(bg=theme["bg"])
+        # Every widget registers its role, so theme and font changes reach it
+        style = self.style
+        style.add(self.root, 'window')
         
         # Create main container frame
-        main_frame = tk.Frame(self.root, bg=theme["bg"])
+        main_frame = style.add(tk.Frame(self.root), 'frame')
         main_frame.pack(expand=True, fill='both')
         
         # Add clock at the top
-        self.clock_label = tk.Label(main_frame, font=('Helvetica', 12), 
-                                  bg=theme["bg"],
-                                  fg=theme["fg"])
+        self.clock_label = style.add(tk.Label(main_frame), 'label', font=style.named_font('Helvetica', 12))
         self.clock_label.pack(pady=5)
         
         # Add menu bar
-        menubar = tk.Menu(self.root, bg=theme["menu_bg"], fg=theme["menu_fg"])
+        menubar = style.add(tk.Menu(self.root), 'menu')
         self.root.config(menu=menubar)
         
         # Settings menu
-        settings_menu = tk.Menu(menubar, tearoff=0, bg=theme["menu_bg"], fg=theme["menu_fg"])
+        settings_menu = style.add(tk.Menu(menubar, tearoff=0), 'menu')
         menubar.add_cascade(label="Settings", menu=settings_menu)
         settings_menu.add_checkbutton(label="Dark Mode", command=self.settings.toggle_dark_mode)
+        settings_menu.add_command(label="Scrollback Lines", command=self.change_scrollback_limit)
+        
+        # History menu
+        history_menu = style.add(tk.Menu(menubar, tearoff=0), 'menu')
+        menubar.add_cascade(label="History", menu=history_menu)
+        history_menu.add_command(label="Load Earlier Messages", command=self.load_earlier_messages)
         
         # Add Font submenu
-        font_menu = tk.Menu(settings_menu, tearoff=0, bg=theme["menu_bg"], fg=theme["menu_fg"])
+        font_menu = style.add(tk.Menu(settings_menu, tearoff=0), 'menu')
         settings_menu.add_cascade(label="Font", menu=font_menu)
         
         # Font size submenu
         font_menu.add_command(label="Size", command=self.change_font_size)
         
         # Font family submenu
-        self.font_family_menu = tk.Menu(font_menu, tearoff=0, bg=theme["menu_bg"], fg=theme["menu_fg"])
+        self.font_family_var = tk.StringVar(value=self.settings.font_family)
+        self.font_family_menu = style.add(tk.Menu(font_menu, tearoff=0), 'menu')
         font_menu.add_cascade(label="Family", menu=self.font_family_menu)
         
         # Add import fonts option
@@ -336,95 +508,158 @@ class ChatClient:
         self.update_font_menu(self.font_family_menu)
         
         # Chat display
-        self.chat_display = scrolledtext.ScrolledText(main_frame, wrap=tk.WORD, width=60, height=30,
-                                                    bg=theme["chat_bg"], fg=theme["fg"],
-                                                    insertbackground=theme["fg"],
-                                                    selectbackground=theme["button_bg"],
-                                                    selectforeground=theme["fg"])
+        self.chat_display = style.add(scrolledtext.ScrolledText(main_frame, wrap=tk.WORD, width=60, height=30),
+                                      'text')
+        style.add(self.chat_display.frame, 'frame')
+        style.add(self.chat_display.vbar, 'scrollbar')
         self.chat_display.pack(expand=True, fill='both', padx=5, pady=5)
         
-        # Configure message colors and tags
-        self.chat_display.tag_config('my_message', foreground=theme["my_message"])
-        self.chat_display.tag_config('other_message', foreground=theme["other_message"])
-        self.chat_display.tag_config('server_message', foreground=theme["server_message"])
+        # Configure message colors and tags, shared by every message of that style
+        theme = self.current_theme
+        self.chat_display.tag_config('my_message', justify='right', foreground=theme["my_message"])
+        self.chat_display.tag_config('other_message', justify='left', foreground=theme["other_message"])
+        self.chat_display.tag_config('server_message', justify='center', foreground=theme["server_message"])
+        # Watch scrolling so archived lines come back when the user reaches the top
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
         
         # Room controls frame
-        self.room_frame = tk.Frame(main_frame, bg=theme["bg"])
+        self.room_frame = style.add(tk.Frame(main_frame), 'frame')
         self.room_frame.pack(fill='x', padx=5, pady=5)
         
-        tk.Label(self.room_frame, text="Room:", bg=theme["bg"], fg=theme["fg"]).pack(side=tk.LEFT)
-        self.room_entry = tk.Entry(self.room_frame, width=15,
-                                 bg=theme["entry_bg"], fg=theme["entry_fg"],
-                                 insertbackground=theme["fg"])
+        style.add(tk.Label(self.room_frame, text="Room:"), 'label').pack(side=tk.LEFT)
+        self.room_entry = style.add(tk.Entry(self.room_frame, width=15), 'entry')
         self.room_entry.pack(side=tk.LEFT, padx=5)
         self.room_entry.insert(0, "General")
         
-        tk.Button(self.room_frame, text="Create Room", command=self.create_room,
-                 bg=theme["button_bg"], fg=theme["fg"],
-                 activebackground=theme["input_bg"],
-                 activeforeground=theme["fg"]).pack(side=tk.LEFT, padx=5)
-        tk.Button(self.room_frame, text="Join Room", command=self.join_room,
-                 bg=theme["button_bg"], fg=theme["fg"],
-                 activebackground=theme["input_bg"],
-                 activeforeground=theme["fg"]).pack(side=tk.LEFT)
+        style.add(tk.Button(self.room_frame, text="Create Room", command=self.create_room),
+                  'button').pack(side=tk.LEFT, padx=5)
+        style.add(tk.Button(self.room_frame, text="Join Room", command=self.join_room),
+                  'button').pack(side=tk.LEFT)
         
         # Message input frame
-        self.input_frame = tk.Frame(main_frame, bg=theme["bg"])
+        self.input_frame = style.add(tk.Frame(main_frame), 'frame')
         self.input_frame.pack(fill='x', padx=5, pady=5)
         
-        self.message_input = tk.Entry(self.input_frame,
-                                    bg=theme["entry_bg"], fg=theme["entry_fg"],
-                                    insertbackground=theme["fg"])
+        self.message_input = style.add(tk.Entry(self.input_frame), 'entry')
         self.message_input.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         self.message_input.bind("<Return>", lambda e: self.send_message())
         
-        tk.Button(self.input_frame, text="Send", command=self.send_message,
-                 bg=theme["button_bg"], fg=theme["fg"],
-                 activebackground=theme["input_bg"],
-                 activeforeground=theme["fg"]).pack(side=tk.RIGHT)
+        style.add(tk.Button(self.input_frame, text="Send", command=self.send_message),
+                  'button').pack(side=tk.RIGHT)
         
-        # Room buttons frame
-        self.rooms_frame = tk.Frame(main_frame, bg=theme["bg"])
+        # Room bar: a filter box over a fixed set of button slots scrolled across the
+        # matching rooms, so a server with thousands of rooms doesn't mean thousands of widgets
+        self.rooms_frame = style.add(tk.Frame(main_frame), 'frame')
         self.rooms_frame.pack(fill='x', padx=5, pady=5)
         
-        # Configure scrollbar colors
-        for scrollbar in self.chat_display.winfo_children():
-            if isinstance(scrollbar, tk.Scrollbar):
-                scrollbar.configure(bg=theme["scrollbar_bg"], 
-                                 activebackground=theme["scrollbar_bg"],
-                                 troughcolor=theme["bg"])
+        filter_row = style.add(tk.Frame(self.rooms_frame), 'frame')
+        filter_row.pack(fill='x')
+        style.add(tk.Label(filter_row, text="Filter rooms:"), 'label').pack(side=tk.LEFT)
+        self.room_filter = tk.StringVar()
+        self.room_filter.trace_add('write', lambda *args: self.filter_rooms())
+        style.add(tk.Entry(filter_row, textvariable=self.room_filter, width=20), 'entry').pack(side=tk.LEFT, padx=5)
+        self.room_count_label = style.add(tk.Label(filter_row), 'label')
+        self.room_count_label.pack(side=tk.LEFT)
+        
+        self.room_slots_frame = style.add(tk.Frame(self.rooms_frame), 'frame')
+        self.room_slots_frame.pack(fill='x')
+        self.room_slots_frame.bind('<Configure>', self.resize_room_slots)
+        self.bind_room_wheel(self.room_slots_frame)
+        self.room_scrollbar = style.add(tk.Scrollbar(self.rooms_frame, orient=tk.HORIZONTAL,
+                                                     command=self.scroll_rooms), 'scrollbar')
+        self.room_scrollbar.pack(fill='x')
         
         # Initial update of room buttons
+        self.add_room_slot()
         self.update_room_buttons()
 
+    def schedule_room_buttons(self):
+        """Redraw the room bar on the next frame, once for however many changes come first"""
+        if not self.room_bar_pending:
+            self.room_bar_pending = True
+            self.root.after(UI_PUMP_INTERVAL_MS, self.update_room_buttons)
+
     def update_room_buttons(self):
-        """Update the room buttons display"""
+        """Show the rooms matching the filter in the visible button slots
+
+        Each slot remembers what it shows, so only buttons whose room, label or
+        state changed are reconfigured.
+        """
+        self.room_bar_pending = False
         try:
-            theme = self.settings.themes["dark" if self.settings.dark_mode else "light"]
-            
-            # Clear existing buttons
-            for widget in self.rooms_frame.winfo_children():
-                widget.destroy()
+            text = self.room_filter.get().strip().lower()
+            if text:
+                self.filtered_rooms = [room for room in self.available_rooms if text in room.lower()]
+            else:
+                self.filtered_rooms = self.available_rooms
+            total = len(self.filtered_rooms)
+            self.room_offset = max(0, min(self.room_offset, total - len(self.room_slots)))
+            visible = self.filtered_rooms[self.room_offset:self.room_offset + len(self.room_slots)]
             
-            # Create new buttons for each room
-            for room in self.available_rooms:
-                btn = tk.Button(
-                    self.rooms_frame, 
-                    text=room + (" 🔒" if room in self.protected_rooms else ""),
-                    command=lambda r=room: self.quick_switch_room(r),
-                    width=15,
-                    bg=theme["button_bg"],
-                    fg=theme["fg"],
-                    activebackground=theme["input_bg"],
-                    activeforeground=theme["fg"],
-                    state='disabled' if room == self.current_room else 'normal'
-                )
-                btn.pack(side=tk.LEFT, padx=2, pady=2)
+            for column, slot in enumerate(self.room_slots):
+                button, shown = slot
+                wanted = None
+                if column < len(visible):
+                    room = visible[column]
+                    wanted = (room, room + (" 🔒" if room in self.protected_rooms else ""),
+                              'disabled' if room == self.current_room else 'normal')
+                if wanted == shown:
+                    continue
+                if wanted is None:
+                    button.grid_remove()
+                else:
+                    if shown is None or wanted[1:] != shown[1:]:
+                        button.configure(text=wanted[1], state=wanted[2])
+                    if shown is None:
+                        button.grid(row=0, column=column, padx=2, pady=2)
+                slot[1] = wanted
             
-            # Force update the frame
-            self.rooms_frame.update()
+            if total:
+                self.room_scrollbar.set(self.room_offset / total, (self.room_offset + len(visible)) / total)
+            else:
+                self.room_scrollbar.set(0, 1)
+            count = f"{total} of {len(self.available_rooms)}" if text else f"{total} rooms"
+            self.room_count_label.configure(text=count)
         except Exception as e:
-            print(f"Error updating room buttons: {e}")
+            logger.exception("Error updating room buttons: %s", e)
+
+    def add_room_slot(self):
+        column = len(self.room_slots)
+        button = self.style.add(tk.Button(self.room_slots_frame, width=15,
+                                          command=lambda: self.quick_switch_room(self.room_slots[column][1][0])),
+                                'button')
+        self.bind_room_wheel(button)
+        self.room_slots.append([button, None])
+
+    def resize_room_slots(self, event):
+        """Keep as many button slots as fit across the room bar"""
+        slot_width = self.room_slots[0][0].winfo_reqwidth() + 4
+        count = max(1, min(ROOM_BAR_MAX_SLOTS, event.width // slot_width))
+        if count == len(self.room_slots):
+            return
+        while len(self.room_slots) < count:
+            self.add_room_slot()
+        while len(self.room_slots) > count:
+            self.room_slots.pop()[0].destroy()
+        self.schedule_room_buttons()
+
+    def bind_room_wheel(self, widget):
+        widget.bind('<MouseWheel>', lambda event: self.scroll_rooms('scroll', -1 if event.delta > 0 else 1, 'units'))
+        widget.bind('<Button-4>', lambda event: self.scroll_rooms('scroll', -1, 'units'))
+        widget.bind('<Button-5>', lambda event: self.scroll_rooms('scroll', 1, 'units'))
+
+    def scroll_rooms(self, action, amount, unit=None):
+        """Scrollbar command: move the window of visible rooms"""
+        if action == 'moveto':
+            self.room_offset = int(float(amount) * len(self.filtered_rooms))
+        else:
+            step = len(self.room_slots) if unit == 'pages' else 1
+            self.room_offset += int(amount) * step
+        self.schedule_room_buttons()
+
+    def filter_rooms(self):
+        self.room_offset = 0
+        self.schedule_room_buttons()
 
     def create_room(self):
         room_name = self.room_entry.get().strip()
@@ -436,19 +671,15 @@ class ChatClient:
                 password_window.transient(self.root)
                 
                 # Apply theme
-                theme = self.settings.themes["dark" if self.settings.dark_mode else "light"]
-                password_window.configure(bg=theme["bg"])
+                self.style.add(password_window, 'window')
                 
                 password = tk.StringVar()
                 
-                frame = tk.Frame(password_window, bg=theme["bg"])
+                frame = self.style.add(tk.Frame(password_window), 'frame')
                 frame.pack(expand=True, fill='both', padx=10, pady=5)
                 
-                tk.Label(frame, text="Enter room password:", 
-                        bg=theme["bg"], fg=theme["fg"]).pack(pady=5)
-                password_entry = tk.Entry(frame, textvariable=password, show="*",
-                                       bg=theme["entry_bg"], fg=theme["entry_fg"],
-                                       insertbackground=theme["fg"])
+                self.style.add(tk.Label(frame, text="Enter room password:"), 'label').pack(pady=5)
+                password_entry = self.style.add(tk.Entry(frame, textvariable=password, show="*"), 'entry')
                 password_entry.pack(pady=5)
                 password_entry.focus()
                 
@@ -456,10 +687,8 @@ class ChatClient:
                     if password.get().strip():
                         password_window.destroy()
                 
-                tk.Button(frame, text="Set Password", command=submit_password,
-                         bg=theme["button_bg"], fg=theme["fg"],
-                         activebackground=theme["input_bg"],
-                         activeforeground=theme["fg"]).pack(pady=5)
+                self.style.add(tk.Button(frame, text="Set Password", command=submit_password),
+                               'button').pack(pady=5)
                 self.root.wait_window(password_window)
                 room_password = password.get().strip()
             else:
@@ -471,7 +700,7 @@ class ChatClient:
                 'password': room_password
             }
             try:
-                self.client_socket.send(json.dumps(create_data).encode())
+                self.send_data(create_data)
             except:
                 messagebox.showerror("Error", "Could not create room")
 
@@ -485,55 +714,126 @@ class ChatClient:
                 'password': stored_password
             }
             try:
-                self.client_socket.send(json.dumps(join_data).encode())
+                self.send_data(join_data)
             except:
                 messagebox.showerror("Error", "Could not join room")
 
     def connect_to_server(self, host, port):
         try:
+            self.server_address = (host, port)
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((host, port))
-            print(f"Connected to server at {host}:{port}")  # Debug print
+            logger.info("Connected to server at %s:%s", host, port)
             
             self.username = self.get_username()
             if not self.username:
-                print("No username provided")  # Debug print
+                logger.info("No username provided")
                 self.root.destroy()
                 return
             
-            print(f"Sending username: {self.username}")  # Debug print    
-            username_data = {
-                'type': 'username',
-                'username': self.username
-            }
-            self.client_socket.send(json.dumps(username_data).encode())
+            logger.debug("Sending username: %s", self.username)
             
             # Wait for initial response from server
             try:
-                initial_data = self.client_socket.recv(1024).decode()
-                if initial_data:
-                    print(f"Received initial data: {initial_data}")  # Debug print
-                    message_data = json.loads(initial_data)
-                    if message_data['type'] == 'room_list':
-                        self.available_rooms = message_data['rooms']
-                        if 'protected_rooms' in message_data:
-                            self.protected_rooms = set(message_data['protected_rooms'])
-                        self.root.after(100, self.update_room_buttons)
+                message_data, self.pending_payloads = self.handshake()
+                if message_data['type'] == 'room_list':
+                    self.handle_server_message(message_data)
             except Exception as e:
-                print(f"Error receiving initial data: {e}")  # Debug print
+                logger.error("Error receiving initial data: %s", e)
                 raise
             
             receive_thread = threading.Thread(target=self.receive_messages)
             receive_thread.daemon = True
             receive_thread.start()
+            self.root.after(UI_PUMP_INTERVAL_MS, self.pump_events)
             
             self.root.mainloop()
             
         except Exception as e:
-            print(f"Connection error: {e}")  # Debug print
+            logger.error("Connection error: %s", e)
             messagebox.showerror("Error", f"Could not connect to server: {str(e)}")
             self.root.destroy()
 
+    def handshake(self, resume=False):
+        """Introduce ourselves on a freshly connected socket and read the server's reply
+
+        Runs on whichever thread connects. Sets up the codec and compression the
+        server agreed to and returns (reply, payloads that arrived with it), leaving
+        the reply for the Tk thread. With resume the session token goes along with
+        the newest sequence number received in the room we were in and the room
+        list version, so the server can send just what we missed.
+        """
+        username_data = {
+            'type': 'username',
+            'username': self.username,
+            'formats': list(SUPPORTED_FORMATS),
+            'compression': list(SUPPORTED_COMPRESSION),
+            'room_deltas': True
+        }
+        if resume:
+            username_data['session'] = self.session
+            username_data['last_seq'] = self.received_seqs.get(self.received_room, 0)
+            username_data['room_version'] = self.received_version
+        self.decoder = FrameDecoder()
+        # The server may compress anything from its first reply on once it agrees
+        self.decoder.decompressor = StreamDecompressor()
+        self.codec = JsonCodec()
+        self.compressor = None
+        self.client_socket.sendall(encode_frame(self.codec.encode(username_data)))
+        
+        payloads = []
+        while not payloads:
+            data = self.client_socket.recv(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            payloads = self.decoder.feed(data)
+        # The handshake reply is always JSON, everything after it uses the agreed format
+        message_data = self.decoder.decode(payloads.pop(0))
+        logger.debug("Received initial data: %s", message_data)
+        if message_data.get('type') == 'server_busy':
+            # Turned away before the handshake; a reconnect just tries again later
+            raise ConnectionError(message_data.get('message', "Server is busy"))
+        self.session = message_data.get('session')
+        # A resumed session continues in its room, anything else starts over in General
+        self.received_room = message_data.get('room', 'General')
+        if message_data.get('type') == 'room_list':
+            self.received_version = message_data.get('version')
+        self.codec = make_codec(message_data.get('format', FORMAT_JSON))
+        self.decoder.codec = self.codec
+        if message_data.get('compression'):
+            self.compressor = StreamCompressor()
+        self.client_socket.settimeout(None)
+        return message_data, payloads
+
+    def reconnect(self):
+        """Connect again after a drop, with jittered exponential backoff between attempts
+
+        Returns the payloads that came with the handshake reply, or None if the
+        window is closing, the server offered no session, or every attempt failed.
+        """
+        if self.closing or self.session is None:
+            return None
+        with self.send_lock:
+            self.reconnecting = True
+        self.ui_events.put({'type': 'connection_lost'})
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)))
+            if self.closing:
+                return None
+            try:
+                self.client_socket.close()
+                self.client_socket = socket.create_connection(self.server_address, CONNECT_TIMEOUT)
+                message_data, payloads = self.handshake(resume=True)
+            except (OSError, ValueError, FrameError) as e:
+                logger.info("Reconnect attempt %d failed: %s", attempt + 1, e)
+                continue
+            logger.info("Reconnected to server at %s:%s", *self.server_address)
+            self.ui_events.put({'type': 'reconnected', 'reply': message_data})
+            with self.send_lock:
+                self.reconnecting = False
+            return payloads
+        return None
+
     def get_username(self):
         username_window = tk.Toplevel(self.root)
         username_window.title("Enter Username")
@@ -600,74 +900,230 @@ class ChatClient:
                 return self.get_username()
             return None
 
+    def send_data(self, data):
+        """Encode a message dict in the negotiated format and send it to the server"""
+        # The deflate context needs frames in wire order, so compress and send together
+        with self.send_lock:
+            if self.reconnecting:
+                raise ConnectionError("Reconnecting to server")
+            frame = encode_frame(self.codec.encode(data))
+            if self.compressor is not None:
+                frame = self.compressor.compress_frame(frame)
+            self.client_socket.sendall(frame)
+
     def receive_messages(self):
-        while True:
+        """Decode server frames for pump_events, reconnecting whenever the connection drops"""
+        payloads = self.pending_payloads
+        self.pending_payloads = []
+        while payloads is not None:
             try:
-                data = self.client_socket.recv(1024).decode()
-                if not data:
-                    print("No data received from server")  # Debug print
-                    break
-                    
-                message_data = json.loads(data)
-                print(f"Received message type: {message_data['type']}")  # Debug print
+                for payload in payloads:
+                    message_data = self.decoder.decode(payload)
+                    if message_data is not None:
+                        self.track_received(message_data)
+                        self.ui_events.put(message_data)
                 
-                # Handle room list updates first
-                if message_data['type'] == 'room_list':
-                    print(f"Updating rooms: {message_data['rooms']}")  # Debug print
-                    self.available_rooms = message_data['rooms']
-                    if 'protected_rooms' in message_data:
-                        self.protected_rooms = set(message_data['protected_rooms'])
-                    self.root.after(100, self.update_room_buttons)
-                
-                elif message_data['type'] == 'message':
-                    sender = message_data['sender']
-                    content = message_data['content']
-                    room = message_data['room']
+                data = self.client_socket.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    logger.info("No data received from server")
+                    payloads = self.reconnect()
+                    continue
                     
-                    if room == self.current_room:
-                        if sender == 'Server':
-                            self.display_message(sender, content, 'server_message')
-                        elif sender != self.username:
-                            self.display_message(sender, content, 'other_message')
-                
-                elif message_data['type'] == 'room_joined':
-                    if message_data['success']:
-                        self.current_room = message_data['room']
-                        self.chat_display.insert(tk.END, f"--- Joined {self.current_room} room ---\n", 'server_message')
-                        self.update_room_buttons()  # Just update buttons, don't modify available_rooms
-                    else:
-                        if message_data['message'] == 'Incorrect password':
-                            # Mark room as protected when password prompt appears
-                            room_name = self.room_entry.get().strip()
-                            self.protected_rooms.add(room_name)
-                            self.update_room_buttons()
-                            self.prompt_password_and_retry()
-                        else:
-                            messagebox.showerror("Error", message_data['message'])
-                
-                elif message_data['type'] == 'room_created':
-                    if message_data['success']:
-                        room_name = self.room_entry.get().strip()
-                        if room_name in self.room_passwords:
-                            self.protected_rooms.add(room_name)
-                        self.join_room()
-                    else:
-                        messagebox.showerror("Error", message_data['message'])
-                
-                elif message_data['type'] == 'room_background':
-                    if message_data['room'] == self.current_room:
-                        self.room_backgrounds[self.current_room] = message_data['color']
-                        self.chat_display.configure(bg=message_data['color'])
+                payloads = self.decoder.feed(data)
                 
             except Exception as e:
-                print(f"Error receiving message: {e}")
-                break
+                logger.warning("Error receiving message: %s", e)
+                payloads = self.reconnect()
         
+        self.ui_events.put(None)  # Tells pump_events the connection is gone for good
+
+    def track_received(self, message_data):
+        """Note the room, sequence number and room list version a frame moves us to, on the receive thread"""
+        message_type = message_data.get('type')
+        if message_type == 'message':
+            if 'seq' in message_data:
+                self.received_seqs[message_data['room']] = message_data['seq']
+        elif message_type == 'room_joined':
+            if message_data.get('success'):
+                self.received_room = message_data['room']
+        elif message_type == 'room_list':
+            self.received_version = message_data.get('version')
+        elif message_type in ('room_added', 'room_removed'):
+            # After a gap only a full room list tells us where we are
+            if self.received_version is not None and message_data['version'] == self.received_version + 1:
+                self.received_version = message_data['version']
+
+    def pump_events(self):
+        """Handle queued server messages on the Tk thread, within a time budget per frame
+
+        A burst is handled in as few frames as the budget allows, with one scroll
+        per batch instead of one per message; what doesn't fit waits for the next pump.
+        """
+        deadline = time.perf_counter() + UI_FRAME_BUDGET
+        connection_lost = False
+        handled = 0
+        self.ui_pumping = True
         try:
+            while time.perf_counter() < deadline:
+                try:
+                    message_data = self.ui_events.get_nowait()
+                except queue.Empty:
+                    break
+                if message_data is None:
+                    connection_lost = True
+                    break
+                handled += 1
+                try:
+                    self.handle_server_message(message_data)
+                except Exception as e:
+                    logger.exception("Error handling message: %s", e)
+        finally:
+            self.ui_pumping = False
+            if handled:
+                self.trim_scrollback(following=self.scroll_pending)
+            if self.scroll_pending:
+                self.chat_display.see(tk.END)
+                self.scroll_pending = False
+        if connection_lost:
             messagebox.showerror("Error", "Lost connection to server")
             self.root.destroy()
-        except:
-            pass
+            return
+        self.root.after(UI_PUMP_INTERVAL_MS, self.pump_events)
+
+    def handle_server_message(self, message_data):
+        """Act on one message received from the server"""
+        # Checked first so the message path costs nothing more than this when not debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received message type: %s", message_data['type'], extra={'sample': MESSAGE_LOG_SAMPLE})
+        
+        # Handle room list updates first
+        if message_data['type'] == 'room_list':
+            logger.debug("Updating rooms: %s", message_data['rooms'])
+            self.available_rooms = message_data['rooms']
+            if 'protected_rooms' in message_data:
+                self.protected_rooms = set(message_data['protected_rooms'])
+            self.room_version = message_data.get('version')
+            self.room_snapshot_pending = False
+            self.schedule_room_buttons()
+        
+        elif message_data['type'] in ('room_added', 'room_removed'):
+            self.apply_room_change(message_data)
+        
+        elif message_data['type'] == 'message':
+            sender = message_data['sender']
+            content = message_data['content']
+            room = message_data['room']
+            if 'seq' in message_data and room == self.current_room:
+                self.note_oldest_shown(room, message_data['seq'])
+        
+            if self.history_remaining:
+                # Part of a room's backlog, which includes our own earlier messages; those
+                # missed while reconnecting were already shown when we sent them
+                self.history_remaining -= 1
+                if room == self.current_room and not (self.history_resumed and sender == self.username):
+                    self.display_message(sender, content, 'my_message' if sender == self.username else 'other_message')
+            elif room == self.current_room:
+                if sender == 'Server':
+                    self.display_message(sender, content, 'server_message')
+                elif sender != self.username:
+                    self.display_message(sender, content, 'other_message')
+        
+        elif message_data['type'] == 'history':
+            self.history_remaining = message_data['count']
+            self.history_resumed = message_data.get('resumed', False)
+            self.note_oldest_shown(message_data['room'], message_data.get('before'))
+            if message_data['room'] == self.current_room:
+                header = "Missed while disconnected" if self.history_resumed else "Earlier messages"
+                self.chat_display.insert(tk.END, f"--- {header} ---\n", 'server_message')
+        
+        elif message_data['type'] == 'throttled':
+            # Sent once when the server starts dropping what we send, not for every message dropped
+            what = "messages" if message_data['limit'] in ('all', 'message') else f"{message_data['limit']} requests"
+            wait = message_data.get('retry_after')
+            after = f", try again in {wait:.1f} s" if wait else ""
+            self.chat_display.insert(tk.END, f"--- Sending too fast, the server is dropping {what}{after} ---\n",
+                                     'server_message')
+            self.scroll_pending = True
+        
+        elif message_data['type'] == 'connection_lost':
+            # Queued by the receive thread, which is already reconnecting
+            self.history_remaining = 0
+            self.chat_display.insert(tk.END, "--- Connection lost, reconnecting... ---\n", 'server_message')
+            self.scroll_pending = True
+        
+        elif message_data['type'] == 'reconnected':
+            reply = message_data['reply']
+            # A room_list_request sent on the old connection may never be answered
+            self.room_snapshot_pending = False
+            if reply['type'] == 'resumed':
+                self.current_room = reply['room']
+                self.chat_display.insert(tk.END, f"--- Reconnected to {self.current_room} ---\n", 'server_message')
+            else:
+                # The session had expired, so the server started a new one in General
+                self.current_room = 'General'
+                self.chat_display.insert(tk.END, "--- Reconnected, back in General ---\n", 'server_message')
+                self.handle_server_message(reply)
+            self.scroll_pending = True
+        
+        elif message_data['type'] == 'history_page':
+            room = message_data['room']
+            # Without 'before' the page reached the start of the room's log
+            self.history_before[room] = message_data.get('before', 1)
+            if room == self.current_room:
+                self.display_earlier_messages(message_data['messages'])
+        
+        elif message_data['type'] == 'room_joined':
+            if message_data['success']:
+                self.current_room = message_data['room']
+                self.chat_display.insert(tk.END, f"--- Joined {self.current_room} room ---\n", 'server_message')
+                self.schedule_room_buttons()  # Just update buttons, don't modify available_rooms
+            else:
+                if message_data['message'] == 'Incorrect password':
+                    # Mark room as protected when password prompt appears
+                    room_name = self.room_entry.get().strip()
+                    self.protected_rooms.add(room_name)
+                    self.schedule_room_buttons()
+                    self.prompt_password_and_retry()
+                else:
+                    messagebox.showerror("Error", message_data['message'])
+        
+        elif message_data['type'] == 'room_created':
+            if message_data['success']:
+                room_name = self.room_entry.get().strip()
+                if room_name in self.room_passwords:
+                    self.protected_rooms.add(room_name)
+                self.join_room()
+            else:
+                messagebox.showerror("Error", message_data['message'])
+        
+        elif message_data['type'] == 'room_background':
+            if message_data['room'] == self.current_room:
+                self.room_backgrounds[self.current_room] = message_data['color']
+                self.chat_display.configure(bg=message_data['color'])
+
+    def apply_room_change(self, change):
+        """Apply one room_added/room_removed delta, or fetch a snapshot if we missed one
+
+        One request per gap: deltas arriving before the snapshot are dropped, the
+        snapshot covers them.
+        """
+        if self.room_version is None or change['version'] != self.room_version + 1:
+            if not self.room_snapshot_pending and (self.room_version is None or change['version'] > self.room_version):
+                self.send_data({'type': 'room_list_request'})
+                self.room_snapshot_pending = True
+            return
+        self.room_version = change['version']
+        room = change['room']
+        if change['type'] == 'room_added':
+            if room not in self.available_rooms:
+                self.available_rooms.append(room)
+            if change.get('protected'):
+                self.protected_rooms.add(room)
+        else:
+            if room in self.available_rooms:
+                self.available_rooms.remove(room)
+            self.protected_rooms.discard(room)
+        self.schedule_room_buttons()
 
     def prompt_password_and_retry(self):
         password_window = tk.Toplevel(self.root)
@@ -676,19 +1132,15 @@ class ChatClient:
         password_window.transient(self.root)
         
         # Apply theme
-        theme = self.settings.themes["dark" if self.settings.dark_mode else "light"]
-        password_window.configure(bg=theme["bg"])
+        self.style.add(password_window, 'window')
         
         password = tk.StringVar()
         
-        frame = tk.Frame(password_window, bg=theme["bg"])
+        frame = self.style.add(tk.Frame(password_window), 'frame')
         frame.pack(expand=True, fill='both', padx=10, pady=5)
         
-        tk.Label(frame, text="Enter room password:", 
-                bg=theme["bg"], fg=theme["fg"]).pack(pady=5)
-        password_entry = tk.Entry(frame, textvariable=password, show="*",
-                               bg=theme["entry_bg"], fg=theme["entry_fg"],
-                               insertbackground=theme["fg"])
+        self.style.add(tk.Label(frame, text="Enter room password:"), 'label').pack(pady=5)
+        password_entry = self.style.add(tk.Entry(frame, textvariable=password, show="*"), 'entry')
         password_entry.pack(pady=5)
         password_entry.focus()
         
@@ -703,44 +1155,130 @@ class ChatClient:
                     'password': password_value
                 }
                 try:
-                    self.client_socket.send(json.dumps(join_data).encode())
+                    self.send_data(join_data)
                 except:
                     messagebox.showerror("Error", "Could not join room")
                 password_window.destroy()
                 
-        tk.Button(frame, text="Join Room", command=submit,
-                 bg=theme["button_bg"], fg=theme["fg"],
-                 activebackground=theme["input_bg"],
-                 activeforeground=theme["fg"]).pack(pady=5)
+        self.style.add(tk.Button(frame, text="Join Room", command=submit), 'button').pack(pady=5)
         password_entry.bind("<Return>", lambda e: submit())
 
     def display_message(self, sender, content, message_type='other_message'):
         """Display message with proper alignment"""
+        # Only follow new messages if the user hasn't scrolled up to read older ones;
+        # our own messages always bring the view back down
+        follow = self.scroll_pending or message_type == 'my_message' or self.at_bottom()
+        
         # Add newline before message for spacing
         self.chat_display.insert(tk.END, "\n")
         
-        # Create a new tag for each message to handle alignment
-        tag_name = f"msg_{self.chat_display.index(tk.END)}"
-        
         if message_type == 'my_message':
             # For sent messages (right-aligned)
-            self.chat_display.tag_config(tag_name, justify='right', foreground=self.current_theme["my_message"])
-            self.chat_display.insert(tk.END, f"{content} :{sender}\n", tag_name)
+            self.chat_display.insert(tk.END, f"{content} :{sender}\n", 'my_message')
         elif message_type == 'server_message':
-            # For server messages (centered)
-            self.chat_display.tag_config(tag_name, justify='center', foreground=self.current_theme["server_message"])
-            self.chat_display.insert(tk.END, f"--- {content} ---\n", tag_name)
+            # For server messages (centered), with extra spacing after
+            self.chat_display.insert(tk.END, f"--- {content} ---\n\n", 'server_message')
         else:
             # For received messages (left-aligned)
-            self.chat_display.tag_config(tag_name, justify='left', foreground=self.current_theme["other_message"])
-            self.chat_display.insert(tk.END, f"{sender}: {content}\n", tag_name)
-        
-        # Scroll to the bottom
-        self.chat_display.see(tk.END)
-        
-        # Add extra spacing after server messages
-        if message_type == 'server_message':
-            self.chat_display.insert(tk.END, "\n")
+            self.chat_display.insert(tk.END, f"{sender}: {content}\n", 'other_message')
+        
+        # Scroll to the bottom, once per batch when called from pump_events
+        if self.ui_pumping:
+            self.scroll_pending = follow
+        elif follow:
+            self.trim_scrollback()
+            self.chat_display.see(tk.END)
+        else:
+            self.trim_scrollback(following=False)
+
+    def at_bottom(self):
+        return self.chat_display.yview()[1] >= 0.999
+
+    def trim_scrollback(self, following=True):
+        """Move the oldest lines to the archive once the display is over its limit
+
+        While the user is scrolled up the display may grow to three times the limit
+        before anything is trimmed from under them.
+        """
+        lines = int(self.chat_display.index('end-1c').split('.')[0])
+        limit = self.scrollback_limit if following else self.scrollback_limit * 3
+        if lines <= limit + SCROLLBACK_SLACK:
+            return
+        cut = f"{lines - self.scrollback_limit}.0"
+        tags = []
+        for key, value, _ in self.chat_display.dump('1.0', cut, text=True, tag=True):
+            if key == 'tagon' and value in MESSAGE_TAGS:
+                tags.append(value)
+            elif key == 'tagoff' and value in tags:
+                tags.remove(value)
+            elif key == 'text':
+                self.archive.append((value, tuple(tags)))
+                self.archived_lines += value.count('\n')
+        self.chat_display.delete('1.0', cut)
+        while self.archived_lines > ARCHIVE_LINES:
+            text, _ = self.archive.popleft()
+            self.archived_lines -= text.count('\n')
+
+    def on_chat_scroll(self, first, last):
+        """yscrollcommand of the chat display: move the scrollbar, refill from the archive at the top"""
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0 and self.archive and not self.restore_scheduled:
+            self.restore_scheduled = True
+            self.root.after_idle(self.restore_archive)
+
+    def restore_archive(self):
+        """Put a page of archived lines back above the oldest line shown"""
+        self.restore_scheduled = False
+        if self.chat_display.yview()[0] > 0.0:
+            return  # Scrolled away again before this ran
+        restored = 0
+        while self.archive and restored < ARCHIVE_PAGE_LINES:
+            text, tags = self.archive.pop()
+            self.chat_display.insert('1.0', text, tags)
+            restored += text.count('\n')
+        self.archived_lines -= restored
+        # Keep the line the user was looking at in place
+        self.chat_display.yview(f"{restored + 1}.0")
+
+    def change_scrollback_limit(self):
+        limit = simpledialog.askinteger("Scrollback", "Lines to keep in the chat window:",
+                                        initialvalue=self.scrollback_limit, minvalue=100, maxvalue=100000)
+        if limit:
+            self.scrollback_limit = limit
+            self.trim_scrollback(following=self.at_bottom())
+
+    def load_earlier_messages(self):
+        """Ask the server for the page of messages before the oldest one shown"""
+        request = {'type': 'history_request', 'room': self.current_room}
+        if self.current_room in self.history_before:
+            request['before'] = self.history_before[self.current_room]
+        try:
+            self.send_data(request)
+        except:
+            messagebox.showerror("Error", "Could not load earlier messages")
+
+    def note_oldest_shown(self, room, seq):
+        """Remember the oldest sequence number shown for a room, where Load Earlier Messages continues"""
+        if seq is not None and seq < self.history_before.get(room, seq + 1):
+            self.history_before[room] = seq
+
+    def display_earlier_messages(self, messages):
+        """Put a page of older messages above everything already shown"""
+        # Trimmed lines are newer than the page, so they go back above the display first
+        while self.archive:
+            text, tags = self.archive.pop()
+            self.chat_display.insert('1.0', text, tags)
+        self.archived_lines = 0
+        if not messages:
+            self.chat_display.insert('1.0', "--- No earlier messages ---\n", 'server_message')
+            return
+        for message in reversed(messages):
+            sender = message.get('sender')
+            if sender == self.username:
+                self.chat_display.insert('1.0', f"{message.get('content')} :{sender}\n", 'my_message')
+            else:
+                self.chat_display.insert('1.0', f"{sender}: {message.get('content')}\n", 'other_message')
+        self.chat_display.insert('1.0', "--- Earlier messages ---\n", 'server_message')
 
     def send_message(self):
         message = self.message_input.get().strip()
@@ -752,7 +1290,7 @@ class ChatClient:
                 'room': self.current_room
             }
             try:
-                self.client_socket.send(json.dumps(message_data).encode())
+                self.send_data(message_data)
                 self.display_message(self.username, message, 'my_message')
                 self.message_input.delete(0, tk.END)
             except:
@@ -778,28 +1316,8 @@ class ChatClient:
         if font_size is None:
             font_size = self.settings.font_size
             
-        # Update all labels, entries, and buttons recursively
-        def update_widget_fonts(widget):
-            try:
-                # Update widget font if it's a supported type
-                if isinstance(widget, (tk.Label, tk.Entry, tk.Button, tk.Listbox, scrolledtext.ScrolledText)):
-                    widget.configure(font=(font_family, font_size))
-                
-                # Update menu items
-                elif isinstance(widget, tk.Menu):
-                    widget.configure(font=(font_family, font_size))
-                    
-                # Recursively update all child widgets
-                for child in widget.winfo_children():
-                    update_widget_fonts(child)
-            except:
-                pass  # Skip widgets that don't support font changes
-        
-        # Update all widgets starting from root
-        update_widget_fonts(self.root)
-        
-        # Update room buttons
-        self.update_room_buttons()
+        # Widgets use the registry's named fonts, so this is one configure per font
+        self.style.set_font(font_family, font_size)
 
     def change_font_size(self):
         """Open dialog to change font size"""
@@ -811,16 +1329,21 @@ class ChatClient:
             self.apply_font_to_all(font_size=size)
 
     def update_font_menu(self, font_menu):
-        """Update the font menu with current font list"""
+        """Update the font menu with current font list
+
+        Entries use the menu's own font; previews are left to the font picker, so
+        building the menu never loads a font per family.
+        """
         # Clear existing menu items
         font_menu.delete(0, tk.END)
         
         # Add fonts to menu
         for font in self.fonts:
-            font_menu.add_command(
+            font_menu.add_radiobutton(
                 label=font,
-                command=lambda f=font: self.change_font_family(f),
-                font=(font, 10)
+                variable=self.font_family_var,
+                value=font,
+                command=lambda f=font: self.change_font_family(f)
             )
 
     def change_font_family(self, font_family):
@@ -837,46 +1360,96 @@ class ChatClient:
         font_window.transient(self.root)
         
         # Apply theme
-        theme = self.current_theme
-        font_window.configure(bg=theme["bg"])
+        self.style.add(font_window, 'window')
+        
+        # Families come from the cache file unless fonts changed since it was written
+        if self.system_fonts is None:
+            self.system_fonts = system_font_families(self.root)
         
-        # Get system fonts
-        system_fonts = list(tkFont.families())
-        system_fonts.sort()
+        # Incremental search over the family names
+        search_row = self.style.add(tk.Frame(font_window), 'frame')
+        search_row.pack(fill='x', padx=10, pady=(10, 0))
+        self.style.add(tk.Label(search_row, text="Search:"), 'label').pack(side='left')
+        search = tk.StringVar()
+        search_entry = self.style.add(tk.Entry(search_row, textvariable=search), 'entry')
+        search_entry.pack(side='left', fill='x', expand=True, padx=5)
+        search_entry.focus()
         
         # Create frame for list and scrollbar
-        list_frame = tk.Frame(font_window, bg=theme["bg"])
+        list_frame = self.style.add(tk.Frame(font_window), 'frame')
         list_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        # Create listbox with scrollbar
-        font_list = tk.Listbox(list_frame, 
-                              selectmode=tk.MULTIPLE,
-                              bg=theme["entry_bg"],
-                              fg=theme["entry_fg"],
-                              selectbackground=theme["button_bg"],
-                              selectforeground=theme["fg"])
-        font_list.pack(side='left', fill='both', expand=True)
+        # A fixed set of rows scrolled over the matching families; a family's preview
+        # font is only created once it scrolls into view
+        rows_frame = self.style.add(tk.Frame(list_frame), 'frame')
+        rows_frame.pack(side='left', fill='both', expand=True)
+        
+        state = {'query': None, 'matches': [], 'offset': 0, 'pending': False}
+        selected = set()
+        preview_fonts = {}  # {family: tkFont.Font}
+        
+        def schedule():
+            if not state['pending']:
+                state['pending'] = True
+                font_window.after(UI_PUMP_INTERVAL_MS, render)
+        
+        def render():
+            state['pending'] = False
+            query = search.get().strip().lower()
+            if query != state['query']:
+                state['query'] = query
+                state['matches'] = [font for font in self.system_fonts if query in font.lower()]
+                state['offset'] = 0
+            matches = state['matches']
+            offset = state['offset'] = max(0, min(state['offset'], len(matches) - len(rows)))
+            for i, row in enumerate(rows):
+                if offset + i < len(matches):
+                    family = matches[offset + i]
+                    font = preview_fonts.get(family)
+                    if font is None:
+                        font = preview_fonts[family] = tkFont.Font(root=font_window, family=family,
+                                                                   size=FONT_PREVIEW_SIZE)
+                    row.configure(text=("\u2713 " if family in selected else "   ") + family, font=font)
+                else:
+                    row.configure(text="", font=self.style.font)
+            if matches:
+                scrollbar.set(offset / len(matches), min(1, (offset + len(rows)) / len(matches)))
+            else:
+                scrollbar.set(0, 1)
         
-        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=font_list.yview)
+        def scroll(action, amount, unit=None):
+            if action == 'moveto':
+                state['offset'] = int(float(amount) * len(state['matches']))
+            else:
+                state['offset'] += int(amount) * (len(rows) if unit == 'pages' else 1)
+            schedule()
+        
+        def toggle(i):
+            if state['offset'] + i < len(state['matches']):
+                family = state['matches'][state['offset'] + i]
+                selected.symmetric_difference_update({family})
+                schedule()
+        
+        rows = []
+        for i in range(FONT_PICKER_ROWS):
+            row = self.style.add(tk.Label(rows_frame, anchor='w'), 'label', font=False)
+            row.pack(fill='x')
+            row.bind('<Button-1>', lambda event, i=i: toggle(i))
+            row.bind('<MouseWheel>', lambda event: scroll('scroll', -1 if event.delta > 0 else 1, 'units'))
+            row.bind('<Button-4>', lambda event: scroll('scroll', -1, 'units'))
+            row.bind('<Button-5>', lambda event: scroll('scroll', 1, 'units'))
+            rows.append(row)
+        
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=scroll)
         scrollbar.pack(side='right', fill='y')
         
-        font_list.configure(yscrollcommand=scrollbar.set)
-        
-        # Add fonts to listbox
-        for font in system_fonts:
-            font_list.insert(tk.END, font)
-            try:
-                # Show each font in its own style
-                font_list.itemconfig(font_list.size()-1, font=(font, 10))
-            except:
-                pass  # Skip if font can't be displayed
+        search.trace_add('write', lambda *args: schedule())
+        render()
         
         def import_selected():
-            selected_indices = font_list.curselection()
-            if selected_indices:
-                selected_fonts = [font_list.get(i) for i in selected_indices]
+            if selected:
                 # Add new fonts to the list if they're not already there
-                for font in selected_fonts:
+                for font in selected:
                     if font not in self.fonts:
                         self.fonts.append(font)
                 self.fonts.sort()
@@ -885,20 +1458,16 @@ class ChatClient:
                 font_window.destroy()
         
         # Add buttons
-        button_frame = tk.Frame(font_window, bg=theme["bg"])
+        button_frame = self.style.add(tk.Frame(font_window), 'frame')
         button_frame.pack(fill='x', pady=10, padx=10)
         
-        tk.Button(button_frame,
-                 text="Import Selected",
-                 command=import_selected,
-                 bg=theme["button_bg"],
-                 fg=theme["fg"]).pack(side='right', padx=5)
+        self.style.add(tk.Button(button_frame, text="Import Selected", command=import_selected),
+                       'button').pack(side='right', padx=5)
         
-        tk.Button(button_frame,
-                 text="Cancel",
-                 command=font_window.destroy,
-                 bg=theme["button_bg"],
-                 fg=theme["fg"]).pack(side='right', padx=5)
+        self.style.add(tk.Button(button_frame, text="Cancel", command=font_window.destroy),
+                       'button').pack(side='right', padx=5)
 
 if __name__ == "__main__":
+    # CHAT_LOG_LEVEL=DEBUG shows the message path too; SIGUSR1 toggles it while running
+    setup_logging(os.environ.get('CHAT_LOG_LEVEL', 'INFO'))
     main()
\ No newline at end of file
@@ -0,0 +1,139 @@
+import logging
+import os
+import socket
+import threading
+import multiprocessing
+from Protocol import FrameDecoder, MAX_FRAME_SIZE, pack_message, read_messages
+
+# Bus events wrap a client message, so they are allowed to be somewhat larger
+BUS_MAX_FRAME_SIZE = 2 * MAX_FRAME_SIZE
+
+logger = logging.getLogger('chat.cluster')
+
+class BusHub:
+    """Pub/sub relay between worker processes over a Unix domain socket
+
+    Every event a worker publishes is forwarded to all other workers. The hub also
+    remembers created rooms and each worker's user count, replays them to workers
+    that connect later, and settles room name races: the first room_created for a
+    name wins and later ones are not relayed.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.lock = threading.Lock()
+        self.workers = {}   # {worker_socket: send lock}
+        self.rooms = {}     # {room name: room_created event}
+        self.presence = {}  # {worker id: presence event}
+
+    def start(self):
+        accept_thread = threading.Thread(target=self.accept_loop)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                worker_socket, _ = self.sock.accept()
+            except OSError:
+                return
+            send_lock = threading.Lock()
+            with self.lock:
+                self.workers[worker_socket] = send_lock
+                state = list(self.rooms.values()) + list(self.presence.values())
+            # Bring a late worker up to date before it sees live events
+            with send_lock:
+                for event in state:
+                    worker_socket.sendall(pack_message(event, BUS_MAX_FRAME_SIZE))
+            thread = threading.Thread(target=self.handle_worker, args=(worker_socket,))
+            thread.daemon = True
+            thread.start()
+
+    def handle_worker(self, worker_socket):
+        try:
+            for event in read_messages(worker_socket, FrameDecoder(BUS_MAX_FRAME_SIZE)):
+                self.route(worker_socket, event)
+        except Exception as e:
+            logger.warning("Bus error: %s", e)
+        finally:
+            with self.lock:
+                self.workers.pop(worker_socket, None)
+            worker_socket.close()
+
+    def route(self, origin, event):
+        with self.lock:
+            if event['type'] == 'room_created':
+                if event['room'] in self.rooms:
+                    return
+                self.rooms[event['room']] = event
+            elif event['type'] == 'presence':
+                self.presence[event['worker']] = event
+            targets = [(worker_socket, send_lock) for worker_socket, send_lock in self.workers.items()
+                       if worker_socket is not origin]
+        data = pack_message(event, BUS_MAX_FRAME_SIZE)
+        for worker_socket, send_lock in targets:
+            try:
+                with send_lock:
+                    worker_socket.sendall(data)
+            except OSError as e:
+                logger.warning("Error relaying to worker: %s", e)
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class BusClient:
+    """A worker's connection to the hub
+
+    on_event is called from a reader thread for every event, on_close once the hub
+    goes away (normally because the parent process exited).
+    """
+    def __init__(self, path, worker_id, on_event, on_close=None):
+        self.worker_id = worker_id
+        self.on_event = on_event
+        self.on_close = on_close
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        reader_thread = threading.Thread(target=self.read_loop)
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def publish(self, event):
+        event['origin'] = self.worker_id
+        data = pack_message(event, BUS_MAX_FRAME_SIZE)
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            logger.warning("Error publishing to bus: %s", e)
+
+    def read_loop(self):
+        try:
+            for event in read_messages(self.sock, FrameDecoder(BUS_MAX_FRAME_SIZE)):
+                try:
+                    self.on_event(event)
+                except Exception as e:
+                    logger.exception("Error applying bus event %s: %s", event.get('type'), e)
+        except OSError as e:
+            logger.warning("Lost connection to bus: %s", e)
+        if self.on_close is not None:
+            self.on_close()
+
+def start_workers(count, target, args):
+    """Start count worker processes running target(worker_id, *args)"""
+    # Spawn rather than fork so workers don't inherit the hub's sockets, which
+    # would keep a worker's bus connection open after the parent has gone
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for worker_id in range(count):
+        process = context.Process(target=target, args=(worker_id,) + tuple(args))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes
@@ -0,0 +1,244 @@
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+DISCOVERY_PORT = 5556
+DISCOVERY_REQUEST = b"CHAT_DISCOVER"
+# Administratively scoped group used when broadcast is replaced by multicast
+DEFAULT_MULTICAST_GROUP = '239.255.77.77'
+# Replies allowed per source address: a steady rate plus a small burst
+SOURCE_RATE = 2.0
+SOURCE_BURST = 5
+# Replies allowed in total, so many spoofed sources still can't keep the thread busy
+GLOBAL_RATE = 200.0
+MAX_TRACKED_SOURCES = 4096
+
+logger = logging.getLogger('chat.discovery')
+
+class TokenBucket:
+    """Allows rate events per second on average and up to burst at once"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class DiscoveryResponder:
+    """Answers CHAT_DISCOVER datagrams with a reply encoded ahead of time
+
+    The reply is rebuilt by update() only when the server's info actually changes,
+    so answering costs one sendto. Each source address gets its own token bucket,
+    on top of a global one. With a multicast group the socket joins that group
+    instead of relying on LAN broadcast; it still answers datagrams sent to it directly.
+    """
+    def __init__(self, port=DISCOVERY_PORT, multicast_group=None):
+        self.multicast_group = multicast_group
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if multicast_group:
+            # Several servers on one host can share the group's port
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('', port))
+            membership = struct.pack('4s4s', socket.inet_aton(multicast_group), socket.inet_aton('0.0.0.0'))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.sock.bind(('', port))
+        self.lock = threading.Lock()
+        self.info = None
+        self.reply = b'{}'
+        self.sources = {}  # {source ip: TokenBucket}
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.replies_sent = 0
+        self.requests_dropped = 0
+
+    def start(self):
+        discovery_thread = threading.Thread(target=self.serve_forever)
+        discovery_thread.daemon = True
+        discovery_thread.start()
+
+    def update(self, info):
+        """Set the server info to advertise, re-encoding only if it changed"""
+        with self.lock:
+            if info == self.info:
+                return
+            self.info = info
+            self.reply = json.dumps(info).encode()
+
+    def allow(self, address):
+        now = time.monotonic()
+        bucket = self.sources.get(address)
+        if bucket is None:
+            if len(self.sources) >= MAX_TRACKED_SOURCES:
+                # Forget sources that have been quiet long enough to be back at a full burst
+                idle = now - SOURCE_BURST / SOURCE_RATE
+                self.sources = {source: kept for source, kept in self.sources.items() if kept.updated > idle}
+            bucket = self.sources[address] = TokenBucket(SOURCE_RATE, SOURCE_BURST)
+        return bucket.allow(now) and self.global_bucket.allow(now)
+
+    def serve_forever(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+                if data != DISCOVERY_REQUEST:
+                    continue
+                if not self.allow(addr[0]):
+                    self.requests_dropped += 1
+                    continue
+                self.sock.sendto(self.reply, addr)
+                self.replies_sent += 1
+            except Exception as e:
+                logger.warning("Discovery error: %s", e)
+                continue
+
+# Client side
+PROBE_TIMEOUT = 2.0          # Seconds to wait for replies after the last probe went out
+PROBE_BATCH = 64             # Unicast probes sent between checks for replies
+MAX_UNICAST_PROBES = 4096    # Largest CIDR range probed host by host
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.webchat_servers.json')
+CACHE_MAX_AGE = 24 * 3600    # Cached servers older than this are forgotten
+RTT_SMOOTHING = 0.5          # Weight of a new RTT sample against the cached one
+
+class DiscoveryClient:
+    """Finds servers in the background and reports each one as soon as it answers
+
+    A probe goes to the LAN broadcast address, the default multicast group and, if
+    given, every host of a CIDR range, all from one non-blocking socket, so replies
+    are read while unicast probes are still going out. Servers seen recently are
+    kept with their smoothed round trip time in a small cache file, so the launcher
+    can list them before any reply arrives. on_result(server) is called from the
+    probe thread with a dict of host, port, info, rtt, seen and cached.
+    """
+    def __init__(self, on_result, port=DISCOVERY_PORT, cache_path=CACHE_PATH):
+        self.on_result = on_result
+        self.port = port
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.servers = self.load_cache()  # {"host:port": server}
+        self.generation = 0               # Bumped by every probe so an older one stops early
+        self.running = False              # Whether the newest probe is still sending or waiting
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                servers = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        cutoff = time.time() - CACHE_MAX_AGE
+        return {key: dict(server, cached=True) for key, server in servers.items()
+                if isinstance(server, dict) and server.get('seen', 0) > cutoff}
+
+    def save_cache(self):
+        with self.lock:
+            servers = {key: {field: value for field, value in server.items() if field != 'cached'}
+                       for key, server in self.servers.items()}
+        try:
+            with open(self.cache_path, 'w') as cache_file:
+                json.dump(servers, cache_file)
+        except OSError as e:
+            logger.warning("Could not save server cache: %s", e)
+
+    def cached_servers(self):
+        """Servers remembered from earlier probes, fastest first"""
+        with self.lock:
+            return sorted(self.servers.values(), key=lambda server: server['rtt'])
+
+    def probe(self, cidr=None):
+        """Start a probe in the background; results arrive through on_result
+
+        Raises ValueError at once for a malformed CIDR range.
+        """
+        network = ipaddress.ip_network(cidr, strict=False) if cidr else None
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.running = True
+        probe_thread = threading.Thread(target=self.run_probe, args=(generation, network))
+        probe_thread.daemon = True
+        probe_thread.start()
+
+    def run_probe(self, generation, network):
+        targets = [('<broadcast>', self.port), (DEFAULT_MULTICAST_GROUP, self.port)]
+        if network is not None:
+            targets += [(str(host), self.port) for host in itertools.islice(network.hosts(), MAX_UNICAST_PROBES)]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setblocking(False)
+        sent = {}  # {host: time its probe went out}
+        group_sent = None  # Replies to broadcast/multicast come from hosts we never probed directly
+        pending = iter(targets)
+        deadline = None
+        try:
+            while generation == self.generation:
+                if deadline is None:
+                    batch = list(itertools.islice(pending, PROBE_BATCH))
+                    for target in batch:
+                        try:
+                            sock.sendto(DISCOVERY_REQUEST, target)
+                        except OSError:
+                            continue  # No route for broadcast or multicast here
+                        now = time.monotonic()
+                        sent[target[0]] = now
+                        if group_sent is None:
+                            group_sent = now
+                    if not batch:
+                        deadline = time.monotonic() + PROBE_TIMEOUT
+                wait = 0.01 if deadline is None else deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                readable, _, _ = select.select([sock], [], [], wait)
+                if readable:
+                    self.read_replies(sock, sent, group_sent)
+        finally:
+            sock.close()
+            with self.lock:
+                if generation == self.generation:
+                    self.running = False
+        self.save_cache()
+
+    def probing(self):
+        """Whether a probe is still under way"""
+        return self.running
+
+    def read_replies(self, sock, sent, group_sent):
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # An ICMP error from a unicast probe; select tells us when to read again
+            try:
+                info = json.loads(data.decode())
+            except ValueError:
+                continue
+            if not isinstance(info, dict):
+                continue
+            rtt = time.monotonic() - sent.get(addr[0], group_sent or time.monotonic())
+            self.report(addr[0], info, rtt)
+
+    def report(self, host, info, rtt):
+        port = info.get('port', 5555)
+        key = f"{host}:{port}"
+        with self.lock:
+            previous = self.servers.get(key)
+            if previous is not None:
+                rtt = RTT_SMOOTHING * rtt + (1 - RTT_SMOOTHING) * previous['rtt']
+            server = {'host': host, 'port': port, 'info': info, 'rtt': rtt, 'seen': time.time(), 'cached': False}
+            self.servers[key] = server
+        self.on_result(server)
@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from Logs import setup_logging
+from Server import ChatServer, DEFAULT_RATE_LIMITS
+from Protocol import FrameDecoder, FrameError, RECV_BUFFER_SIZE, pack_message
+
+MAX_LATENCY_SAMPLES = 200000  # Latencies kept for percentiles, a uniform sample of them beyond this
+RSS_INTERVAL = 1.0            # Seconds between samples of the server's memory use
+CONNECT_TIMEOUT = 10.0
+SETUP_TIMEOUT = 30.0
+
+def serve(port_queue, mode, options):
+    """Child process entry point: run a server on a free loopback port and report the port"""
+    # Only problems are worth seeing under load, and the banner not at all
+    sys.stdout = open(os.devnull, 'w')
+    setup_logging('WARNING')
+    server = ChatServer(host='127.0.0.1', port=0, discovery_port=None, **options)
+    port_queue.put(server.server_socket.getsockname()[1])
+    try:
+        server.start(mode)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+def start_server(mode, options):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(port_queue, mode, options))
+    process.daemon = True
+    process.start()
+    return process, port_queue.get(timeout=SETUP_TIMEOUT)
+
+def read_rss(pid):
+    """Resident set size of a process in bytes, or None where /proc isn't available"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit does; each user needs one here and one in the server"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class LoadStats:
+    """Counters and latency samples shared by every simulated user, all on one event loop"""
+    def __init__(self):
+        self.connected = 0
+        self.connect_errors = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.room_switches = 0
+        self.reconnects = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.throttled = 0
+        self.server_busy = 0
+        self.latency_count = 0
+        self.latency_max = 0.0
+        self.samples = []
+        self.rss = []
+
+    def add_latency(self, latency):
+        self.latency_count += 1
+        self.latency_max = max(self.latency_max, latency)
+        if len(self.samples) < MAX_LATENCY_SAMPLES:
+            self.samples.append(latency)
+        else:
+            # Reservoir sampling keeps every latency equally likely to be in the sample
+            index = random.randrange(self.latency_count)
+            if index < MAX_LATENCY_SAMPLES:
+                self.samples[index] = latency
+
+    def latency_ms(self):
+        ordered = sorted(self.samples)
+        return {
+            'samples': self.latency_count,
+            'p50': percentile(ordered, 0.50) * 1000 if ordered else None,
+            'p95': percentile(ordered, 0.95) * 1000 if ordered else None,
+            'p99': percentile(ordered, 0.99) * 1000 if ordered else None,
+            'max': self.latency_max * 1000 if ordered else None
+        }
+
+class SimulatedUser:
+    """One headless chat user speaking the plain JSON protocol
+
+    Chat messages carry their send time as content, so every member of the room
+    that receives one adds a delivery latency sample.
+    """
+    def __init__(self, name, port, stats):
+        self.name = name
+        self.port = port
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.room = None
+        self.closing = False
+        self.history_remaining = 0  # Backlog messages still to come, which aren't timed
+        self.room_list = asyncio.Event()
+
+    async def connect(self):
+        self.closing = False
+        self.history_remaining = 0
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', self.port), CONNECT_TIMEOUT)
+        await self.send({'type': 'username', 'username': self.name})
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def close(self):
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.receiver is not None:
+            await self.receiver
+
+    async def send(self, message):
+        self.writer.write(pack_message(message))
+        await self.writer.drain()
+
+    async def receive(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                for message in decoder.feed_messages(data):
+                    self.handle(message)
+        except (OSError, FrameError, ValueError):
+            if not self.closing:
+                self.stats.errors += 1
+        if not self.closing:
+            self.stats.disconnects += 1
+
+    def handle(self, message):
+        kind = message.get('type')
+        if kind == 'message':
+            if self.history_remaining:
+                self.history_remaining -= 1
+                return
+            if message.get('sender') == 'Server':
+                return
+            self.stats.messages_received += 1
+            try:
+                self.stats.add_latency(time.perf_counter() - float(message['content']))
+            except (KeyError, TypeError, ValueError):
+                self.stats.errors += 1
+        elif kind == 'history':
+            self.history_remaining = message.get('count', 0)
+        elif kind == 'room_list':
+            self.room_list.set()
+        elif kind == 'throttled':
+            self.stats.throttled += 1
+        elif kind == 'server_busy':
+            self.stats.server_busy += 1
+        elif kind == 'room_joined':
+            if message.get('success'):
+                self.room = message['room']
+            else:
+                self.stats.errors += 1
+        elif kind == 'room_created':
+            if not message.get('success') and message.get('message') != 'Room already exists':
+                self.stats.errors += 1
+
+    async def run(self, rooms, deadline, rate, switch_rate, reconnect_rate):
+        """Send messages, switch rooms and reconnect as Poisson processes until deadline"""
+        loop = asyncio.get_running_loop()
+        total_rate = rate + switch_rate + reconnect_rate
+        try:
+            await self.send({'type': 'join_room', 'room': random.choice(rooms), 'password': None})
+            while True:
+                remaining = deadline - loop.time()
+                wait = random.expovariate(total_rate) if total_rate else remaining
+                if wait >= remaining:
+                    await asyncio.sleep(max(0, remaining))
+                    return
+                await asyncio.sleep(wait)
+                action = random.uniform(0, total_rate)
+                if action < rate:
+                    await self.send({'type': 'message', 'content': f"{time.perf_counter():.9f}",
+                                     'room': self.room})
+                    self.stats.messages_sent += 1
+                elif action < rate + switch_rate:
+                    others = [room for room in rooms if room != self.room] or rooms
+                    await self.send({'type': 'join_room', 'room': random.choice(others), 'password': None})
+                    self.stats.room_switches += 1
+                else:
+                    await self.close()
+                    await self.connect()
+                    await self.send({'type': 'join_room', 'room': random.choice(rooms), 'password': None})
+                    self.stats.reconnects += 1
+        except (OSError, asyncio.TimeoutError):
+            self.stats.errors += 1
+        finally:
+            await self.close()
+
+async def sample_rss(pid, stats, stop):
+    while not stop.is_set():
+        rss = read_rss(pid)
+        if rss is not None:
+            stats.rss.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), RSS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def create_rooms(port, rooms, stats):
+    """Create the rooms from an owner who stays connected, so they're never collected as idle"""
+    owner = SimulatedUser('load-owner', port, stats)
+    await owner.connect()
+    await asyncio.wait_for(owner.room_list.wait(), SETUP_TIMEOUT)
+    owner.room_list.clear()
+    for room in rooms:
+        await owner.send({'type': 'create_room', 'room': room, 'password': None})
+    # Replies come in order, so this list arrives once every room exists
+    await owner.send({'type': 'room_list_request'})
+    await asyncio.wait_for(owner.room_list.wait(), SETUP_TIMEOUT)
+    return owner
+
+async def run_load(port, server_pid, args):
+    stats = LoadStats()
+    rooms = [f"load-room{i}" for i in range(args.rooms)]
+    owner = await create_rooms(port, rooms, stats)
+    stop = asyncio.Event()
+    rss_task = asyncio.create_task(sample_rss(server_pid, stats, stop)) if server_pid else None
+
+    # Start connecting users at a steady pace rather than all in one burst
+    users = []
+
+    async def connect(user):
+        try:
+            await user.connect()
+            users.append(user)
+            stats.connected += 1
+        except (OSError, asyncio.TimeoutError):
+            stats.connect_errors += 1
+
+    connecting = []
+    ramp_start = time.perf_counter()
+    for i in range(args.users):
+        connecting.append(asyncio.create_task(connect(SimulatedUser(f"load{i}", port, stats))))
+        if args.connect_rate:
+            delay = ramp_start + (i + 1) / args.connect_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    await asyncio.gather(*connecting)
+    ramp_seconds = time.perf_counter() - ramp_start
+
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    deadline = loop.time() + args.duration
+    await asyncio.gather(*(user.run(rooms, deadline, args.rate, args.switches_per_min / 60,
+                                    args.reconnects_per_min / 60) for user in users))
+    elapsed = time.perf_counter() - start
+    await owner.close()
+    stop.set()
+    if rss_task is not None:
+        await rss_task
+
+    return {
+        'config': {
+            'users': args.users,
+            'rooms': args.rooms,
+            'rate': args.rate,
+            'switches_per_min': args.switches_per_min,
+            'reconnects_per_min': args.reconnects_per_min,
+            'duration': args.duration,
+            'mode': args.mode
+        },
+        'connected': stats.connected,
+        'connect_errors': stats.connect_errors,
+        'ramp_seconds': ramp_seconds,
+        'elapsed_seconds': elapsed,
+        'messages_sent': stats.messages_sent,
+        'messages_received': stats.messages_received,
+        'sent_per_second': stats.messages_sent / elapsed,
+        'delivered_per_second': stats.messages_received / elapsed,
+        'room_switches': stats.room_switches,
+        'reconnects': stats.reconnects,
+        'errors': stats.errors,
+        'disconnects': stats.disconnects,
+        'throttled': stats.throttled,
+        'server_busy': stats.server_busy,
+        'latency_ms': stats.latency_ms(),
+        'server_rss_mb': {
+            'start': stats.rss[0] / 2**20,
+            'peak': max(stats.rss) / 2**20,
+            'end': stats.rss[-1] / 2**20
+        } if stats.rss else None
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load test for the chat server")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=0.5, help="messages per second sent by each user")
+    parser.add_argument('--switches-per-min', type=float, default=1.0, help="room switches per minute per user")
+    parser.add_argument('--reconnects-per-min', type=float, default=0.2,
+                        help="disconnects and reconnects per minute per user")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of load once every user is connected")
+    parser.add_argument('--connect-rate', type=float, default=500.0, help="users connected per second (0 for no limit)")
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread',
+                        help="engine of the server started for the test")
+    parser.add_argument('--port', type=int,
+                        help="load a server already listening on this local port instead of starting one")
+    parser.add_argument('--server-pid', type=int, help="pid of that server, to report its memory use")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    process = None
+    if args.port is None:
+        # Default flood control, except that the setup creates every room at once and
+        # any number of users may connect
+        limits = {name: limit for name, limit in DEFAULT_RATE_LIMITS.items() if name != 'create_room'}
+        process, port = start_server(args.mode, {'rate_limits': limits, 'max_connections': None, 'max_rooms': None})
+        server_pid = process.pid
+    else:
+        port, server_pid = args.port, args.server_pid
+    try:
+        result = asyncio.run(run_load(port, server_pid, args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
@@ -0,0 +1,106 @@
+import json
+import logging
+import logging.handlers
+import queue
+import signal
+import sys
+import threading
+import time
+from Discovery import TokenBucket
+
+# Records of one event (same logger and message) let through per second, plus a burst
+EVENT_RATE = 20.0
+EVENT_BURST = 100
+LOG_FORMATS = ('text', 'json')
+# Attributes every LogRecord has; anything else on a record came from extra= and is a field
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class EventFilter(logging.Filter):
+    """Samples and rate limits records per event before they are queued
+
+    A record logged with extra={'sample': n} is kept once every n times. Every
+    event also has a token bucket, so a burst of one event can't flood the log;
+    how many were held back is reported on the event's next record.
+    """
+    def __init__(self, rate=EVENT_RATE, burst=EVENT_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.events = {}  # {(logger, message): [token bucket, records seen, records suppressed]}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        with self.lock:
+            event = self.events.get(key)
+            if event is None:
+                event = self.events[key] = [TokenBucket(self.rate, self.burst), 0, 0]
+            event[1] += 1
+            sample = getattr(record, 'sample', 1)
+            if event[1] % sample or not event[0].allow(time.monotonic()):
+                event[2] += 1
+                return False
+            suppressed, event[2] = event[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record: the message plus its extra= fields, as key=value text or JSON"""
+    def __init__(self, json_output=False):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items()
+                  if key not in RECORD_ATTRIBUTES and key != 'sample'}
+        when = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}'
+        if self.json_output:
+            entry = {'time': when, 'level': record.levelname, 'logger': record.name, 'event': record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = f"{when} {record.levelname:7} {record.name} {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value!r}" if isinstance(value, str) and ' ' in value else f"{key}={value}"
+                                   for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def setup_logging(level='INFO', log_format='text', stream=None):
+    """Route every 'chat' logger through a queue to one writer thread; returns the listener
+
+    Logging threads only filter and enqueue, the listener thread formats and writes.
+    SIGUSR1, where there is one, toggles DEBUG on and off while running.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(EventFilter())
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(log_format == 'json'))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+    logger = logging.getLogger('chat')
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.propagate = False
+    set_level(level)
+
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        configured = logger.level
+        signal.signal(signal.SIGUSR1, lambda signum, frame: set_level(
+            configured if logger.level == logging.DEBUG else logging.DEBUG))
+    return listener
+
+def set_level(level, name='chat'):
+    """Change a logger's level at runtime, by name or number; returns the new level's name"""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level")
+    logging.getLogger(name).setLevel(level)
+    return logging.getLevelName(level)
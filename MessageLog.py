@@ -0,0 +1,354 @@
+import os
+import logging
+import mmap
+import time
+import struct
+import threading
+import zlib
+from Protocol import HEADER, FrameDecoder, FrameError, MAX_FRAME_SIZE, decode_message, pack_message
+
+# Records hold a chat message plus its room, sequence number and timestamp
+LOG_MAX_RECORD_SIZE = 2 * MAX_FRAME_SIZE
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.05          # Seconds a record may wait for its group commit
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+DEFAULT_RETENTION_BYTES = 1024 * 1024 * 1024
+GROUP_COMMIT_BYTES = 1024 * 1024       # Pending bytes that trigger a commit before the interval is up
+INDEX_EVERY = 32                       # Index one record in this many per room and segment
+INDEX_ENTRY = struct.Struct('!IIQ')    # Room name crc32, sequence number, offset in the segment
+INDEX_INITIAL_ENTRIES = 4096
+READ_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger('chat.log')
+
+def room_key(room):
+    return zlib.crc32(room.encode())
+
+class Segment:
+    """One log file and its memory-mapped sparse index
+
+    Every room's first record in the segment is indexed, then every INDEX_EVERY-th,
+    so a read seeks close to the sequence number it wants and scans from there.
+    Sequence numbers start at 1, so an all-zero entry marks the end of the index.
+    """
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory, f"{number:010d}.log")
+        self.index_path = os.path.join(directory, f"{number:010d}.idx")
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.first_seqs = {}  # {room key: first sequence number in this segment}
+        self.counts = {}      # {room key: records since that room's last index entry}
+        self.entries = 0
+        self.index_file = None
+        self.index = None
+
+    def open_index(self):
+        if self.index is not None:
+            return
+        self.index_file = open(self.index_path, 'a+b')
+        if os.path.getsize(self.index_path) < INDEX_ENTRY.size * INDEX_INITIAL_ENTRIES:
+            self.index_file.truncate(INDEX_ENTRY.size * INDEX_INITIAL_ENTRIES)
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        self.entries = 0
+        self.first_seqs = {}
+        for key, seq, offset in self.index_entries():
+            if offset >= self.size:
+                break  # Points past a torn write that recovery cut off
+            self.first_seqs.setdefault(key, seq)
+            self.entries += 1
+
+    def index_entries(self):
+        return index_entries(self.index)
+
+    def add_to_index(self, key, seq, offset):
+        count = self.counts.get(key, INDEX_EVERY)
+        if key in self.first_seqs and count < INDEX_EVERY:
+            self.counts[key] = count + 1
+            return
+        self.counts[key] = 1
+        self.first_seqs.setdefault(key, seq)
+        position = self.entries * INDEX_ENTRY.size
+        if position + INDEX_ENTRY.size > len(self.index):
+            # Out of room: double the index file and map it again
+            self.index.close()
+            self.index_file.truncate(len(self.index) * 2 if len(self.index) else INDEX_ENTRY.size * INDEX_INITIAL_ENTRIES)
+            self.index = mmap.mmap(self.index_file.fileno(), 0)
+        INDEX_ENTRY.pack_into(self.index, position, key, seq, offset)
+        self.entries += 1
+
+    def seal(self):
+        """Flush and unmap the index once the segment stops growing"""
+        if self.index is not None:
+            self.index.flush()
+            self.index.close()
+            self.index_file.close()
+            self.index = None
+            self.index_file = None
+
+    def rebuild_index(self):
+        """Index the whole segment again from its records, cutting off a torn tail"""
+        self.seal()
+        if os.path.exists(self.index_path):
+            os.unlink(self.index_path)
+        self.open_index()
+        self.counts = {}
+        valid = 0
+        for offset, length, record in read_records(self.path, 0, self.size):
+            self.add_to_index(room_key(record['room']), record['seq'], offset)
+            valid = offset + length
+        if valid < self.size:
+            logger.warning("Truncating torn tail of %s at %d", self.path, valid)
+            with open(self.path, 'r+b') as log_file:
+                log_file.truncate(valid)
+            self.size = valid
+
+    def delete(self):
+        self.seal()
+        for path in (self.path, self.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def index_entries(index):
+    for key, seq, offset in INDEX_ENTRY.iter_unpack(index):
+        if not seq:
+            return
+        yield key, seq, offset
+
+def seek_offset(index, key, seq):
+    """Offset of a room's last indexed record at or before seq, or of its first one"""
+    best = None
+    for entry_key, entry_seq, offset in index_entries(index):
+        if entry_key != key:
+            continue
+        if entry_seq > seq and best is not None:
+            break
+        best = offset
+    return best or 0
+
+def read_records(path, offset, end):
+    """Yield (offset, length, record) for every complete record between offset and end"""
+    decoder = FrameDecoder(LOG_MAX_RECORD_SIZE)
+    try:
+        log_file = open(path, 'rb')
+    except FileNotFoundError:
+        return  # Removed by retention since the caller looked it up
+    with log_file:
+        log_file.seek(offset)
+        position = offset
+        while position < end:
+            data = log_file.read(min(READ_CHUNK_SIZE, end - position))
+            if not data:
+                return
+            position += len(data)
+            try:
+                payloads = decoder.feed(data)
+            except FrameError:
+                return  # Garbage after a torn write
+            for payload in payloads:
+                length = HEADER.size + len(payload)
+                try:
+                    record = decode_message(payload)
+                except ValueError:
+                    return
+                yield offset, length, record
+                offset += length
+
+class MessageLog:
+    """Durable, append-only log of every room's chat messages
+
+    append only queues a record and returns its sequence number; a commit thread
+    writes everything pending in one write and one fsync (group commit) every
+    flush_interval seconds, so a slow disk never holds up a broadcast. Records go
+    into segment files of about segment_bytes each. Whole segments are dropped once
+    they are older than retention_seconds or the log outgrows retention_bytes.
+    """
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS, retention_bytes=DEFAULT_RETENTION_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()            # Guards pending, next_seqs and segments
+        self.commit_lock = threading.Lock()     # Held while a group is written
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = []       # (room, seq, encoded record) waiting for the next commit
+        self.pending_bytes = 0
+        self.next_seqs = {}     # {room: next sequence number}
+        self.closed = False
+        self.segments = self.load_segments()
+        self.active = self.segments[-1]
+        self.log_file = open(self.active.path, 'ab')
+
+        commit_thread = threading.Thread(target=self.commit_loop)
+        commit_thread.daemon = True
+        commit_thread.start()
+
+    def load_segments(self):
+        """Open the segments on disk and recover every room's next sequence number"""
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        segments = [Segment(self.directory, number) for number in numbers] or [Segment(self.directory, 1)]
+        for segment in segments[:-1]:
+            segment.open_index()
+        # The active segment's index may be behind its records after a crash
+        segments[-1].rebuild_index()
+        # A room's last record lives in the segment holding its last index entry
+        last_entries = {}
+        for segment in segments:
+            for key, seq, offset in segment.index_entries():
+                last_entries[key] = (segment, offset)
+        for segment in segments:
+            offsets = [offset for entry_segment, offset in last_entries.values() if entry_segment is segment]
+            if not offsets:
+                continue
+            for _, _, record in read_records(segment.path, min(offsets), segment.size):
+                self.next_seqs[record['room']] = max(self.next_seqs.get(record['room'], 1), record['seq'] + 1)
+        for segment in segments[:-1]:
+            segment.seal()
+        return segments
+
+    def append(self, room, message):
+        """Queue a message for the next group commit and return its sequence number"""
+        with self.lock:
+            if self.closed:
+                raise ValueError("Message log is closed")
+            seq = self.next_seqs.get(room, 1)
+            self.next_seqs[room] = seq + 1
+            data = pack_message({'room': room, 'seq': seq, 'time': time.time(), 'message': message},
+                                LOG_MAX_RECORD_SIZE)
+            self.pending.append((room, seq, data))
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= GROUP_COMMIT_BYTES:
+                self.wakeup.notify()
+        return seq
+
+    def commit_loop(self):
+        while True:
+            with self.lock:
+                if not self.closed and self.pending_bytes < GROUP_COMMIT_BYTES:
+                    self.wakeup.wait(self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Error writing message log: %s", e)
+
+    def flush(self):
+        """Write and fsync everything appended so far"""
+        with self.commit_lock:
+            with self.lock:
+                group, self.pending = self.pending, []
+                self.pending_bytes = 0
+            if not group:
+                return
+            segment = self.active
+            offset = segment.size
+            self.log_file.write(b''.join(data for _, _, data in group))
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            # Index only once the records are durable, so no entry points at lost data
+            for room, seq, data in group:
+                segment.add_to_index(room_key(room), seq, offset)
+                offset += len(data)
+            segment.size = offset
+            if segment.size >= self.segment_bytes:
+                self.roll()
+
+    def roll(self):
+        """Seal the active segment, start the next one and apply retention"""
+        self.log_file.close()
+        self.active.seal()
+        segment = Segment(self.directory, self.active.number + 1)
+        segment.open_index()
+        self.log_file = open(segment.path, 'ab')
+        with self.lock:
+            self.segments.append(segment)
+            self.active = segment
+        self.apply_retention()
+
+    def apply_retention(self):
+        """Drop the oldest sealed segments past the age or size limit"""
+        cutoff = time.time() - self.retention_seconds
+        with self.lock:
+            total = sum(segment.size for segment in self.segments)
+            expired = []
+            for segment in self.segments[:-1]:
+                try:
+                    too_old = os.path.getmtime(segment.path) < cutoff
+                except FileNotFoundError:
+                    too_old = True
+                if not too_old and total <= self.retention_bytes:
+                    break
+                expired.append(segment)
+                total -= segment.size
+            self.segments = self.segments[len(expired):]
+        for segment in expired:
+            logger.info("Removing log segment %s", segment.path)
+            segment.delete()
+
+    def read(self, room, before=None, limit=50):
+        """One page of a room's committed history, oldest first
+
+        Returns the up to limit messages with a sequence number below before (the
+        newest ones if before is None) as (seq, time, message) tuples.
+        """
+        key = room_key(room)
+        with self.lock:
+            segments = list(self.segments)
+            if before is None:
+                before = self.next_seqs.get(room, 1)
+        start = max(1, before - limit)
+        # Newest segment whose first record of the room is at or before start
+        first = 0
+        for position in range(len(segments) - 1, -1, -1):
+            first_seq = segments[position].first_seqs.get(key)
+            if first_seq is not None and first_seq <= start:
+                first = position
+                break
+        page = []
+        for segment in segments[first:]:
+            first_seq = segment.first_seqs.get(key)
+            if first_seq is None or first_seq >= before:
+                continue
+            offset = self.seek_offset(segment, key, start)
+            for _, _, record in read_records(segment.path, offset, segment.size):
+                if record['room'] == room and start <= record['seq'] < before:
+                    page.append((record['seq'], record['time'], record['message']))
+                if record['room'] == room and record['seq'] >= before - 1:
+                    break
+            if page and page[-1][0] >= before - 1:
+                break
+        return page
+
+    def seek_offset(self, segment, key, seq):
+        with self.commit_lock:
+            if segment.index is not None:
+                return seek_offset(segment.index, key, seq)
+        # Sealed segments keep their index unmapped until a read needs it
+        index = mmap_index(segment.index_path)
+        if index is None:
+            return 0
+        with index:
+            return seek_offset(index, key, seq)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.flush()
+        with self.commit_lock:
+            self.log_file.close()
+            self.active.seal()
+
+def mmap_index(path):
+    """Read-only map of a sealed segment's index, None if the segment is gone"""
+    try:
+        with open(path, 'rb') as index_file:
+            return mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
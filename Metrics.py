@@ -0,0 +1,151 @@
+import bisect
+import http.server
+import threading
+import urllib.parse
+
+# Upper bounds of the histogram buckets, in seconds and in recipients
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def label_text(labels):
+    """Render {name: value} as a Prometheus label set, empty without labels"""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class Counter:
+    """Monotonic count, optionally split by the value of one label"""
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}  # {label value or None: count}
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        for label_value, count in values:
+            labels = {self.label: label_value} if self.label else {}
+            lines.append(f"{self.name}{label_text(labels)} {count}")
+
+class Sampled:
+    """A value read when the metrics are rendered, for state the server already keeps"""
+    def __init__(self, name, help_text, read, kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.kind = kind
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        lines.append(f"{self.name} {self.read()}")
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum, optionally split by one label
+
+    observe() is a bisect and three updates under a lock; buckets only become
+    cumulative when rendered.
+    """
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.lock = threading.Lock()
+        self.series = {}  # {label value or None: [counts per bucket and +Inf, sum]}
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        with self.lock:
+            series = sorted(((key, list(counts), total) for key, (counts, total) in self.series.items()),
+                            key=lambda entry: str(entry[0]))
+        for label_value, counts, total in series:
+            labels = {self.label: label_value} if self.label else {}
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{label_text(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(labels)} {total}")
+            lines.append(f"{self.name}_count{label_text(labels)} {cumulative}")
+
+class MetricsRegistry:
+    """The metrics of one process, rendered together in Prometheus text format"""
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label=None):
+        return self.add(Counter(name, help_text, label))
+
+    def histogram(self, name, help_text, buckets, label=None):
+        return self.add(Histogram(name, help_text, buckets, label))
+
+    def sampled(self, name, help_text, read, kind='gauge'):
+        return self.add(Sampled(name, help_text, read, kind))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+def serve_metrics(port, render, host='127.0.0.1', routes=None):
+    """Answer HTTP GETs of /metrics with render() from a background thread; returns the server
+
+    routes adds admin pages, {path: handler(query)} where query is the parsed
+    query string and the handler returns the text of the reply.
+    """
+    routes = dict(routes or {})
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path in ('/', '/metrics'):
+                body = render().encode()
+            elif path in routes:
+                try:
+                    body = routes[path](urllib.parse.parse_qs(query)).encode()
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # One line per scrape would only be noise
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    admin_thread = threading.Thread(target=server.serve_forever)
+    admin_thread.daemon = True
+    admin_thread.start()
+    return server
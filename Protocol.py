@@ -0,0 +1,461 @@
+import json
+import struct
+import threading
+import time
+import zlib
+
+# Every frame on the wire is a 4 byte big-endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1024 * 1024   # Largest payload either side will accept
+RECV_BUFFER_SIZE = 64 * 1024   # Bytes asked for on every recv/read call
+
+# Payload encodings. The client lists the ones it supports in the username handshake,
+# the server picks one and names it in its first room_list reply. Everything before
+# that reply, and everything to or from clients that don't ask, stays JSON.
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+SUPPORTED_FORMATS = (FORMAT_BINARY, FORMAT_JSON)  # In order of preference
+
+# Stream compression, offered and agreed in the same handshake. A compressed frame
+# has the top bit of its length header set; the rest of the header is the length of
+# the deflated payload. Each direction keeps one deflate context for the whole
+# connection, so names and keys seen in earlier frames compress to back references.
+COMPRESSION_ZLIB = 'zlib'
+SUPPORTED_COMPRESSION = (COMPRESSION_ZLIB,)
+COMPRESSED_FLAG = 0x80000000
+DEFAULT_COMPRESSION_THRESHOLD = 128  # Payloads smaller than this go out uncompressed
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame that breaks the framing rules"""
+
+class FrameTooLarge(FrameError):
+    """Raised for a frame over the size limit"""
+
+def encode_message(message):
+    """Serialize a message dict into a frame payload"""
+    return json.dumps(message).encode()
+
+def decode_message(payload):
+    """Turn a frame payload back into a message dict"""
+    return json.loads(payload.decode())
+
+def encode_frame(payload, max_frame_size=MAX_FRAME_SIZE):
+    """Prefix a payload with its length"""
+    if len(payload) > max_frame_size:
+        raise FrameTooLarge(f"Frame of {len(payload)} bytes exceeds limit of {max_frame_size}")
+    return HEADER.pack(len(payload)) + payload
+
+def pack_message(message, max_frame_size=MAX_FRAME_SIZE):
+    """Serialize and frame a message in one go, ready for sendall"""
+    return encode_frame(encode_message(message), max_frame_size)
+
+def negotiate_format(offered):
+    """Pick the wire format for a client from the list it offered in its handshake"""
+    for wire_format in SUPPORTED_FORMATS:
+        if offered and wire_format in offered:
+            return wire_format
+    return FORMAT_JSON
+
+def negotiate_compression(offered):
+    """Pick the stream compression for a client, None if it offered nothing we support"""
+    for compression in SUPPORTED_COMPRESSION:
+        if offered and compression in offered:
+            return compression
+    return None
+
+class StreamCompressor:
+    """Deflates frames for one direction of one connection, keeping the context between frames
+
+    Frames must be passed in the order they go on the wire. Every compressed frame
+    ends with a sync flush, so the peer can inflate it as soon as it arrives.
+    """
+    def __init__(self, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        self.threshold = threshold
+        self.deflater = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.bytes_in = 0    # Payload bytes handed to compress_frame
+        self.bytes_out = 0   # Payload bytes actually written
+        self.frames_compressed = 0
+        self.frames_skipped = 0
+        self.cpu_seconds = 0.0
+
+    @property
+    def ratio(self):
+        """Bytes saved as a fraction of the original size, 0.0 before any traffic"""
+        return 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+
+    def compress_frame(self, frame):
+        """Turn a complete frame into its compressed form, or return it as is if it is tiny"""
+        length = len(frame) - HEADER.size
+        self.bytes_in += length
+        if length < self.threshold:
+            self.frames_skipped += 1
+            self.bytes_out += length
+            return frame
+        start = time.thread_time()
+        payload = self.deflater.compress(memoryview(frame)[HEADER.size:]) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_seconds += time.thread_time() - start
+        self.frames_compressed += 1
+        self.bytes_out += len(payload)
+        return HEADER.pack(len(payload) | COMPRESSED_FLAG) + payload
+
+    def stats(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.ratio,
+            'frames_compressed': self.frames_compressed,
+            'frames_skipped': self.frames_skipped,
+            'cpu_ms': self.cpu_seconds * 1000
+        }
+
+class StreamDecompressor:
+    """Inflates the compressed frames of one direction of one connection"""
+    def __init__(self):
+        self.inflater = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+        self.bytes_in = 0    # Compressed bytes received
+        self.bytes_out = 0   # Bytes after inflating
+        self.cpu_seconds = 0.0
+
+    @property
+    def ratio(self):
+        return 1 - self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+
+    def decompress(self, payload, max_frame_size=MAX_FRAME_SIZE):
+        start = time.thread_time()
+        try:
+            # Bounded, so a small frame can't inflate into an unbounded amount of memory
+            data = self.inflater.decompress(payload, max_frame_size + 1)
+        except zlib.error as e:
+            raise FrameError(f"Corrupt compressed frame: {e}")
+        self.cpu_seconds += time.thread_time() - start
+        if len(data) > max_frame_size or self.inflater.unconsumed_tail:
+            raise FrameError(f"Compressed frame inflates beyond limit of {max_frame_size}")
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data)
+        return data
+
+    def stats(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.ratio,
+            'cpu_ms': self.cpu_seconds * 1000
+        }
+
+class JsonCodec:
+    """The original text encoding, still used by every client that doesn't negotiate"""
+    name = FORMAT_JSON
+
+    def encode(self, message):
+        return encode_message(message)
+
+    def decode(self, payload):
+        return decode_message(payload)
+
+# Compact binary encoding: one byte type code, then the fields the type's schema
+# lists, each as a tagged value, then a tagged dict of any keys outside the schema.
+BINARY_SCHEMAS = {
+    'message': ('sender', 'content', 'room', 'seq'),
+    'room_list': ('rooms', 'protected_rooms', 'version'),
+    'room_joined': ('success', 'room', 'message'),
+    'room_created': ('success', 'room', 'message'),
+    'join_room': ('room', 'password'),
+    'create_room': ('room', 'password'),
+    'room_background': ('room', 'color'),
+    'intern': ('id', 'value'),
+    'history': ('room', 'count', 'before'),
+    'history_request': ('room', 'before', 'limit'),
+    'history_page': ('room', 'messages', 'before'),
+    'room_added': ('room', 'protected', 'version'),
+    'room_removed': ('room', 'version'),
+    'stats': ('text',),
+}
+TYPE_NAMES = list(BINARY_SCHEMAS)
+TYPE_CODES = {name: code for code, name in enumerate(TYPE_NAMES, start=1)}
+GENERIC_TYPE_CODE = 0  # Any other message: the whole dict follows as JSON
+# Room and user names repeat in nearly every frame, so they are sent as small ids
+INTERNED_FIELDS = frozenset(('sender', 'room', 'rooms', 'protected_rooms'))
+# Longer names go out as literals, which bounds what the never-shrinking table holds
+MAX_INTERNED_LENGTH = 64
+
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_STR, TAG_REF, TAG_INT, TAG_LIST, TAG_JSON, TAG_MISSING = range(9)
+MISSING = object()  # Decoded from TAG_MISSING: a schema field the original message did not have
+U32 = struct.Struct('!I')
+I64 = struct.Struct('!q')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+class StringTable:
+    """Server-wide ids for room and user names, shared by every binary connection
+
+    Each connection learns an id from an 'intern' frame the first time it needs it.
+    Ids are never reused, so only names the server has accepted are added; any
+    other string in an interned field, such as a sender a client made up, goes
+    out as a literal.
+    """
+    def __init__(self, limit=65536, max_length=MAX_INTERNED_LENGTH):
+        self.limit = limit
+        self.max_length = max_length
+        self.ids = {}
+        self.values = []
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        """Give an accepted name an id; returns it, or None if the name is too long or the table is full"""
+        if value.__class__ is not str or len(value) > self.max_length:
+            return None
+        ident = self.ids.get(value)
+        if ident is None:
+            with self.lock:
+                ident = self.ids.get(value)
+                if ident is None and len(self.values) < self.limit:
+                    ident = len(self.values)
+                    self.values.append(value)
+                    self.ids[value] = ident
+        return ident
+
+    def intern(self, value):
+        """Id for a name added earlier, or None"""
+        return self.ids.get(value)
+
+class BinaryCodec:
+    """Struct-packed encoding with integer type codes and interned names
+
+    Encoding with a StringTable turns names into ids (the server side); without one,
+    names go out as literals (the client side). Decoding resolves ids from the
+    'intern' frames seen so far, which are consumed here and never returned.
+    """
+    name = FORMAT_BINARY
+
+    def __init__(self, strings=None):
+        self.strings = strings
+        self.known = {}  # {id: string} learned from intern frames
+
+    def encode(self, message):
+        return self.encode_with_refs(message)[0]
+
+    def encode_with_refs(self, message):
+        """Encode a message and return (payload, ids of the interned names it uses)"""
+        out = bytearray()
+        refs = set()
+        schema = BINARY_SCHEMAS.get(message.get('type'))
+        if schema is None:
+            out.append(GENERIC_TYPE_CODE)
+            self.write_value(out, message, False, refs)
+            return bytes(out), refs
+        out.append(TYPE_CODES[message['type']])
+        present = 1
+        for field in schema:
+            if field in message:
+                present += 1
+                self.write_value(out, message[field], field in INTERNED_FIELDS, refs)
+            else:
+                out.append(TAG_MISSING)
+        if len(message) > present:
+            extras = {key: value for key, value in message.items() if key != 'type' and key not in schema}
+            self.write_value(out, extras, False, refs)
+        else:
+            out.append(TAG_NONE)
+        return bytes(out), refs
+
+    def write_value(self, out, value, interned, refs):
+        if value is None:
+            out.append(TAG_NONE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif value.__class__ is str:
+            ident = self.strings.intern(value) if interned and self.strings is not None else None
+            if ident is not None:
+                out.append(TAG_REF)
+                out += U32.pack(ident)
+                refs.add(ident)
+            else:
+                data = value.encode()
+                out.append(TAG_STR)
+                out += U32.pack(len(data))
+                out += data
+        elif isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+            out.append(TAG_INT)
+            out += I64.pack(value)
+        elif isinstance(value, list):
+            out.append(TAG_LIST)
+            out += U32.pack(len(value))
+            for item in value:
+                self.write_value(out, item, interned, refs)
+        else:
+            # Anything else, ints beyond 64 bits included, goes out as JSON
+            data = json.dumps(value).encode()
+            out.append(TAG_JSON)
+            out += U32.pack(len(data))
+            out += data
+
+    def decode(self, payload):
+        """Decode a payload, or return None for an intern frame"""
+        view = memoryview(payload)
+        code = view[0]
+        if code == GENERIC_TYPE_CODE:
+            return self.read_value(view, 1)[0]
+        if code > len(TYPE_NAMES):
+            raise ValueError(f"Unknown binary type code {code}")
+        message_type = TYPE_NAMES[code - 1]
+        message = {'type': message_type}
+        offset = 1
+        for field in BINARY_SCHEMAS[message_type]:
+            value, offset = self.read_value(view, offset)
+            if value is not MISSING:
+                message[field] = value
+        extras, offset = self.read_value(view, offset)
+        if extras:
+            message.update(extras)
+        if message_type == 'intern':
+            self.known[message['id']] = message['value']
+            return None
+        return message
+
+    def read_value(self, view, offset):
+        tag = view[offset]
+        offset += 1
+        if tag == TAG_NONE:
+            return None, offset
+        if tag == TAG_TRUE:
+            return True, offset
+        if tag == TAG_FALSE:
+            return False, offset
+        if tag == TAG_MISSING:
+            return MISSING, offset
+        if tag == TAG_REF:
+            (ident,) = U32.unpack_from(view, offset)
+            if ident not in self.known:
+                raise ValueError(f"Reference to unknown interned string {ident}")
+            return self.known[ident], offset + U32.size
+        if tag == TAG_INT:
+            return I64.unpack_from(view, offset)[0], offset + I64.size
+        if tag == TAG_LIST:
+            (count,) = U32.unpack_from(view, offset)
+            offset += U32.size
+            items = []
+            for _ in range(count):
+                item, offset = self.read_value(view, offset)
+                items.append(item)
+            return items, offset
+        if tag in (TAG_STR, TAG_JSON):
+            (length,) = U32.unpack_from(view, offset)
+            offset += U32.size
+            data = bytes(view[offset:offset + length])
+            if len(data) != length:
+                raise ValueError("Truncated binary value")
+            offset += length
+            return (data.decode() if tag == TAG_STR else json.loads(data)), offset
+        raise ValueError(f"Unknown binary value tag {tag}")
+
+def make_codec(wire_format, strings=None):
+    return BinaryCodec(strings) if wire_format == FORMAT_BINARY else JsonCodec()
+
+class EncodedMessage:
+    """A message serialized at most once per wire format and shared by every recipient
+
+    This is how a room with both JSON and binary clients is served: each format is
+    produced on first use and reused for the rest of the fan-out.
+    """
+    def __init__(self, message, strings=None, max_frame_size=MAX_FRAME_SIZE):
+        self.message = message
+        self.strings = strings
+        self.max_frame_size = max_frame_size
+        self.json = None
+        self.binary = None
+        self.seq = None  # Sequence number in the room, once recorded
+
+    def set_seq(self, seq):
+        """Number a recorded message, which must happen before any frame of it is built"""
+        self.seq = seq
+        self.message = dict(self.message, seq=seq)
+
+    def json_frame(self):
+        if self.json is None:
+            self.json = pack_message(self.message, self.max_frame_size)
+        return self.json
+
+    def binary_frame(self):
+        """(frame, ids of the interned names the frame refers to)"""
+        if self.binary is None:
+            payload, refs = BinaryCodec(self.strings).encode_with_refs(self.message)
+            self.binary = (encode_frame(payload, self.max_frame_size), refs)
+        return self.binary
+
+def intern_frame(ident, value):
+    """Binary frame that teaches a client the string behind an id"""
+    return encode_frame(BinaryCodec().encode({'type': 'intern', 'id': ident, 'value': value}))
+
+class FrameDecoder:
+    """Incremental decoder that turns arbitrary chunks of a byte stream into payloads
+
+    TCP may split one frame across several reads or merge several frames into one,
+    so bytes are buffered until a complete frame is available. Payloads are turned
+    into messages by codec, which can be swapped once a format is negotiated.
+    Compressed frames are inflated by decompressor, set once compression is agreed;
+    until then a compressed frame is a protocol error.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, codec=None):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.codec = codec or JsonCodec()
+        self.decompressor = None
+        self.bytes_received = 0
+
+    def feed(self, data):
+        """Add received bytes and return every payload that is now complete"""
+        self.bytes_received += len(data)
+        self.buffer += data
+        payloads = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            compressed = length & COMPRESSED_FLAG
+            length &= ~COMPRESSED_FLAG
+            if length > self.max_frame_size:
+                raise FrameTooLarge(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            if compressed and self.decompressor is None:
+                raise FrameError("Compressed frame on a connection without compression")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + HEADER.size:end])
+            if compressed:
+                payload = self.decompressor.decompress(payload, self.max_frame_size)
+            payloads.append(payload)
+            offset = end
+        if offset:
+            # Drop consumed bytes once per feed rather than once per frame
+            del self.buffer[:offset]
+        return payloads
+
+    def decode(self, payload):
+        """Decode one payload with the current codec, None if it carried no message"""
+        return self.codec.decode(payload)
+
+    def feed_messages(self, data):
+        """Add received bytes and yield each complete message
+
+        Messages are decoded lazily, so a codec switched while iterating applies to
+        the frames that follow.
+        """
+        for payload in self.feed(data):
+            message = self.decode(payload)
+            if message is not None:
+                yield message
+
+def read_messages(sock, decoder=None):
+    """Yield messages from a blocking socket until the peer closes it
+
+    The socket's current timeout applies to every recv, so callers can change it
+    between messages (for example after a handshake).
+    """
+    if decoder is None:
+        decoder = FrameDecoder()
+    while True:
+        data = sock.recv(RECV_BUFFER_SIZE)
+        if not data:
+            return
+        for message in decoder.feed_messages(data):
+            yield message
@@ -0,0 +1,290 @@
+import threading
+import collections
+import secrets
+import time
+
+CLIENT_STRIPES = 16  # Number of independently locked shards of the client table
+# Default backlog kept per room for replay to joining clients
+DEFAULT_HISTORY_MESSAGES = 100
+DEFAULT_HISTORY_BYTES = 256 * 1024
+# How long a dropped client may resume its session, and how many dropped sessions are kept
+DEFAULT_SESSION_SECONDS = 120
+MAX_SESSIONS = 100000
+
+class RoomHistory:
+    """Ring buffer of a room's last messages, bounded by count and by encoded size
+
+    Entries are the server's EncodedMessage objects, so a message is replayed from
+    the frames already built for its broadcast instead of being serialized again.
+    Not locked on its own, the room's lock guards it.
+    """
+    def __init__(self, max_messages=DEFAULT_HISTORY_MESSAGES, max_bytes=DEFAULT_HISTORY_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = collections.deque()  # (encoded message, size in bytes)
+        self.size = 0
+
+    def append(self, encoded, size):
+        if size > self.max_bytes or not self.max_messages:
+            return
+        self.entries.append((encoded, size))
+        self.size += size
+        self.trim()
+
+    def trim(self):
+        while self.entries and (len(self.entries) > self.max_messages or self.size > self.max_bytes):
+            self.size -= self.entries.popleft()[1]
+
+    def snapshot(self):
+        return [encoded for encoded, _ in self.entries]
+
+class Room:
+    """One chat room with its own lock and a copy-on-write member snapshot
+
+    members is a frozenset that is replaced, never mutated, on join and leave, so
+    broadcasts can iterate it without taking any lock.
+    """
+    def __init__(self, name, password=None, owner=None, history_limits=None):
+        self.name = name
+        self.password = password
+        self.owner = owner
+        self.background = None
+        self.lock = threading.Lock()
+        self.members = frozenset()
+        self.history = RoomHistory(*(history_limits or ()))
+        self.version = 0           # Room list version that added this room
+        self.seq = 0               # Sequence number of the newest recorded message
+        self.empty_since = time.monotonic()
+        self.removed = False       # Set once collected, after which nobody can join
+
+    def add_member(self, client):
+        """Add a client and return the backlog it has not seen yet, None if the room was removed"""
+        with self.lock:
+            if self.removed:
+                return None
+            self.members = self.members | {client}
+            self.empty_since = None
+            return self.history.snapshot()
+
+    def record(self, encoded, message_log=None):
+        """Number a message, keep it for later joiners and return the members to deliver it to now
+
+        All of it happens under the room lock, so sequence numbers follow history
+        order, and a client joining concurrently gets the message either in its
+        backlog or live, never both and never neither. With a message log the
+        log's sequence numbers are used, which carry on across restarts.
+        """
+        with self.lock:
+            if message_log is not None:
+                # Only queued for the log's next group commit, no disk I/O happens here
+                self.seq = message_log.append(self.name, encoded.message)
+            else:
+                self.seq += 1
+            encoded.set_seq(self.seq)
+            # History limits count the JSON frame, the largest of the encodings
+            self.history.append(encoded, len(encoded.json_frame()))
+            return self.members
+
+    def remove_member(self, client):
+        with self.lock:
+            self.members = self.members - {client}
+            if not self.members and self.empty_since is None:
+                self.empty_since = time.monotonic()
+
+class Registry:
+    """Thread-safe table of connected clients and rooms
+
+    Rooms are looked up under a short table lock and change membership under their
+    own lock. Clients are spread over striped shards, each guarded by its own lock,
+    so joins, leaves and broadcasts in different rooms never wait on each other.
+    Lock order is always client shard, then room.
+    """
+    def __init__(self, history_limits=None, room_history_limits=None):
+        # (messages, bytes) kept per room, overridable per room name
+        self.history_limits = history_limits or (DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES)
+        self.room_history_limits = dict(room_history_limits or {})
+        self.rooms_lock = threading.Lock()
+        self.rooms = {'General': Room('General', history_limits=self.limits_for('General'))}
+        # Bumped on every room added or removed, so clients can tell a missed change
+        self.room_version = 0
+        self.client_shards = [({}, threading.Lock()) for _ in range(CLIENT_STRIPES)]
+
+    def _shard(self, client):
+        return self.client_shards[hash(client) % CLIENT_STRIPES]
+
+    # Rooms
+
+    def limits_for(self, name):
+        return self.room_history_limits.get(name, self.history_limits)
+
+    def get_room(self, name):
+        with self.rooms_lock:
+            return self.rooms.get(name)
+
+    def create_room(self, name, password=None, owner=None):
+        """Create a room, or return None if the name is taken"""
+        with self.rooms_lock:
+            if name in self.rooms:
+                return None
+            room = Room(name, password, owner, self.limits_for(name))
+            self.room_version += 1
+            room.version = self.room_version
+            self.rooms[name] = room
+            return room
+
+    def remove_room(self, name):
+        """Remove an empty room and return the new room list version, None if it can't go"""
+        with self.rooms_lock:
+            room = self.rooms.get(name)
+            if room is None or name == 'General':
+                return None
+            with room.lock:
+                if room.members:
+                    return None
+                room.removed = True
+            del self.rooms[name]
+            self.room_version += 1
+            return self.room_version
+
+    def idle_rooms(self, online_users, idle_seconds):
+        """Names of rooms empty for idle_seconds whose owner is not connected"""
+        cutoff = time.monotonic() - idle_seconds
+        with self.rooms_lock:
+            rooms = list(self.rooms.values())
+        return [room.name for room in rooms
+                if room.name != 'General' and room.owner not in online_users
+                and room.empty_since is not None and room.empty_since <= cutoff]
+
+    def room_list(self):
+        """Snapshot of (room names, protected room names, room list version)"""
+        with self.rooms_lock:
+            rooms = list(self.rooms.values())
+            version = self.room_version
+        return [room.name for room in rooms], [room.name for room in rooms if room.password], version
+
+    def room_count(self):
+        return len(self.rooms)
+
+    # Clients
+
+    def add_client(self, client, username, room_name='General'):
+        """Add a client to a room and return the room's backlog, None if the room is gone"""
+        room = self.get_room(room_name)
+        if room is None:
+            return None
+        clients, lock = self._shard(client)
+        with lock:
+            backlog = room.add_member(client)
+            if backlog is not None:
+                clients[client] = (username, room_name)
+            return backlog
+
+    def get_client(self, client):
+        """(username, room name) for a client, or None once it has been removed"""
+        clients, lock = self._shard(client)
+        with lock:
+            return clients.get(client)
+
+    def move_client(self, client, new_room_name):
+        """Move a client to another room
+
+        Returns (room it left, backlog of the room it entered), or None if the client
+        or the new room is gone.
+        """
+        new_room = self.get_room(new_room_name)
+        clients, lock = self._shard(client)
+        with lock:
+            entry = clients.get(client)
+            if entry is None or new_room is None:
+                return None
+            username, old_room_name = entry
+            # Join first: the new room may have been collected since it was looked up
+            backlog = new_room.add_member(client)
+            if backlog is None:
+                return None
+            old_room = self.get_room(old_room_name)
+            if old_room is not None and old_room is not new_room:
+                old_room.remove_member(client)
+            clients[client] = (username, new_room_name)
+            return old_room_name, backlog
+
+    def remove_client(self, client):
+        """Forget a client and return its (username, room name)
+
+        Only the first of several concurrent callers gets the entry back, the rest
+        get None, so cleanup runs exactly once.
+        """
+        clients, lock = self._shard(client)
+        with lock:
+            entry = clients.pop(client, None)
+            if entry is not None:
+                room = self.get_room(entry[1])
+                if room is not None:
+                    room.remove_member(client)
+            return entry
+
+    def clients(self):
+        """Snapshot list of (client, (username, room name)) pairs"""
+        result = []
+        for clients, lock in self.client_shards:
+            with lock:
+                result.extend(clients.items())
+        return result
+
+    def client_count(self):
+        return sum(len(clients) for clients, _ in self.client_shards)
+
+class SessionTable:
+    """Sessions of dropped clients, kept for a while so a reconnect can resume them
+
+    A token is issued with every handshake and attached to its connection; it
+    is only stored here once that connection drops. Every session waits the
+    same time, so insertion order is expiry order and expired sessions are
+    trimmed off the front.
+    """
+    def __init__(self, seconds=DEFAULT_SESSION_SECONDS, max_sessions=MAX_SESSIONS):
+        self.seconds = seconds
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()  # {token: (username, room name, expiry)}
+        self.attached = {}  # {token: connection} for sessions whose client is still connected
+
+    def issue(self):
+        return secrets.token_urlsafe(16)
+
+    def attach(self, token, connection):
+        """Record the connection a session is live on"""
+        with self.lock:
+            self.attached[token] = connection
+
+    def attached_connection(self, token):
+        """The connection still holding a session, or None once it has dropped"""
+        return self.attached.get(token)
+
+    def detach(self, token, username, room_name):
+        """Keep a dropped client's session, in the room it was in"""
+        now = time.monotonic()
+        with self.lock:
+            self.attached.pop(token, None)
+            self.sessions.pop(token, None)
+            self.sessions[token] = (username, room_name, now + self.seconds)
+            while self.sessions:
+                _, _, expiry = next(iter(self.sessions.values()))
+                if expiry > now and len(self.sessions) <= self.max_sessions:
+                    break
+                self.sessions.popitem(last=False)
+
+    def resume(self, token, username):
+        """Take back a dropped session and return its room
+
+        None if the token is unknown, expired or another user's.
+        """
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None or entry[0] != username:
+                return None
+            del self.sessions[token]
+        return entry[1] if entry[2] > time.monotonic() else None
+
+    def session_count(self):
+        return len(self.sessions)
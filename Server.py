@@ -1,36 +1,218 @@
+import abc
 import socket
 import threading
-import json
+import asyncio
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import collections
+import logging
+import selectors
+import time
+from Registry import Registry, SessionTable, DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES, DEFAULT_SESSION_SECONDS
+from Cluster import BusHub, BusClient, start_workers
+from Discovery import DiscoveryResponder, TokenBucket, DISCOVERY_PORT, DEFAULT_MULTICAST_GROUP
+from MessageLog import MessageLog, DEFAULT_RETENTION_BYTES, DEFAULT_RETENTION_SECONDS, DEFAULT_SEGMENT_BYTES
+from Logs import LOG_FORMATS, set_level, setup_logging
+from Metrics import MetricsRegistry, FANOUT_BUCKETS, LATENCY_BUCKETS, serve_metrics
+from Protocol import (FrameDecoder, FrameError, FrameTooLarge, MAX_FRAME_SIZE, RECV_BUFFER_SIZE, FORMAT_BINARY, FORMAT_JSON,
+                      DEFAULT_COMPRESSION_THRESHOLD, EncodedMessage, StringTable, StreamCompressor,
+                      StreamDecompressor, intern_frame, make_codec, negotiate_compression, negotiate_format,
+                      pack_message, read_messages)
+
+# Outbound queue limits per client, counted in frames
+DEFAULT_HIGH_WATERMARK = 1000
+DEFAULT_LOW_WATERMARK = 250
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect', 'pause')
+# Most frames gathered into one scatter/gather write, kept under the usual IOV_MAX of 1024
+MAX_BATCH_FRAMES = 512
+# Most logged messages returned for one history_request
+MAX_HISTORY_PAGE = 100
+# Rooms left empty this long by an owner who is offline are removed
+DEFAULT_ROOM_IDLE_SECONDS = 300
+ROOM_GC_INTERVAL = 30
+# Users the server is sized for, advertised to clients as a load hint
+DEFAULT_CAPACITY = 1000
+# Client message types counted by name in the metrics; any other type counts as 'other'
+MESSAGE_TYPES = ('message', 'room_background', 'create_room', 'room_list_request', 'history_request',
+                 'join_room', 'stats')
+# Of the per-message debug records, only one in this many is logged
+MESSAGE_LOG_SAMPLE = 100
+# Most clients listed per section of a stats reply, the most interesting first
+STATS_TOP_CLIENTS = 20
+# Compression totals kept per connection and summed for metrics: (key, metric name, help)
+COMPRESSION_METRICS = (
+    ('compress_in_bytes', 'chat_compress_in_bytes_total', "Frame bytes handed to client compressors"),
+    ('compress_out_bytes', 'chat_compress_out_bytes_total',
+     "Frame bytes client compressors wrote, frames under the threshold included"),
+    ('compress_cpu_seconds', 'chat_compress_cpu_seconds_total', "CPU time spent deflating frames to clients"),
+    ('decompress_in_bytes', 'chat_decompress_in_bytes_total', "Compressed bytes received from clients"),
+    ('decompress_out_bytes', 'chat_decompress_out_bytes_total', "Bytes inflated from clients' compressed frames"),
+    ('decompress_cpu_seconds', 'chat_decompress_cpu_seconds_total', "CPU time spent inflating frames from clients"),
+)
+# Flood control: (messages per second, burst) allowed per connection for each message
+# type, and for all of a connection's messages together under 'all'
+DEFAULT_RATE_LIMITS = {
+    'all': (30.0, 60),
+    'message': (10.0, 20),
+    'create_room': (0.2, 3),
+    'join_room': (2.0, 5),
+    'room_background': (1.0, 3),
+    'room_list_request': (1.0, 5),
+    'history_request': (2.0, 5),
+    'stats': (1.0, 2)
+}
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_MAX_ROOMS = 1000
+BUSY_RETRY_SECONDS = 5  # Suggested to clients turned away because the server is full
+REFUSE_LINGER_SECONDS = 1.0  # How long a refused connection is read from before it is closed
+
+logger = logging.getLogger('chat.server')
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, max_frame_size=MAX_FRAME_SIZE, discovery_port=DISCOVERY_PORT,
+                 high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 slow_consumer_policy='drop_oldest', batch_window=0.0, worker_id=None,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, history_messages=DEFAULT_HISTORY_MESSAGES,
+                 history_bytes=DEFAULT_HISTORY_BYTES, room_history=None, log_dir=None, log_options=None,
+                 room_idle_seconds=DEFAULT_ROOM_IDLE_SECONDS, multicast_group=None, capacity=DEFAULT_CAPACITY,
+                 admin_port=None, session_seconds=DEFAULT_SESSION_SECONDS, rate_limits=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_rooms=DEFAULT_MAX_ROOMS):
         self.host = host
         self.port = port
+        self.worker_id = worker_id  # Set when this process is one of several sharing the port
+        self.max_frame_size = max_frame_size
+        # Smallest payload worth compressing for clients that ask, None turns compression off
+        self.compression_threshold = compression_threshold
+        self.queue_options = {
+            'high_watermark': high_watermark,
+            'low_watermark': low_watermark,
+            'policy': slow_consumer_policy,
+            'flush_window': batch_window,
+            'write_delay': None  # Set once the metrics below exist
+        }
+        # Flood control, see allow_message and admit_connection. rate_limits maps message
+        # types to (rate, burst) and replaces the defaults ({} turns rate limiting off);
+        # max_connections and max_rooms of None mean no cap
+        self.rate_limits = DEFAULT_RATE_LIMITS if rate_limits is None else dict(rate_limits)
+        self.max_connections = max_connections
+        self.max_rooms = max_rooms
+        self.open_connections = 0  # Including those still in their handshake
+        self.connections_lock = threading.Lock()
+        # Refused connections waiting to be closed, each with its deadline, see refuse_connection
+        self.refused = selectors.DefaultSelector()
+        self.refused_lock = threading.Lock()
+        self.reaper = None
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if worker_id is not None:
+            # Every worker binds the same port and the kernel spreads connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         
-        # Setup discovery socket
-        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.discovery_socket.bind(('', 5556))
-        
         self.server_name = socket.gethostname()
         
-        # Start discovery listener
-        discovery_thread = threading.Thread(target=self.handle_discovery)
-        discovery_thread.daemon = True
-        discovery_thread.start()
+        # Clients and rooms, safe to use from every handler thread. Each room keeps
+        # a backlog of chat messages for clients that join later; room_history maps
+        # room names to their own (messages, bytes) limits
+        self.registry = Registry((history_messages, history_bytes), room_history)
+        # Ids for room and user names sent to binary clients, added as the server accepts them
+        self.strings = StringTable()
+        for name in ('Server', 'General'):
+            self.strings.add(name)
+        # Dropped clients that reconnect within session_seconds get their room back and
+        # only the messages they missed (session_seconds=None disables resumption)
+        self.sessions = SessionTable(session_seconds) if session_seconds else None
         
-        self.clients = {}  # {client_socket: (username, current_room)}
-        self.rooms = {
-            'General': {
-                'password': None, 
-                'members': set(),
-                'owner': None,
-                'background': None
-            }
-        }
+        # Durable log of every room's chat messages (log_dir=None keeps them in memory only).
+        # Every worker receives every message, so each keeps a complete log of its own
+        self.message_log = None
+        if log_dir is not None:
+            if worker_id is not None:
+                log_dir = os.path.join(log_dir, f"worker-{worker_id}")
+            self.message_log = MessageLog(log_dir, **(log_options or {}))
+        
+        # Idle rooms are collected by this process alone; workers only see their own
+        # members, so multi-process mode keeps every room (room_idle_seconds=None does too)
+        self.room_idle_seconds = room_idle_seconds
+        if room_idle_seconds is not None and worker_id is None:
+            gc_thread = threading.Thread(target=self.room_gc_loop)
+            gc_thread.daemon = True
+            gc_thread.start()
+        
+        # Live counters and histograms, served on the admin port and to 'stats' requests
+        # in Prometheus text format. Queue and connection figures are read at scrape time
+        self.metrics = MetricsRegistry()
+        self.messages_received = self.metrics.counter(
+            'chat_messages_received_total', "Messages received from clients, by type", label='type')
+        self.bytes_received = self.metrics.counter('chat_received_bytes_total', "Bytes received from clients")
+        self.metrics.sampled('chat_sent_bytes_total', "Bytes handed to client sockets", self.bytes_sent,
+                             kind='counter')
+        self.metrics.sampled('chat_sent_frames_total', "Frames written to client sockets",
+                             lambda: self.batch_stats()['frames_sent'], kind='counter')
+        self.metrics.sampled('chat_socket_writes_total', "Writes to client sockets, each carrying a batch of frames",
+                             lambda: self.batch_stats()['batches_sent'], kind='counter')
+        self.metrics.sampled('chat_average_batch_size', "Frames per socket write since the server started",
+                             lambda: self.batch_stats()['average_batch_size'])
+        self.handle_seconds = self.metrics.histogram(
+            'chat_handle_seconds', "Time from a decoded client message to its last frame queued for a writer, by type",
+            LATENCY_BUCKETS, label='type')
+        # The rest of a message's latency, from its frames being queued to the writer handing them to the socket
+        self.queue_options['write_delay'] = self.metrics.histogram(
+            'chat_write_delay_seconds', "Time from a frame being queued to its write to the client socket",
+            LATENCY_BUCKETS)
+        self.room_fanout = self.metrics.histogram(
+            'chat_room_fanout', "Clients each room broadcast was queued for", FANOUT_BUCKETS)
+        self.metrics.sampled('chat_connections', "Clients connected to this process", self.registry.client_count)
+        self.metrics.sampled('chat_rooms', "Rooms that exist", self.registry.room_count)
+        self.limit_hits = self.metrics.counter(
+            'chat_limit_hits_total', "Messages, connections and rooms refused by flood control, by limit",
+            label='limit')
+        self.sessions_resumed = self.metrics.counter(
+            'chat_sessions_resumed_total', "Reconnects that resumed their session instead of a full handshake")
+        if self.sessions is not None:
+            self.metrics.sampled('chat_resumable_sessions', "Dropped sessions that can still be resumed",
+                                 self.sessions.session_count)
+        self.metrics.sampled('chat_outbound_queued_frames', "Frames waiting in client outbound queues",
+                             lambda: sum(client.queue_depth for client, _ in self.registry.clients()))
+        self.metrics.sampled('chat_outbound_queue_depth_max', "Deepest client outbound queue",
+                             lambda: max((client.queue_depth for client, _ in self.registry.clients()), default=0))
+        self.metrics.sampled('chat_lagging_clients', "Clients whose queue reached the high watermark and hasn't drained",
+                             lambda: sum(client.lagging for client, _ in self.registry.clients()))
+        self.metrics.sampled('chat_dropped_frames_total', "Frames dropped by the slow consumer policy",
+                             self.dropped_frames, kind='counter')
+        if self.compression_threshold is not None:
+            for key, name, help_text in COMPRESSION_METRICS:
+                self.metrics.sampled(name, help_text, lambda key=key: self.compression_totals()[key], kind='counter')
+        # Totals of clients that have since disconnected, so the counters above never go back
+        self.closed_bytes_sent = 0
+        self.closed_dropped = 0
+        self.closed_frames_sent = 0
+        self.closed_batches_sent = 0
+        self.closed_compression = {key: 0 for key, _, _ in COMPRESSION_METRICS}
+        self.closed_lock = threading.Lock()
+        self.admin = None
+        if admin_port is not None:
+            self.admin = serve_metrics(admin_port, self.metrics_text, routes={'/log-level': admin_log_level})
+        
+        # Pub/sub link to the other workers, see attach_bus
+        self.bus = None
+        self.remote_users = {}  # {worker id: connected users on that worker}
+        self.loop = None
+        
+        # Setup discovery responder (discovery_port=None disables it). Its reply is
+        # kept up to date by refresh_discovery whenever the advertised counts change
+        self.capacity = capacity
+        self.discovery = None
+        if discovery_port is not None:
+            self.discovery = DiscoveryResponder(discovery_port, multicast_group)
+            self.refresh_discovery()
+            self.discovery.start()
+        
+        if worker_id:
+            return
         
         # Get and display the server's local IP address
         hostname = socket.gethostname()
@@ -42,224 +224,1222 @@ class ChatServer:
         print("If connecting from the same network, use the Local IP.")
         print("Note: You may need to configure your firewall to allow connections on port 5555")
         
-    def broadcast(self, message, room, sender_socket=None):
-        for client_socket, (_, client_room) in self.clients.items():
-            if client_room == room and client_socket != sender_socket:
-                try:
-                    client_socket.send(json.dumps(message).encode())
-                except Exception as e:
-                    print(f"Error broadcasting to client: {e}")  # Debug print
-                    self.remove_client(client_socket)
+    def broadcast(self, message, room, sender_socket=None, record=False):
+        """Send a message to every member of a room, on this worker and all others
+
+        With record the message is also kept in the room's history.
+        """
+        self.broadcast_local(message, room, sender_socket, record)
+        if self.bus is not None:
+            self.bus.publish({'type': 'publish', 'room': room, 'message': message, 'record': record})
+
+    def broadcast_local(self, message, room, sender_socket=None, record=False):
+        """Send a message to the room's members connected to this process, serializing it only once"""
+        room = self.registry.get_room(room)
+        if room is None:
+            return
+        # Encoded lazily, once per wire format in use in the room
+        encoded = EncodedMessage(message, self.strings, self.max_frame_size)
+        if record:
+            # Numbered within the room, so reconnecting clients can say what they missed
+            members = room.record(encoded, self.message_log)
+        else:
+            members = room.members
+        self.room_fanout.observe(len(members))
+        # members is an immutable snapshot, so no lock is held while sending
+        for client_socket in members:
+            if client_socket is sender_socket:
+                continue
+            try:
+                client_socket.send_message(encoded)
+            except Exception as e:
+                logger.warning("Error broadcasting to client: %s", e)
+                self.remove_client(client_socket)
 
     def handle_client(self, client_socket, address):
-        print(f"New connection from {address}")  # Debug print
+        """Serve one connection, already counted in by admit_connection, on its own thread"""
+        logger.debug("New connection from %s", address)
+        client = ThreadedClientConnection(client_socket, **self.queue_options)
         try:
             # Set timeout for initial connection
             client_socket.settimeout(10)
             
             # Receive username
-            data = client_socket.recv(1024).decode()
-            print(f"Received initial data from {address}: {data}")  # Debug print
+            decoder = FrameDecoder(self.max_frame_size)
+            messages = read_messages(client_socket, decoder)
+            username_data = next(messages, None)
+            logger.debug("Received initial data from %s: %s", address, username_data)
             
-            username_data = json.loads(data)
             if not username_data or username_data.get('type') != 'username':
-                print(f"Invalid initial message from {address}")  # Debug print
+                logger.info("Invalid initial message from %s", address)
                 return
                 
             username = username_data.get('username')
-            print(f"User {username} connected from {address}")  # Debug print
+            logger.info("User %s connected from %s", username, address)
             
             # Remove timeout after initial connection
             client_socket.settimeout(None)
             
-            # Add client to tracking
-            self.clients[client_socket] = (username, 'General')
-            self.rooms['General']['members'].add(client_socket)
+            wire_format = negotiate_format(username_data.get('formats'))
+            compression = self.negotiate_compression(username_data)
+            if not self.register_client(client, username, wire_format, compression,
+                                        bool(username_data.get('room_deltas')), username_data):
+                return
+            decoder.codec = make_codec(wire_format)
+            decoder.decompressor = client.decompressor
             
-            # Send initial room list
             try:
-                room_list = {
-                    'type': 'room_list',
-                    'rooms': list(self.rooms.keys()),
-                    'protected_rooms': [room for room, info in self.rooms.items() if info.get('password')]
-                }
-                client_socket.send(json.dumps(room_list).encode())
-                print(f"Sent initial room list to {username}")  # Debug print
+                counted = 0
+                for message_data in messages:
+                    self.bytes_received.inc(decoder.bytes_received - counted)
+                    counted = decoder.bytes_received
+                    self.handle_message(client, username, message_data)
+                logger.info("Client %s disconnected", username)
+            except (ValueError, FrameError) as e:
+                if isinstance(e, FrameTooLarge):
+                    self.limit_hits.inc(label_value='frame_size')
+                logger.warning("Bad frame from %s: %s", username, e)
+            except OSError as e:
+                # Resets and the like are clients going away, not server trouble
+                logger.info("Client %s disconnected: %s", username, e)
             except Exception as e:
-                print(f"Error sending initial room list to {username}: {e}")  # Debug print
+                logger.warning("Error handling message from %s: %s", username, e)
+                    
+        except Exception as e:
+            logger.warning("Error in handle_client: %s", e)
+        finally:
+            self.remove_client(client)
+            client.close()
+            self.release_connection()
+
+    async def read_payloads_async(self, reader, decoder):
+        """Read until at least one complete frame arrives, None once the peer closes"""
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return None
+            self.bytes_received.inc(len(data))
+            payloads = decoder.feed(data)
+            if payloads:
+                return payloads
+
+    async def handle_client_async(self, reader, writer):
+        """Event loop counterpart of handle_client, one coroutine per connection"""
+        address = writer.get_extra_info('peername')
+        logger.debug("New connection from %s", address)
+        if not self.admit_connection():
+            await self.refuse_connection_async(reader, writer)
+            return
+        client = AsyncClientConnection(reader, writer, **self.queue_options)
+        decoder = FrameDecoder(self.max_frame_size)
+        try:
+            # Receive username, with the same timeout as the threaded mode
+            payloads = await asyncio.wait_for(self.read_payloads_async(reader, decoder), timeout=10)
+            username_data = decoder.decode(payloads.pop(0)) if payloads else None
+            logger.debug("Received initial data from %s: %s", address, username_data)
+            
+            if not username_data or username_data.get('type') != 'username':
+                logger.info("Invalid initial message from %s", address)
                 return
+                
+            username = username_data.get('username')
+            logger.info("User %s connected from %s", username, address)
             
-            # Send welcome message
-            welcome = {
-                'type': 'message',
-                'sender': 'Server',
-                'content': f'{username} joined the chat',
-                'room': 'General'
-            }
-            self.broadcast(welcome, 'General')
+            wire_format = negotiate_format(username_data.get('formats'))
+            compression = self.negotiate_compression(username_data)
+            if not self.register_client(client, username, wire_format, compression,
+                                        bool(username_data.get('room_deltas')), username_data):
+                return
+            decoder.codec = make_codec(wire_format)
+            decoder.decompressor = client.decompressor
             
-            while True:
-                try:
-                    data = client_socket.recv(1024).decode()
-                    if not data:
-                        print(f"Client {username} disconnected")  # Debug print
-                        break
-                    
-                    message_data = json.loads(data)
-                    print(f"Received {message_data['type']} from {username}")  # Debug print
-                    
-                    message_type = message_data.get('type')
-                    
-                    if message_type == 'message':
-                        current_room = self.clients[client_socket][1]
-                        self.broadcast(message_data, current_room)
-                    
-                    elif message_type == 'room_background':
-                        room = message_data.get('room')
-                        if room in self.rooms and self.rooms[room]['owner'] == username:
-                            self.rooms[room]['background'] = message_data.get('color')
-                            self.broadcast(message_data, room)
-                    
-                    elif message_type == 'create_room':
-                        room_name = message_data.get('room')
-                        password = message_data.get('password')
-                        
-                        if room_name not in self.rooms:
-                            self.rooms[room_name] = {
-                                'password': password,
-                                'members': set(),
-                                'owner': username,
-                                'background': None
-                            }
-                            response = {
-                                'type': 'room_created',
-                                'success': True,
-                                'room': room_name
-                            }
-                            # Broadcast updated room list to all clients
-                            self.broadcast_room_list()
-                        else:
-                            response = {
-                                'type': 'room_created',
-                                'success': False,
-                                'message': 'Room already exists'
-                            }
-                        client_socket.send(json.dumps(response).encode())
-                    
-                    elif message_type == 'join_room':
-                        new_room = message_data.get('room')
-                        provided_password = message_data.get('password')
-                        
-                        if new_room in self.rooms:
-                            room_password = self.rooms[new_room]['password']
-                            if room_password is None or room_password == provided_password:
-                                # Remove from old room
-                                old_room = self.clients[client_socket][1]
-                                self.rooms[old_room]['members'].remove(client_socket)
-                                
-                                # Add to new room
-                                self.rooms[new_room]['members'].add(client_socket)
-                                self.clients[client_socket] = (username, new_room)
-                                
-                                response = {
-                                    'type': 'room_joined',
-                                    'success': True,
-                                    'room': new_room
-                                }
-                                
-                                # Notify room changes
-                                change_message = {
-                                    'type': 'message',
-                                    'sender': 'Server',
-                                    'content': f'{username} moved to {new_room}',
-                                    'room': new_room
-                                }
-                                self.broadcast(change_message, new_room)
-                            else:
-                                response = {
-                                    'type': 'room_joined',
-                                    'success': False,
-                                    'message': 'Incorrect password'
-                                }
-                        else:
-                            response = {
-                                'type': 'room_joined',
-                                'success': False,
-                                'message': 'Room does not exist'
-                            }
-                        client_socket.send(json.dumps(response).encode())
-                        
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error from {username}: {e}")  # Debug print
-                    break
-                except Exception as e:
-                    print(f"Error handling message from {username}: {e}")  # Debug print
-                    break
+            try:
+                while payloads is not None:
+                    for payload in payloads:
+                        message_data = decoder.decode(payload)
+                        if message_data is not None:
+                            self.handle_message(client, username, message_data)
+                    payloads = await self.read_payloads_async(reader, decoder)
+                logger.info("Client %s disconnected", username)
+            except (ValueError, FrameError) as e:
+                if isinstance(e, FrameTooLarge):
+                    self.limit_hits.inc(label_value='frame_size')
+                logger.warning("Bad frame from %s: %s", username, e)
+            except OSError as e:
+                # Resets and the like are clients going away, not server trouble
+                logger.info("Client %s disconnected: %s", username, e)
+            except Exception as e:
+                logger.warning("Error handling message from %s: %s", username, e)
                     
         except Exception as e:
-            print(f"Error in handle_client: {e}")  # Debug print
+            logger.warning("Error in handle_client_async: %s", e)
         finally:
-            self.remove_client(client_socket)
+            self.remove_client(client)
+            client.close()
+            self.release_connection()
+
+    def admit_connection(self):
+        """Count a new connection in, or refuse it if the server already has max_connections"""
+        with self.connections_lock:
+            if self.max_connections is not None and self.open_connections >= self.max_connections:
+                self.limit_hits.inc(label_value='connections')
+                return False
+            self.open_connections += 1
+            return True
+
+    def release_connection(self):
+        with self.connections_lock:
+            self.open_connections -= 1
+
+    def busy_message(self):
+        """Sent, always as JSON, in place of the handshake reply to a connection that was turned away"""
+        return {'type': 'server_busy', 'limit': 'connections', 'retry_after': BUSY_RETRY_SECONDS,
+                'message': 'Server is full, try again later'}
+
+    def refuse_connection(self, client_socket):
+        """Send server_busy to a connection that was turned away, without blocking the accept loop
+
+        Closing with the client's handshake still unread would send a reset, which
+        can destroy the reply before the client reads it. So only the write side is
+        shut down here; the reaper thread reads and discards whatever the client
+        sends until it closes too, for REFUSE_LINGER_SECONDS at most.
+        """
+        try:
+            # A fresh connection's send buffer always has room for one small frame
+            client_socket.setblocking(False)
+            client_socket.send(pack_message(self.busy_message()))
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            client_socket.close()
+            return
+        with self.refused_lock:
+            self.refused.register(client_socket, selectors.EVENT_READ, time.monotonic() + REFUSE_LINGER_SECONDS)
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap_refused)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+    def reap_refused(self):
+        """Reaper thread: drain refused connections and close them at EOF or their deadline"""
+        while True:
+            for key, _ in self.refused.select(REFUSE_LINGER_SECONDS):
+                try:
+                    if key.fileobj.recv(RECV_BUFFER_SIZE):
+                        continue
+                except OSError:
+                    pass
+                self.close_refused(key.fileobj)
+            now = time.monotonic()
+            with self.refused_lock:
+                expired = [key.fileobj for key in self.refused.get_map().values() if key.data <= now]
+            for client_socket in expired:
+                self.close_refused(client_socket)
+
+    def close_refused(self, client_socket):
+        with self.refused_lock:
+            self.refused.unregister(client_socket)
+        client_socket.close()
+
+    async def refuse_connection_async(self, reader, writer):
+        """refuse_connection for an asyncio stream"""
+        try:
+            writer.write(pack_message(self.busy_message()))
+            await writer.drain()
+            writer.write_eof()
+            await asyncio.wait_for(self.discard_until_eof(reader), REFUSE_LINGER_SECONDS)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        writer.close()
+
+    async def discard_until_eof(self, reader):
+        while await reader.read(RECV_BUFFER_SIZE):
+            pass
+
+    def allow_message(self, client_socket, message_type):
+        """Spend a token from the client's bucket for this message type and from its overall one
+
+        A client over either limit gets one 'throttled' reply naming the limit and
+        how long to wait, then nothing more until a message gets through again; the
+        refused messages are dropped. Each connection is only ever read by one
+        thread or coroutine, so its buckets need no lock.
+        """
+        now = time.monotonic()
+        for limit in (message_type, 'all'):
+            bucket = client_socket.buckets.get(limit)
+            if bucket is None:
+                if limit not in self.rate_limits:
+                    continue
+                bucket = client_socket.buckets[limit] = TokenBucket(*self.rate_limits[limit])
+            if not bucket.allow(now):
+                self.limit_hits.inc(label_value=limit)
+                if client_socket.throttled is None:
+                    client_socket.throttled = limit
+                    retry_after = (1 - bucket.tokens) / bucket.rate if bucket.rate else None
+                    client_socket.send_message({'type': 'throttled', 'limit': limit,
+                                                'retry_after': round(retry_after, 3) if retry_after else None})
+                return False
+        client_socket.throttled = None
+        return True
+
+    def take_over_session(self, token, username):
+        """Close the connection still holding a session that a reconnect presents, detaching the session"""
+        old_client = self.sessions.attached_connection(token)
+        if old_client is None:
+            return
+        client_info = self.registry.get_client(old_client)
+        if client_info is None or client_info[0] != username:
+            return
+        logger.info("Session of %s resumed on a new connection, closing the old one", username)
+        self.remove_client(old_client)
+        old_client.close()
+
+    def negotiate_compression(self, username_data):
+        """Stream compression for a new client, None if either side doesn't want it"""
+        if self.compression_threshold is None:
+            return None
+        return negotiate_compression(username_data.get('compression'))
+
+    def register_client(self, client_socket, username, wire_format=FORMAT_JSON, compression=None, room_deltas=False,
+                        handshake=None):
+        """Add a client to General, send it the room list and announce it
+
+        A client whose handshake presents the session token of a connection that
+        dropped recently goes back to that session's room instead. It gets a short
+        'resumed' reply, the room list only if it changed since the client's
+        room_version, and only the messages after its last_seq. If the old
+        connection is still attached, because the client noticed the drop first,
+        the new one takes the session over and the old one is closed.
+        """
+        client_socket.room_deltas = room_deltas
+        handshake = handshake or {}
+        resumed_room = None
+        if self.sessions is not None:
+            if handshake.get('session'):
+                self.take_over_session(handshake['session'], username)
+                resumed_room = self.sessions.resume(handshake['session'], username)
+            client_socket.session = handshake['session'] if resumed_room is not None else self.sessions.issue()
+        room_version = self.registry.room_version
+        # Send initial room list
+        try:
+            if resumed_room is not None:
+                reply = {'type': 'resumed', 'room': resumed_room, 'version': room_version}
+            else:
+                reply = self.room_list_message()
+            if client_socket.session is not None:
+                reply['session'] = client_socket.session
+            if wire_format != FORMAT_JSON:
+                # Tell a client that offered formats which one the rest of the session uses
+                reply['format'] = wire_format
+            if compression is not None:
+                reply['compression'] = compression
+                # A client that offers compression inflates from its very first frame,
+                # so this reply may already go out compressed
+                client_socket.set_compression(compression, self.compression_threshold)
+            # The handshake reply itself is always JSON and goes out ahead of any
+            # intern frame, so it is queued as control
+            client_socket.send_message(reply, control=True)
+            client_socket.set_wire_format(wire_format, self.strings)
+            if resumed_room is not None and handshake.get('room_version') != room_version:
+                # Rooms came or went while the client was away
+                client_socket.send_message(self.room_list_message())
+            logger.debug("Sent initial room list to %s", username)
+        except Exception as e:
+            logger.warning("Error sending initial room list to %s: %s", username, e)
+            return False
+        
+        self.strings.add(username)
+        if client_socket.session is not None:
+            self.sessions.attach(client_socket.session, client_socket)
+        # Add client to tracking only once its format is settled, so no broadcast
+        # can reach it in the wrong encoding
+        if resumed_room is not None:
+            backlog = self.registry.add_client(client_socket, username, resumed_room)
+            if backlog is not None:
+                self.sessions_resumed.inc()
+                self.publish_presence()
+                last_seq = handshake.get('last_seq')
+                if not is_count(last_seq):
+                    last_seq = 0
+                self.replay_history(client_socket, resumed_room,
+                                    [encoded for encoded in backlog if encoded.seq > last_seq], resumed=True)
+                self.broadcast({'type': 'message', 'sender': 'Server', 'content': f'{username} reconnected',
+                                'room': resumed_room}, resumed_room)
+                return True
+            # The room was collected while the client was away
+            client_socket.send_message({'type': 'room_joined', 'success': True, 'room': 'General'})
+        backlog = self.registry.add_client(client_socket, username, 'General')
+        self.publish_presence()
+        self.replay_history(client_socket, 'General', backlog)
+        
+        # Send welcome message
+        welcome = {
+            'type': 'message',
+            'sender': 'Server',
+            'content': f'{username} joined the chat',
+            'room': 'General'
+        }
+        self.broadcast(welcome, 'General')
+        return True
+
+    def handle_message(self, client_socket, username, message_data):
+        """Dispatch one decoded message from a registered client, counting and timing it"""
+        started = time.perf_counter()
+        message_type = message_data.get('type')
+        label = message_type if message_type in MESSAGE_TYPES else 'other'
+        self.messages_received.inc(label_value=label)
+        if not self.allow_message(client_socket, label):
+            return
+        try:
+            self.dispatch_message(client_socket, username, message_data)
+        finally:
+            self.handle_seconds.observe(time.perf_counter() - started, label)
+
+    def dispatch_message(self, client_socket, username, message_data):
+        # Checked first so the message path costs nothing more than this when not debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received %s from %s", message_data.get('type'), username,
+                         extra={'sample': MESSAGE_LOG_SAMPLE})
+        client_info = self.registry.get_client(client_socket)
+        if client_info is None:
+            raise ConnectionError(f"{username} was disconnected")
+        
+        message_type = message_data.get('type')
+        
+        if message_type == 'message':
+            current_room = client_info[1]
+            self.broadcast(message_data, current_room, record=True)
+        
+        elif message_type == 'room_background':
+            room = self.registry.get_room(message_data.get('room'))
+            if room is not None and room.owner == username:
+                room.background = message_data.get('color')
+                self.broadcast(message_data, room.name)
+        
+        elif message_type == 'create_room':
+            room_name = message_data.get('room')
+            password = message_data.get('password')
+            
+            if self.max_rooms is not None and self.registry.room_count() >= self.max_rooms:
+                self.limit_hits.inc(label_value='rooms')
+                client_socket.send_message({
+                    'type': 'room_created',
+                    'success': False,
+                    'limit': 'rooms',
+                    'message': 'Server has too many rooms'
+                })
+                return
+            
+            room = self.registry.create_room(room_name, password, owner=username)
+            if room is not None:
+                self.strings.add(room.name)
+                response = {
+                    'type': 'room_created',
+                    'success': True,
+                    'room': room_name
+                }
+                if self.bus is not None:
+                    self.bus.publish({'type': 'room_created', 'room': room_name,
+                                      'password': password, 'owner': username})
+                # Tell all clients about the new room
+                self.broadcast_room_change(self.room_added_message(room))
+            else:
+                response = {
+                    'type': 'room_created',
+                    'success': False,
+                    'message': 'Room already exists'
+                }
+            client_socket.send_message(response)
+        
+        elif message_type == 'room_list_request':
+            # A client that missed a room change asks for a fresh snapshot
+            client_socket.send_message(self.room_list_message())
+        
+        elif message_type == 'stats':
+            client_socket.send_message(self.stats_message())
+        
+        elif message_type == 'history_request':
+            client_socket.send_message(self.history_page(client_info[1], message_data))
+        
+        elif message_type == 'join_room':
+            new_room = message_data.get('room')
+            provided_password = message_data.get('password')
+            
+            room = self.registry.get_room(new_room)
+            if room is not None and (room.password is None or room.password == provided_password):
+                # Leave the old room and enter the new one in one step
+                moved = self.registry.move_client(client_socket, new_room)
+                if moved is not None:
+                    response = {
+                        'type': 'room_joined',
+                        'success': True,
+                        'room': new_room
+                    }
+                    # The backlog follows the reply, once the client has switched rooms
+                    client_socket.send_message(response)
+                    self.replay_history(client_socket, new_room, moved[1])
+                    
+                    # Notify room changes
+                    change_message = {
+                        'type': 'message',
+                        'sender': 'Server',
+                        'content': f'{username} moved to {new_room}',
+                        'room': new_room
+                    }
+                    self.broadcast(change_message, new_room)
+                    return
+                # Collected as idle between the lookup and the move
+                room = None
+            if room is not None:
+                response = {
+                    'type': 'room_joined',
+                    'success': False,
+                    'message': 'Incorrect password'
+                }
+            else:
+                response = {
+                    'type': 'room_joined',
+                    'success': False,
+                    'message': 'Room does not exist'
+                }
+            client_socket.send_message(response)
+
+    def history_page(self, current_room, request):
+        """Answer a history_request with one page of logged messages, oldest first"""
+        room_name = request.get('room', current_room)
+        limit = request.get('limit') or MAX_HISTORY_PAGE
+        before = request.get('before')
+        if not isinstance(room_name, str) or not is_count(limit) or (before is not None and not is_count(before)):
+            return {'type': 'history_page', 'room': current_room, 'messages': [], 'message': 'Invalid request'}
+        room = self.registry.get_room(room_name)
+        response = {'type': 'history_page', 'room': room_name, 'messages': []}
+        if room is None or (room.password and room_name != current_room):
+            # Protected rooms only show their history to members
+            response['message'] = 'Not allowed'
+            return response
+        if self.message_log is None:
+            return response
+        page = self.message_log.read(room_name, before, max(1, min(limit, MAX_HISTORY_PAGE)))
+        response['messages'] = [message for _, _, message in page]
+        if page and page[0][0] > 1:
+            response['before'] = page[0][0]
+        return response
+
+    def replay_history(self, client_socket, room, backlog, resumed=False):
+        """Send a joining client the room's recent messages, all in one write
+
+        With resumed they are the messages a reconnecting client missed.
+        """
+        if not backlog:
+            return
+        header = {'type': 'history', 'room': room, 'count': len(backlog)}
+        if resumed:
+            header['resumed'] = True
+        if self.message_log is not None:
+            # Where a history_request for older messages should continue
+            header['before'] = backlog[0].seq
+        try:
+            client_socket.send_messages([header] + backlog)
+        except Exception as e:
+            logger.warning("Error replaying history of %s: %s", room, e)
 
     def remove_client(self, client_socket):
-        if client_socket in self.clients:
-            username, room = self.clients[client_socket]
+        client_info = self.registry.remove_client(client_socket)
+        if client_info is not None:
+            username, room = client_info
+            with self.closed_lock:
+                self.closed_bytes_sent += client_socket.bytes_sent
+                self.closed_dropped += client_socket.dropped
+                self.closed_frames_sent += client_socket.frames_sent
+                self.closed_batches_sent += client_socket.batches_sent
+                if client_socket.compressor is not None:
+                    for key, value in client_socket.compression_counts().items():
+                        self.closed_compression[key] += value
+            if client_socket.session is not None:
+                # Kept for a while so a reconnect can pick up where this one left off
+                self.sessions.detach(client_socket.session, username, room)
+            self.publish_presence()
             leave_message = {
                 'type': 'message',
                 'sender': 'Server',
                 'content': f'{username} left the chat',
                 'room': room
             }
-            self.rooms[room]['members'].remove(client_socket)
-            del self.clients[client_socket]
             self.broadcast(leave_message, room)
             client_socket.close()
 
-    def broadcast_room_list(self):
-        """Send updated room list to all clients"""
-        room_list = {
+    def queue_depths(self, limit=None):
+        """Outbound queue state per client, most backed up first, at most limit of them"""
+        depths = [
+            {
+                'username': username,
+                'room': room,
+                'queue_depth': client.queue_depth,
+                'dropped': client.dropped,
+                'lagging': client.lagging,
+                'average_batch_size': client.average_batch_size
+            }
+            for client, (username, room) in self.registry.clients()
+        ]
+        depths.sort(key=lambda entry: (entry['queue_depth'], entry['dropped']), reverse=True)
+        return depths[:limit]
+
+    def dropped_frames(self):
+        return self.closed_dropped + sum(client.dropped for client, _ in self.registry.clients())
+
+    def compression_stats(self, limit=None):
+        """Compression ratio and CPU time per compressing client in both directions, most bytes sent first"""
+        stats = [
+            {
+                'username': username,
+                'sent': client.compressor.stats(),
+                'received': client.decompressor.stats()
+            }
+            for client, (username, _) in self.registry.clients()
+            if client.compressor is not None
+        ]
+        stats.sort(key=lambda entry: entry['sent']['bytes_in'], reverse=True)
+        return stats[:limit]
+
+    def compression_totals(self):
+        """Compression bytes and CPU time of every client since the server started, keyed as in COMPRESSION_METRICS"""
+        totals = dict(self.closed_compression)
+        for client, _ in self.registry.clients():
+            if client.compressor is not None:
+                for key, value in client.compression_counts().items():
+                    totals[key] += value
+        return totals
+
+    def batch_stats(self):
+        """Frames and writes to every client since the server started, and the average frames per write"""
+        frames, batches = self.closed_frames_sent, self.closed_batches_sent
+        for client, _ in self.registry.clients():
+            frames += client.frames_sent
+            batches += client.batches_sent
+        return {
+            'frames_sent': frames,
+            'batches_sent': batches,
+            'writes_saved': frames - batches,
+            'average_batch_size': frames / batches if batches else 0.0
+        }
+
+    def bytes_sent(self):
+        return self.closed_bytes_sent + sum(client.bytes_sent for client, _ in self.registry.clients())
+
+    def metrics_text(self):
+        """This process's metrics in Prometheus text format"""
+        return self.metrics.render()
+
+    def stats_message(self):
+        """Reply to a 'stats' request: the metrics text, batching totals, the most backed up client
+        queues and the clients sending the most compressed traffic"""
+        return {
+            'type': 'stats',
+            'text': self.metrics_text(),
+            'batching': self.batch_stats(),
+            'queues': self.queue_depths(STATS_TOP_CLIENTS),
+            'compression': self.compression_stats(STATS_TOP_CLIENTS)
+        }
+
+    def room_list_message(self):
+        rooms, protected_rooms, version = self.registry.room_list()
+        return {
             'type': 'room_list',
-            'rooms': list(self.rooms.keys()),
-            'protected_rooms': [room for room, info in self.rooms.items() if info.get('password')]
+            'rooms': rooms,
+            'protected_rooms': protected_rooms,
+            'version': version
         }
-        # Send to all connected clients
-        for client_socket in self.clients:
+
+    def room_added_message(self, room):
+        return {'type': 'room_added', 'room': room.name, 'protected': bool(room.password), 'version': room.version}
+
+    def broadcast_room_change(self, change):
+        """Send one room_added or room_removed change to all clients
+
+        Clients that asked for deltas in their handshake get just the change; older
+        clients get the full room list, built and encoded once, as before.
+        """
+        self.refresh_discovery()
+        delta = EncodedMessage(change, self.strings, self.max_frame_size)
+        full_list = None
+        for client_socket, _ in self.registry.clients():
             try:
-                client_socket.send(json.dumps(room_list).encode())
+                if client_socket.room_deltas:
+                    client_socket.send_message(delta)
+                else:
+                    if full_list is None:
+                        full_list = EncodedMessage(self.room_list_message(), self.strings, self.max_frame_size)
+                    client_socket.send_message(full_list)
+            except SlowConsumerError as e:
+                logger.warning("Error broadcasting room list to client: %s", e)
+                self.remove_client(client_socket)
             except Exception as e:
-                print(f"Error broadcasting room list to client: {e}")  # Debug print
-                pass
+                logger.warning("Error broadcasting room list to client: %s", e)
+
+    def collect_rooms(self):
+        """Remove rooms that have been empty for a while and whose owner is offline"""
+        online_users = {username for _, (username, _) in self.registry.clients()}
+        for name in self.registry.idle_rooms(online_users, self.room_idle_seconds):
+            version = self.registry.remove_room(name)
+            if version is not None:
+                logger.info("Removed idle room %s", name)
+                self.broadcast_room_change({'type': 'room_removed', 'room': name, 'version': version})
 
-    def handle_discovery(self):
+    def room_gc_loop(self):
+        """Runs on its own thread; in asyncio mode each pass hops onto the event loop, like bus events"""
         while True:
+            time.sleep(ROOM_GC_INTERVAL)
             try:
-                data, addr = self.discovery_socket.recvfrom(1024)
-                if data == b"CHAT_DISCOVER":
-                    # Send server info
-                    server_info = {
-                        "name": self.server_name,
-                        "users": len(self.clients),
-                        "rooms": len(self.rooms)
-                    }
-                    self.discovery_socket.sendto(
-                        json.dumps(server_info).encode(),
-                        addr
-                    )
-            except Exception as e:
-                print(f"Discovery error: {e}")
-                continue
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.run_room_gc)
+                else:
+                    self.run_room_gc()
+            except RuntimeError:
+                return  # The event loop has been closed
+
+    def run_room_gc(self):
+        try:
+            self.collect_rooms()
+        except Exception as e:
+            logger.exception("Room cleanup error: %s", e)
 
-    def start(self):
+    def user_count(self):
+        """Connected users across every worker"""
+        return self.registry.client_count() + sum(self.remote_users.values())
+
+    def close(self):
+        """Commit whatever the message log still holds and stop serving metrics"""
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.admin is not None:
+            self.admin.shutdown()
+            self.admin.server_close()
+
+    def attach_bus(self, bus_path, on_close=None):
+        """Join the other workers' pub/sub bus so rooms, messages and counts are shared"""
+        self.bus = BusClient(bus_path, self.worker_id, self.on_bus_event, on_close)
+        self.publish_presence()
+
+    def publish_presence(self):
+        """Share this worker's user count with the other workers and discovery"""
+        self.refresh_discovery()
+        if self.bus is not None:
+            self.bus.publish({'type': 'presence', 'worker': self.worker_id,
+                              'users': self.registry.client_count()})
+
+    def on_bus_event(self, event):
+        """Called on the bus reader thread; hop onto the event loop in asyncio mode"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.apply_bus_event, event)
+        else:
+            self.apply_bus_event(event)
+
+    def apply_bus_event(self, event):
+        """Mirror something that happened on another worker"""
+        event_type = event['type']
+        if event_type == 'publish':
+            message = event['message']
+            if message.get('type') == 'room_background':
+                room = self.registry.get_room(event['room'])
+                if room is not None:
+                    room.background = message.get('color')
+            self.broadcast_local(message, event['room'], record=event.get('record', False))
+        elif event_type == 'room_created':
+            room = self.registry.create_room(event['room'], event.get('password'), owner=event.get('owner'))
+            if room is not None:
+                self.strings.add(room.name)
+                self.broadcast_room_change(self.room_added_message(room))
+        elif event_type == 'presence':
+            self.remote_users[event['worker']] = event['users']
+            self.refresh_discovery()
+
+    def refresh_discovery(self):
+        """Update the discovery reply with current load, re-encoded only if it changed"""
+        if self.discovery is None:
+            return
+        users = self.user_count()
+        self.discovery.update({
+            'name': self.server_name,
+            'port': self.server_socket.getsockname()[1],
+            'users': users,
+            'rooms': self.registry.room_count(),
+            'capacity': self.capacity,
+            'workers': 1 + len(self.remote_users),
+            'load': round(users / self.capacity, 3) if self.capacity else None
+        })
+
+    def start(self, mode='thread'):
+        """Serve clients with one thread per connection or on a single event loop"""
+        if mode == 'asyncio':
+            asyncio.run(self.start_async())
+        else:
+            self.start_threaded()
+
+    def start_threaded(self):
         while True:
             client_socket, address = self.server_socket.accept()
+            # Refused here rather than on a handler thread, so a flood of connections
+            # over the cap costs no threads
+            if not self.admit_connection():
+                self.refuse_connection(client_socket)
+                continue
             thread = threading.Thread(target=self.handle_client, args=(client_socket, address))
             thread.daemon = True
             thread.start()
 
+    async def start_async(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+def is_count(value):
+    """Whether a value from a client is a usable non-negative integer (bools are ints, but not counts)"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def sendmsg_all(sock, buffers):
+    """Write a list of buffers with as few scatter/gather sendmsg calls as possible"""
+    if len(buffers) == 1 or not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + MAX_BATCH_FRAMES])
+        # Skip the buffers that went out completely and trim the one cut short
+        while sent and index < len(views):
+            if sent >= len(views[index]):
+                sent -= len(views[index])
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+
+class SlowConsumerError(ConnectionError):
+    """Raised when a client's outbound queue overflows under the disconnect policy"""
+
+class ClientConnection(abc.ABC):
+    """Bounded outbound queue in front of one client, drained by a dedicated writer
+
+    sendall only enqueues, so a client on a bad network never stalls the thread
+    broadcasting to it. When the queue reaches the high watermark the slow consumer
+    policy decides what happens:
+      drop_oldest - discard the oldest queued frame to make room
+      disconnect  - drop the client
+      pause       - stop queueing new frames until the writer drains to the low watermark
+    """
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 policy='drop_oldest', flush_window=0.0, write_delay=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+        # Queued items are (perf_counter() when queued, frame or group of frames)
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.paused = False
+        self.lagging = False  # Set at the high watermark, cleared at the low watermark
+        self.dropped = 0
+        self.closed = False
+        # Frames the slow consumer policy must never drop, written before queued data
+        self.control = collections.deque()
+        # Negotiated payload encoding, see set_wire_format
+        self.wire_format = FORMAT_JSON
+        self.strings = None
+        self.known_ids = set()  # Interned string ids this binary client has been taught
+        self.session = None  # Token a reconnect presents to resume, see register_client
+        self.buckets = {}  # {message type or 'all': TokenBucket}, see ChatServer.allow_message
+        self.throttled = None  # Limit this client was last told it hit, until it is let through
+        self.intern_lock = threading.Lock()
+        # With a flush window the writer waits that many seconds after being woken,
+        # then sends everything queued in one write
+        self.flush_window = flush_window
+        self.batches_sent = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        # Histogram of queue-to-socket delay, observed by batch_written, and the stamps of the batch in flight
+        self.write_delay = write_delay
+        self.batch_stamps = []
+        # Stream compression, see set_compression
+        self.compressor = None
+        self.decompressor = None
+        # Whether the client takes room_added/room_removed changes instead of full lists
+        self.room_deltas = False
+
+    @property
+    def queue_depth(self):
+        return len(self.queue)
+
+    @property
+    def average_batch_size(self):
+        return self.frames_sent / self.batches_sent if self.batches_sent else 0.0
+
+    def set_wire_format(self, wire_format, strings=None):
+        self.wire_format = wire_format
+        self.strings = strings
+
+    def set_compression(self, compression, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """Compress frames to this client from now on and accept compressed frames from it"""
+        self.compressor = StreamCompressor(threshold)
+        self.decompressor = StreamDecompressor()
+
+    def compression_counts(self):
+        """Bytes and CPU time of both directions of a compressing connection, keyed as in COMPRESSION_METRICS"""
+        return {
+            'compress_in_bytes': self.compressor.bytes_in,
+            'compress_out_bytes': self.compressor.bytes_out,
+            'compress_cpu_seconds': self.compressor.cpu_seconds,
+            'decompress_in_bytes': self.decompressor.bytes_in,
+            'decompress_out_bytes': self.decompressor.bytes_out,
+            'decompress_cpu_seconds': self.decompressor.cpu_seconds
+        }
+
+    def send_message(self, message, control=False):
+        """Queue a message dict or EncodedMessage in this client's wire format"""
+        self.sendall(self.frame_for(message), control)
+
+    def send_messages(self, messages):
+        """Queue several messages as a single item, written in one go and dropped as a whole"""
+        self.sendall(tuple(self.frame_for(message) for message in messages))
+
+    def frame_for(self, message):
+        """The frame carrying a message in this client's wire format"""
+        if not isinstance(message, EncodedMessage):
+            message = EncodedMessage(message, self.strings)
+        if self.wire_format != FORMAT_BINARY:
+            return message.json_frame()
+        frame, refs = message.binary_frame()
+        if not refs <= self.known_ids:
+            with self.intern_lock:
+                # Teach the client any new ids before the frame that uses them
+                for ident in sorted(refs - self.known_ids):
+                    self.sendall(intern_frame(ident, self.strings.values[ident]), control=True)
+                    self.known_ids.add(ident)
+        return frame
+
+    def sendall(self, data, control=False):
+        data = (time.perf_counter(), data)
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if control:
+                self.control.append(data)
+            else:
+                if self.paused:
+                    self.dropped += 1
+                    return
+                if len(self.queue) >= self.high_watermark:
+                    self.lagging = True
+                    if self.policy == 'disconnect':
+                        raise SlowConsumerError(f"Outbound queue full ({len(self.queue)} frames)")
+                    self.dropped += 1
+                    if self.policy == 'pause':
+                        self.paused = True
+                        return
+                    self.queue.popleft()
+                self.queue.append(data)
+        self.wake_writer()
+
+    def next_batch(self):
+        """Pop the frames for the writer's next write, an empty list once the queue is empty"""
+        limit = MAX_BATCH_FRAMES if self.flush_window else 1
+        with self.lock:
+            items = list(self.control)
+            self.control.clear()
+            items.extend(self.queue.popleft() for _ in range(min(limit, len(self.queue))))
+            if len(self.queue) <= self.low_watermark:
+                self.paused = False
+                self.lagging = False
+        batch = []
+        self.batch_stamps = [queued_at for queued_at, _ in items]
+        for _, item in items:
+            # A tuple is a group of frames queued by send_messages
+            if item.__class__ is tuple:
+                batch.extend(item)
+            else:
+                batch.append(item)
+        if batch:
+            self.batches_sent += 1
+            self.frames_sent += len(batch)
+            if self.compressor is not None:
+                # Done here, by the one writer and in wire order, which the deflate
+                # context depends on; shared frames stay uncompressed in the queue
+                batch = [self.compressor.compress_frame(frame) for frame in batch]
+            self.bytes_sent += sum(map(len, batch))
+        return batch
+
+    def batch_written(self):
+        """Record how long the items of the last batch waited, called once the writer has sent it"""
+        if self.write_delay is not None:
+            now = time.perf_counter()
+            for queued_at in self.batch_stamps:
+                self.write_delay.observe(now - queued_at)
+
+    @abc.abstractmethod
+    def wake_writer(self):
+        """Tell the writer there are frames to send, called after queueing them"""
+
+    @abc.abstractmethod
+    def close(self):
+        """Stop the writer and close the connection, safe to call more than once"""
+
+class ThreadedClientConnection(ClientConnection):
+    """Outbound queue for a blocking socket, drained by its own writer thread"""
+    def __init__(self, sock, **queue_options):
+        super().__init__(**queue_options)
+        self.sock = sock
+        self.ready = threading.Event()
+        writer_thread = threading.Thread(target=self.write_loop)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def wake_writer(self):
+        self.ready.set()
+
+    def write_loop(self):
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            if self.flush_window:
+                # Let more frames for this client arrive so they share one syscall
+                time.sleep(self.flush_window)
+            batch = self.next_batch()
+            while batch and not self.closed:
+                try:
+                    sendmsg_all(self.sock, batch)
+                except OSError as e:
+                    logger.debug("Error writing to client: %s", e)
+                    self.shutdown()
+                    return
+                self.batch_written()
+                batch = self.next_batch()
+
+    def shutdown(self):
+        """Unblock the reader thread so it cleans the client up"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        self.shutdown()
+        self.sock.close()
+
+class AsyncClientConnection(ClientConnection):
+    """Outbound queue for an asyncio stream, drained by a writer task on the loop"""
+    def __init__(self, reader, writer, **queue_options):
+        super().__init__(**queue_options)
+        self.reader = reader
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+
+    def wake_writer(self):
+        self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.flush_window:
+                    await asyncio.sleep(self.flush_window)
+                batch = self.next_batch()
+                while batch and not self.closed:
+                    self.writer.writelines(batch)
+                    # drain only waits once the transport's own buffer is full,
+                    # which is what lets frames back up in our queue
+                    await self.writer.drain()
+                    self.batch_written()
+                    batch = self.next_batch()
+        except (ConnectionError, OSError) as e:
+            logger.debug("Error writing to client: %s", e)
+            self.writer.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        if not self.writer.is_closing():
+            self.writer.close()
+
+def admin_log_level(query):
+    """Admin route: report the log level, or change it with ?level=NAME[&logger=chat.server]"""
+    name = query.get('logger', ['chat'])[0]
+    if 'level' in query:
+        return f"{name} {set_level(query['level'][0], name)}\n"
+    return f"{name} {logging.getLevelName(logging.getLogger(name).getEffectiveLevel())}\n"
+
+def run_worker(worker_id, bus_path, server_options, mode, log_level='INFO', log_format='text'):
+    """Entry point of one worker process in multi-process mode"""
+    # Workers are spawned, so each sets up its own logging
+    setup_logging(log_level, log_format)
+    # Only the first worker answers discovery, with user counts from every worker
+    discovery_port = DISCOVERY_PORT if worker_id == 0 else None
+    if server_options.get('admin_port') is not None:
+        server_options = dict(server_options, admin_port=server_options['admin_port'] + worker_id)
+    server = ChatServer(worker_id=worker_id, discovery_port=discovery_port, **server_options)
+    # A worker is useless without the bus, so exit along with the parent
+    server.attach_bus(bus_path, on_close=lambda: os._exit(0))
+    try:
+        server.start(mode)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+def run_cluster(workers, server_options, mode, log_level='INFO', log_format='text'):
+    """Run several worker processes on one port, linked by a local pub/sub bus"""
+    bus_path = os.path.join(tempfile.gettempdir(), f"webchat-bus-{os.getpid()}.sock")
+    hub = BusHub(bus_path)
+    hub.start()
+    # Make a plain kill run the cleanup below, like Ctrl+C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    processes = start_workers(workers, run_worker, (bus_path, server_options, mode, log_level, log_format))
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        hub.close()
+
+def parse_rate_limits(specs):
+    """Turn --rate-limit TYPE=RATE[:BURST] options into the defaults with those replaced"""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for spec in specs:
+        message_type, _, value = spec.partition('=')
+        rate, _, burst = value.partition(':')
+        # allow_message looks limits up by metrics label, so unknown types share 'other'
+        if message_type not in MESSAGE_TYPES + ('all', 'other'):
+            raise SystemExit(f"Bad --rate-limit value: {spec}")
+        try:
+            rate = float(rate)
+            burst = int(burst) if burst else max(1, int(rate))
+        except (ValueError, OverflowError):
+            raise SystemExit(f"Bad --rate-limit value: {spec}")
+        if not 0 < rate < float('inf') or burst < 1:
+            raise SystemExit(f"Bad --rate-limit value: {spec}")
+        limits[message_type] = (rate, burst)
+    return limits
+
+def parse_room_history(specs, default_bytes):
+    """Turn --room-history ROOM=MESSAGES[:BYTES] options into {room: (messages, bytes)}"""
+    limits = {}
+    for spec in specs:
+        room, _, value = spec.rpartition('=')
+        messages, _, size = value.partition(':')
+        if not room:
+            raise SystemExit(f"Bad --room-history value: {spec}")
+        limits[room] = (int(messages), int(size) if size else default_bytes)
+    return limits
+
 if __name__ == "__main__":
-    server = ChatServer()
-    print("Chat server started. Press Ctrl+C to stop.")
+    parser = argparse.ArgumentParser(description="Multi-room chat server")
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread',
+                        help="thread: one OS thread per client, asyncio: all clients on one event loop")
+    parser.add_argument('--max-frame-size', type=int, default=MAX_FRAME_SIZE,
+                        help="largest message payload in bytes accepted from a client")
+    parser.add_argument('--high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="frames queued for one client before the slow consumer policy applies")
+    parser.add_argument('--low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="queue depth at which a lagging or paused client counts as caught up")
+    parser.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES, default='drop_oldest',
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument('--batch-window-ms', type=float, default=0.0,
+                        help="gather frames per client for this long and send them in one write (0 disables)")
+    parser.add_argument('--compression-threshold', type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help="smallest payload in bytes compressed for clients that negotiate compression")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="never compress, even for clients that ask")
+    parser.add_argument('--history-messages', type=int, default=DEFAULT_HISTORY_MESSAGES,
+                        help="chat messages kept per room and replayed to clients joining it (0 disables)")
+    parser.add_argument('--history-bytes', type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="most bytes of messages kept per room")
+    parser.add_argument('--room-history', action='append', default=[], metavar='ROOM=MESSAGES[:BYTES]',
+                        help="history limits for one room, overriding the defaults (repeatable)")
+    parser.add_argument('--room-idle-minutes', type=float, default=DEFAULT_ROOM_IDLE_SECONDS / 60,
+                        help="remove rooms left empty this long while their owner is offline (0 disables)")
+    parser.add_argument('--multicast-group', nargs='?', const=DEFAULT_MULTICAST_GROUP,
+                        help=f"answer discovery on this IP multicast group instead of LAN broadcast "
+                             f"(default group {DEFAULT_MULTICAST_GROUP})")
+    parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY,
+                        help="users this server is sized for, advertised to clients choosing a server")
+    parser.add_argument('--log-dir',
+                        help="keep every room's messages in an append-only log in this directory")
+    parser.add_argument('--log-segment-mb', type=float, default=DEFAULT_SEGMENT_BYTES / 2**20,
+                        help="size at which the message log starts a new segment file")
+    parser.add_argument('--log-retention-days', type=float, default=DEFAULT_RETENTION_SECONDS / 86400,
+                        help="remove log segments older than this")
+    parser.add_argument('--log-retention-mb', type=float, default=DEFAULT_RETENTION_BYTES / 2**20,
+                        help="remove the oldest log segments once the log is larger than this")
+    parser.add_argument('--session-seconds', type=float, default=DEFAULT_SESSION_SECONDS,
+                        help="how long a dropped client can reconnect and resume its room, "
+                             "receiving only what it missed (0 disables)")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='TYPE=RATE[:BURST]',
+                        help="messages per second and burst allowed per connection for one message type, "
+                             "for unlisted types with 'other' or for all of them with 'all' (repeatable)")
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help="don't rate limit clients at all")
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="connections accepted at once; more are sent server_busy (0 for no cap). "
+                             "Counted per process, so --workers N accepts up to N times as many")
+    parser.add_argument('--max-rooms', type=int, default=DEFAULT_MAX_ROOMS,
+                        help="rooms that can exist at once (0 for no cap). With --workers every worker "
+                             "checks its own copy of the room list, so simultaneous creates can overshoot it")
+    parser.add_argument('--admin-port', type=int,
+                        help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics and the log level "
+                             "at /log-level (workers use consecutive ports)")
+    parser.add_argument('--log-level', default='INFO', type=str.upper,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="least severe server log records written to stderr; SIGUSR1 toggles DEBUG")
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text',
+                        help="write log records as key=value text or as JSON lines")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT")
+    args = parser.parse_args()
+    
+    server_options = {
+        'max_frame_size': args.max_frame_size,
+        'high_watermark': args.high_watermark,
+        'low_watermark': args.low_watermark,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'batch_window': args.batch_window_ms / 1000,
+        'compression_threshold': None if args.no_compression else args.compression_threshold,
+        'history_messages': args.history_messages,
+        'history_bytes': args.history_bytes,
+        'room_history': parse_room_history(args.room_history, args.history_bytes),
+        'room_idle_seconds': args.room_idle_minutes * 60 or None,
+        'multicast_group': args.multicast_group,
+        'capacity': args.capacity,
+        'admin_port': args.admin_port,
+        'session_seconds': args.session_seconds,
+        'rate_limits': {} if args.no_rate_limits else parse_rate_limits(args.rate_limit),
+        'max_connections': args.max_connections or None,
+        'max_rooms': args.max_rooms or None,
+        'log_dir': args.log_dir,
+        'log_options': {
+            'segment_bytes': int(args.log_segment_mb * 2**20),
+            'retention_seconds': args.log_retention_days * 86400,
+            'retention_bytes': int(args.log_retention_mb * 2**20)
+        }
+    }
     try:
-        server.start()
+        if args.workers > 1:
+            print(f"Chat server starting {args.workers} workers in {args.mode} mode. Press Ctrl+C to stop.")
+            run_cluster(args.workers, server_options, args.mode, args.log_level, args.log_format)
+        else:
+            setup_logging(args.log_level, args.log_format)
+            server = ChatServer(**server_options)
+            print(f"Chat server started in {args.mode} mode. Press Ctrl+C to stop.")
+            try:
+                server.start(args.mode)
+            finally:
+                server.close()
     except KeyboardInterrupt:
-        print("\nShutting down server...")
\ No newline at end of file
+        print("\nShutting down server...")
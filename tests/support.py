@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+import io
+import socket
+import threading
+import time
+from Protocol import FrameDecoder, JsonCodec, StreamDecompressor, encode_frame, make_codec
+from Server import ChatServer
+
+WAIT_TIMEOUT = 5.0
+
+def start_server(mode='thread', **options):
+    """Run a server on a free loopback port in a background thread; returns (server, port)"""
+    options.setdefault('discovery_port', None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ChatServer(host='127.0.0.1', port=0, **options)
+    if mode == 'asyncio':
+        thread = threading.Thread(target=asyncio.run, args=(server.start_async(),))
+    else:
+        thread = threading.Thread(target=server.start_threaded)
+    thread.daemon = True
+    thread.start()
+    return server, server.server_socket.getsockname()[1]
+
+def wait_for(predicate, timeout=WAIT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.01)
+    raise AssertionError("Timed out waiting")
+
+class TestClient:
+    """A bare protocol client that records every message it receives"""
+    __test__ = False  # Not a test class, despite the name
+
+    def __init__(self, port, username, **handshake):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.decoder = FrameDecoder()
+        if handshake.get('compression'):
+            # The server may compress from its very first reply on
+            self.decoder.decompressor = StreamDecompressor()
+        self.codec = JsonCodec()
+        self.messages = []
+        self.closed = False
+        self.send(dict({'type': 'username', 'username': username}, **handshake))
+        reader = threading.Thread(target=self.read_loop)
+        reader.daemon = True
+        reader.start()
+        self.reply = wait_for(lambda: self.messages and self.messages[0])
+        self.codec = make_codec(self.reply.get('format', 'json'))
+
+    def read_loop(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for message in self.decoder.feed_messages(data):
+                    self.messages.append(message)
+                    if len(self.messages) == 1:
+                        # The handshake reply is JSON, what follows uses the agreed format
+                        self.decoder.codec = make_codec(message.get('format', 'json'))
+        except OSError:
+            pass
+        self.closed = True
+
+    def send(self, message):
+        self.sock.sendall(encode_frame(self.codec.encode(message)))
+
+    def of_type(self, message_type):
+        return [message for message in self.messages if message.get('type') == message_type]
+
+    def wait_type(self, message_type):
+        return wait_for(lambda: self.of_type(message_type))[-1]
+
+    def close(self):
+        # Shut down first: close alone leaves the reader's recv holding the socket open
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,62 @@
+import collections
+from Client import ChatClient
+
+def make_client():
+    """A ChatClient without a window, recording what it sends"""
+    client = object.__new__(ChatClient)
+    client.sent = []
+    client.send_data = client.sent.append
+    client.schedule_room_buttons = lambda: None
+    client.available_rooms = ['General']
+    client.protected_rooms = set()
+    client.room_version = 0
+    client.room_snapshot_pending = False
+    return client
+
+def test_one_room_list_request_per_gap():
+    client = make_client()
+    # Version 1 was missed, so every later delta is out of order until the snapshot
+    for version in range(2, 12):
+        client.handle_server_message({'type': 'room_added', 'room': f'room{version}', 'version': version})
+    assert client.sent == [{'type': 'room_list_request'}]
+    client.handle_server_message({'type': 'room_list', 'rooms': ['General', 'a'], 'protected_rooms': [],
+                                  'version': 11})
+    client.handle_server_message({'type': 'room_added', 'room': 'b', 'version': 12})
+    assert client.available_rooms == ['General', 'a', 'b']
+    client.handle_server_message({'type': 'room_added', 'room': 'c', 'version': 14})
+    assert client.sent == [{'type': 'room_list_request'}] * 2
+
+class FakeText:
+    """Just enough of a Tk Text widget: whole lines inserted at the top or the end"""
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    def insert(self, index, text, tags=()):
+        if index == '1.0':
+            self.lines.insert(0, text)
+        else:
+            self.lines.append(text)
+
+def test_earlier_page_goes_above_the_archive():
+    client = make_client()
+    client.username = 'alice'
+    client.current_room = 'General'
+    client.history_before = {}
+    client.history_remaining = 0
+    client.display_message = lambda sender, content, tag: client.chat_display.insert('end', f"{sender}: {content}\n")
+    client.chat_display = FakeText([])
+    for seq in range(5, 9):
+        client.handle_server_message({'type': 'message', 'sender': 'bob', 'content': f'm{seq}',
+                                      'room': 'General', 'seq': seq})
+    # The two oldest lines were trimmed into the archive
+    client.archive = collections.deque([('bob: m5\n', ()), ('bob: m6\n', ())])
+    client.archived_lines = 2
+    client.chat_display.lines = client.chat_display.lines[2:]
+    client.load_earlier_messages()
+    assert client.sent[-1] == {'type': 'history_request', 'room': 'General', 'before': 5}
+    client.handle_server_message({'type': 'history_page', 'room': 'General', 'before': 3,
+                                  'messages': [{'sender': 'bob', 'content': f'm{seq}'} for seq in (3, 4)]})
+    assert client.chat_display.lines == ['--- Earlier messages ---\n'] + [f'bob: m{seq}\n' for seq in range(3, 9)]
+    assert not client.archive
+    client.load_earlier_messages()
+    assert client.sent[-1]['before'] == 3
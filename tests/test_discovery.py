@@ -0,0 +1,17 @@
+import socket
+from Discovery import DiscoveryClient
+from support import wait_for
+
+def unused_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_probing_until_the_newest_probe_finishes(tmp_path, monkeypatch):
+    monkeypatch.setattr('Discovery.PROBE_TIMEOUT', 0.2)
+    discovery = DiscoveryClient(lambda server: None, port=unused_udp_port(),
+                                cache_path=str(tmp_path / 'servers.json'))
+    assert not discovery.probing()
+    discovery.probe('127.0.0.1/32')
+    assert discovery.probing()
+    wait_for(lambda: not discovery.probing())
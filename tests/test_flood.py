@@ -0,0 +1,65 @@
+import contextlib
+import io
+import pytest
+from Discovery import TokenBucket
+from Server import DEFAULT_RATE_LIMITS, ChatServer, parse_rate_limits
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(2.0, 3)
+    now = bucket.updated
+    assert [bucket.allow(now) for _ in range(4)] == [True, True, True, False]
+    assert bucket.allow(now + 0.5)
+    assert not bucket.allow(now + 0.5)
+    # Refills up to the burst and no further
+    assert [bucket.allow(now + 60) for _ in range(4)] == [True, True, True, False]
+
+class Flooder:
+    def __init__(self):
+        self.buckets = {}
+        self.throttled = None
+        self.sent = []
+
+    def send_message(self, message, control=False):
+        self.sent.append(message)
+
+def test_allow_message_throttles_once_per_episode():
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ChatServer(host='127.0.0.1', port=0, discovery_port=None,
+                            rate_limits={'message': (0.001, 2), 'all': (0.001, 3)})
+    try:
+        client = Flooder()
+        assert server.allow_message(client, 'message')
+        assert server.allow_message(client, 'message')
+        assert not server.allow_message(client, 'message')
+        assert not server.allow_message(client, 'message')
+        assert [(message['type'], message['limit']) for message in client.sent] == [('throttled', 'message')]
+        # Other types still pass until the overall bucket runs dry
+        assert server.allow_message(client, 'room_list_request')
+        assert not server.allow_message(client, 'room_list_request')
+        assert [message['limit'] for message in client.sent] == ['message', 'all']
+    finally:
+        server.server_socket.close()
+
+def test_admission_cap():
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ChatServer(host='127.0.0.1', port=0, discovery_port=None, max_connections=2)
+    try:
+        assert server.admit_connection() and server.admit_connection()
+        assert not server.admit_connection()
+        server.release_connection()
+        assert server.admit_connection()
+    finally:
+        server.server_socket.close()
+
+def test_rate_limit_options():
+    limits = parse_rate_limits(['message=2.5', 'all=10:40', 'other=1:3'])
+    assert limits['message'] == (2.5, 2)
+    assert limits['all'] == (10.0, 40)
+    assert limits['other'] == (1.0, 3)
+    assert limits['stats'] == DEFAULT_RATE_LIMITS['stats']
+
+@pytest.mark.parametrize('spec', ['message=fast', 'message=5:many', 'message=0', 'message=-1',
+                                  'message=nan', 'message=inf', 'message=1:0', 'mesage=5', '=5', 'message'])
+def test_bad_rate_limit_options_exit(spec):
+    with pytest.raises(SystemExit, match='Bad --rate-limit value'):
+        parse_rate_limits([spec])
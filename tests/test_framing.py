@@ -0,0 +1,24 @@
+import pytest
+from Protocol import FrameDecoder, FrameError, pack_message
+
+def test_frame_split_across_reads():
+    message = {'type': 'message', 'content': 'hello'}
+    frame = pack_message(message)
+    decoder = FrameDecoder()
+    for i in range(len(frame) - 1):
+        assert list(decoder.feed_messages(frame[i:i + 1])) == []
+    assert list(decoder.feed_messages(frame[-1:])) == [message]
+
+def test_coalesced_frames_come_out_in_order():
+    messages = [{'type': 'message', 'content': f'message {i}'} for i in range(3)]
+    data = b''.join(pack_message(message) for message in messages)
+    tail = pack_message({'type': 'message', 'content': 'tail'})
+    decoder = FrameDecoder()
+    # Three whole frames and the start of a fourth in one read
+    assert list(decoder.feed_messages(data + tail[:5])) == messages
+    assert list(decoder.feed_messages(tail[5:])) == [{'type': 'message', 'content': 'tail'}]
+
+def test_oversized_frame_is_rejected_from_its_header():
+    decoder = FrameDecoder(max_frame_size=16)
+    with pytest.raises(FrameError):
+        decoder.feed(pack_message({'content': 'x' * 100})[:4])
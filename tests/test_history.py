@@ -0,0 +1,19 @@
+from support import TestClient, start_server, wait_for
+
+def test_history_request_with_bad_limit_gets_an_error(tmp_path):
+    server, port = start_server(log_dir=str(tmp_path))
+    alice = TestClient(port, 'alice')
+    alice.send({'type': 'message', 'content': 'hello', 'room': 'General'})
+    wait_for(lambda: [m for m in alice.of_type('message') if 'seq' in m])
+    bad_requests = ({'limit': 'abc'}, {'limit': [1]}, {'before': 'abc'}, {'room': ['General']})
+    for count, request in enumerate(bad_requests, start=1):
+        alice.send(dict({'type': 'history_request', 'room': 'General'}, **request))
+        page = wait_for(lambda: len(alice.of_type('history_page')) == count and alice.of_type('history_page')[-1])
+        assert page['message'] == 'Invalid request'
+        assert page['messages'] == []
+    alice.send({'type': 'history_request', 'room': 'General', 'limit': 10})
+    page = wait_for(lambda: len(alice.of_type('history_page')) == len(bad_requests) + 1 and
+                    alice.of_type('history_page')[-1])
+    assert [message['content'] for message in page['messages']] == ['hello']
+    assert not alice.closed
+    alice.close()
@@ -0,0 +1,47 @@
+import socket
+import threading
+import time
+import pytest
+from Protocol import FrameDecoder, pack_message
+from support import TestClient, start_server, wait_for
+
+@pytest.mark.parametrize('mode', ['thread', 'asyncio'])
+def test_refused_connection_reads_server_busy(mode):
+    server, port = start_server(mode, max_connections=1)
+    alice = TestClient(port, 'alice')
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(pack_message({'type': 'username', 'username': 'bob'}))
+    # Give a reset, if one is coming, time to arrive before anything is read
+    time.sleep(0.2)
+    received = b''
+    while True:
+        data = sock.recv(65536)  # Raises ConnectionResetError if the server aborted
+        if not data:
+            break
+        received += data
+    sock.close()
+    assert [message['type'] for message in FrameDecoder().feed_messages(received)] == ['server_busy']
+    alice.close()
+
+def read_until_eof(sock):
+    received = b''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return received
+        received += data
+
+def test_refusals_take_no_thread_each():
+    server, port = start_server(max_connections=1)
+    alice = TestClient(port, 'alice')
+    threads = threading.active_count()
+    # Never closed by the client, so each stays with the server until its linger runs out
+    socks = [socket.create_connection(('127.0.0.1', port)) for _ in range(20)]
+    for sock in socks:
+        messages = list(FrameDecoder().feed_messages(read_until_eof(sock)))
+        assert [message['type'] for message in messages] == ['server_busy']
+    assert threading.active_count() <= threads + 1
+    wait_for(lambda: not server.refused.get_map())
+    for sock in socks:
+        sock.close()
+    alice.close()
@@ -0,0 +1,60 @@
+import os
+from MessageLog import MessageLog
+
+def fill(log, room, count, start=0):
+    seqs = [log.append(room, {'type': 'message', 'content': f'{room} {i}', 'room': room})
+            for i in range(start, start + count)]
+    log.flush()
+    return seqs
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+
+def test_log_rolls_into_segments(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=1024)
+    for i in range(40):
+        fill(log, 'General', 1, i)
+    assert len(segment_files(tmp_path)) > 3
+    assert [seq for seq, _, _ in log.read('General', limit=40)] == list(range(1, 41))
+    log.close()
+
+def test_pages_continue_across_segments(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=1024)
+    for i in range(60):
+        fill(log, 'General', 1, i)
+        fill(log, 'Lobby', 1, i)
+    contents = []
+    before = None
+    while before != 1:
+        page = log.read('General', before, limit=7)
+        assert page and len(page) <= 7
+        contents[:0] = [message['content'] for _, _, message in page]
+        before = page[0][0]
+    assert contents == [f'General {i}' for i in range(60)]
+    log.close()
+
+def test_torn_tail_is_truncated_on_open(tmp_path):
+    log = MessageLog(str(tmp_path))
+    fill(log, 'General', 5)
+    log.close()
+    path = os.path.join(str(tmp_path), segment_files(tmp_path)[-1])
+    size = os.path.getsize(path)
+    with open(path, 'ab') as log_file:
+        log_file.write(b'\x00\x00\x01\x00{"room": "Gen')  # A record cut short by a crash
+    log = MessageLog(str(tmp_path))
+    assert os.path.getsize(path) == size
+    assert fill(log, 'General', 1) == [6]
+    assert [seq for seq, _, _ in log.read('General')] == list(range(1, 7))
+    log.close()
+
+def test_sequence_numbers_survive_a_restart(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=1024)
+    for i in range(30):
+        fill(log, 'General', 1, i)
+    fill(log, 'Lobby', 3)
+    log.close()
+    log = MessageLog(str(tmp_path), segment_bytes=1024)
+    assert fill(log, 'General', 1) == [31]
+    assert fill(log, 'Lobby', 1) == [4]
+    assert fill(log, 'New', 1) == [1]
+    log.close()
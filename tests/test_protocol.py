@@ -0,0 +1,51 @@
+import logging
+from Protocol import BinaryCodec
+from support import TestClient, start_server, wait_for
+
+def test_binary_codec_round_trips_big_ints():
+    codec = BinaryCodec()
+    message = {'type': 'message', 'sender': 'alice', 'content': 10 ** 20, 'room': 'General', 'seq': -2 ** 63}
+    assert BinaryCodec().decode(codec.encode(message)) == message
+
+def test_big_int_reaches_binary_members():
+    server, port = start_server()
+    alice = TestClient(port, 'alice')
+    bob = TestClient(port, 'bob', formats=['binary'])
+    assert bob.reply.get('format') == 'binary'
+    alice.send({'type': 'message', 'content': 10 ** 20, 'room': 'General'})
+    message = wait_for(lambda: [m for m in bob.of_type('message') if 'seq' in m])[0]
+    assert message['content'] == 10 ** 20
+    assert not bob.closed
+    carol = TestClient(port, 'carol', formats=['binary'])
+    replayed = wait_for(lambda: [m for m in carol.of_type('message') if 'seq' in m])[0]
+    assert replayed['content'] == 10 ** 20
+    for client in (alice, bob, carol):
+        client.close()
+
+def test_only_accepted_names_are_interned():
+    server, port = start_server()
+    alice = TestClient(port, 'alice', formats=['binary'])
+    bob = TestClient(port, 'bob', formats=['binary'])
+    for i in range(10):
+        alice.send({'type': 'message', 'sender': f'forged{i}', 'content': 'hi', 'room': 'General'})
+    messages = wait_for(lambda: len([m for m in bob.of_type('message') if 'seq' in m]) == 10 and
+                        [m for m in bob.of_type('message') if 'seq' in m])
+    assert [m['sender'] for m in messages] == [f'forged{i}' for i in range(10)]
+    assert server.strings.values == ['Server', 'General', 'alice', 'bob']
+    alice.close()
+    bob.close()
+
+def test_untyped_message_does_not_drop_a_debugging_server_client():
+    logger = logging.getLogger('chat.server')
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    try:
+        server, port = start_server()
+        alice = TestClient(port, 'alice')
+        alice.send({'content': 'no type', 'room': 'General'})
+        alice.send({'type': 'message', 'content': 'still here', 'room': 'General'})
+        wait_for(lambda: [m for m in alice.of_type('message') if m.get('content') == 'still here'])
+        assert not alice.closed
+        alice.close()
+    finally:
+        logger.setLevel(level)
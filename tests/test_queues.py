@@ -0,0 +1,63 @@
+import contextlib
+import io
+import pytest
+from Server import ChatServer, ClientConnection, SlowConsumerError
+
+class QueueOnly(ClientConnection):
+    """A client whose writer never runs, so frames stay queued until the test drains them"""
+    def wake_writer(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def drain_one(client):
+    batch = client.next_batch()
+    return batch[0] if batch else None
+
+def test_drop_oldest_keeps_the_newest_frames():
+    client = QueueOnly(high_watermark=3, low_watermark=1, policy='drop_oldest')
+    for i in range(5):
+        client.sendall(b'%d' % i)
+    assert (client.queue_depth, client.dropped, client.lagging) == (3, 2, True)
+    assert drain_one(client) == b'2'
+    assert client.lagging
+    assert drain_one(client) == b'3'
+    assert not client.lagging
+
+def test_disconnect_raises_at_the_high_watermark():
+    client = QueueOnly(high_watermark=2, policy='disconnect')
+    client.sendall(b'0')
+    client.sendall(b'1')
+    with pytest.raises(SlowConsumerError):
+        client.sendall(b'2')
+    assert client.queue_depth == 2
+
+def test_pause_drops_until_the_low_watermark():
+    client = QueueOnly(high_watermark=2, low_watermark=0, policy='pause')
+    for i in range(4):
+        client.sendall(b'%d' % i)
+    assert (client.queue_depth, client.dropped, client.paused) == (2, 2, True)
+    assert drain_one(client) == b'0'
+    client.sendall(b'4')  # Still paused above the low watermark
+    assert drain_one(client) == b'1'
+    assert not client.paused
+    client.sendall(b'5')
+    assert drain_one(client) == b'5'
+    assert client.dropped == 3
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        QueueOnly(policy='ignore')
+
+def test_room_change_disconnects_a_full_client():
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ChatServer(host='127.0.0.1', port=0, discovery_port=None)
+    try:
+        slow = QueueOnly(high_watermark=1, policy='disconnect')
+        server.registry.add_client(slow, 'slow')
+        slow.sendall(b'0')
+        server.broadcast_room_change({'type': 'room_added', 'room': 'Lobby', 'version': 1})
+        assert server.registry.get_client(slow) is None
+    finally:
+        server.server_socket.close()
@@ -0,0 +1,48 @@
+import threading
+from Registry import CLIENT_STRIPES, Registry
+
+def test_clients_spread_over_stripes():
+    registry = Registry()
+    clients = [object() for _ in range(200)]
+    for i, client in enumerate(clients):
+        registry.add_client(client, f'user{i}')
+    assert registry.client_count() == 200
+    assert sum(1 for shard, _ in registry.client_shards if shard) > CLIENT_STRIPES // 2
+    assert registry.get_room('General').members == frozenset(clients)
+
+def test_move_client_changes_rooms_atomically():
+    registry = Registry()
+    client = object()
+    registry.add_client(client, 'alice')
+    registry.create_room('Lobby')
+    assert registry.move_client(client, 'Lobby')
+    assert registry.get_client(client) == ('alice', 'Lobby')
+    assert client in registry.get_room('Lobby').members
+    assert client not in registry.get_room('General').members
+    assert registry.move_client(client, 'Missing') is None
+    assert registry.get_client(client) == ('alice', 'Lobby')
+    assert registry.move_client(object(), 'General') is None
+
+def test_concurrent_joins_moves_and_leaves():
+    registry = Registry()
+    for name in ('a', 'b'):
+        registry.create_room(name)
+    removed = []
+
+    def churn(n):
+        for i in range(200):
+            client = object()
+            registry.add_client(client, f'user{n}-{i}')
+            registry.move_client(client, 'ab'[i % 2])
+            removed.append(registry.remove_client(client))
+            # Only the first removal gets the entry back
+            assert registry.remove_client(client) is None
+
+    threads = [threading.Thread(target=churn, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.client_count() == 0
+    assert all(entry is not None for entry in removed)
+    assert all(not registry.get_room(name).members for name in ('General', 'a', 'b'))
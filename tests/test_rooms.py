@@ -0,0 +1,21 @@
+import threading
+import Server
+from support import TestClient, start_server, wait_for
+
+def test_idle_rooms_are_collected_on_the_event_loop(monkeypatch):
+    monkeypatch.setattr(Server, 'ROOM_GC_INTERVAL', 0.05)
+    server, port = start_server('asyncio', room_idle_seconds=0)
+    gc_threads = []
+    collect_rooms = server.collect_rooms
+    monkeypatch.setattr(server, 'collect_rooms', lambda: (gc_threads.append(threading.get_ident()), collect_rooms()))
+    alice = TestClient(port, 'alice', room_deltas=True)
+    bob = TestClient(port, 'bob')
+    bob.send({'type': 'create_room', 'room': 'Lobby'})
+    assert alice.wait_type('room_added')['room'] == 'Lobby'
+    bob.close()
+    assert alice.wait_type('room_removed')['room'] == 'Lobby'
+    loop_thread = []
+    server.loop.call_soon_threadsafe(lambda: loop_thread.append(threading.get_ident()))
+    wait_for(lambda: loop_thread)
+    assert gc_threads and set(gc_threads) == set(loop_thread)
+    alice.close()
@@ -0,0 +1,45 @@
+import socket
+import pytest
+from Client import ChatClient
+from Protocol import FrameDecoder, pack_message
+from support import TestClient, start_server, wait_for
+
+@pytest.mark.parametrize('mode', ['thread', 'asyncio'])
+def test_resume_takes_over_an_attached_session(mode):
+    server, port = start_server(mode)
+    old = TestClient(port, 'alice')
+    for i in range(3):
+        old.send({'type': 'message', 'content': f'message {i}', 'room': 'General'})
+    wait_for(lambda: len([m for m in old.of_type('message') if 'seq' in m]) == 3)
+    # The client gave up on its connection before the server noticed
+    new = TestClient(port, 'alice', session=old.reply['session'], last_seq=2,
+                     room_version=old.reply['version'])
+    assert new.reply['type'] == 'resumed'
+    assert new.reply['session'] == old.reply['session']
+    wait_for(lambda: old.closed)
+    missed = wait_for(lambda: [m for m in new.of_type('message') if 'seq' in m])
+    assert [m['content'] for m in missed] == ['message 2']
+    assert server.registry.client_count() == 1
+    new.close()
+
+def test_resume_presents_what_the_receive_thread_saw():
+    client = object.__new__(ChatClient)
+    client.username = 'alice'
+    client.session = 'token'
+    client.received_room = 'General'
+    client.received_seqs = {}
+    client.received_version = 0
+    # The Tk thread has handled none of these yet
+    client.current_room = 'General'
+    client.room_version = 0
+    for message in ({'type': 'room_added', 'room': 'Lobby', 'version': 1},
+                    {'type': 'room_joined', 'success': True, 'room': 'Lobby'},
+                    {'type': 'message', 'sender': 'bob', 'content': 'hi', 'room': 'Lobby', 'seq': 7}):
+        client.track_received(message)
+    client.client_socket, server_end = socket.socketpair()
+    server_end.sendall(pack_message({'type': 'resumed', 'room': 'Lobby', 'version': 1, 'session': 'token'}))
+    client.handshake(resume=True)
+    handshake = next(FrameDecoder().feed_messages(server_end.recv(65536)))
+    assert (handshake['last_seq'], handshake['room_version']) == (7, 1)
+    client.client_socket.close()
+    server_end.close()
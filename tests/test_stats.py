@@ -0,0 +1,63 @@
+import pytest
+from Server import ClientConnection
+from support import TestClient, start_server, wait_for
+
+def test_stats_lists_client_queues():
+    server, port = start_server()
+    alice = TestClient(port, 'alice')
+    alice.send({'type': 'stats'})
+    stats = alice.wait_type('stats')
+    assert 'chat_lagging_clients 0' in stats['text']
+    assert 'chat_dropped_frames_total 0' in stats['text']
+    assert [entry['username'] for entry in stats['queues']] == ['alice']
+    assert stats['queues'][0]['queue_depth'] >= 0
+    alice.close()
+
+def test_client_connection_needs_a_writer():
+    with pytest.raises(TypeError):
+        ClientConnection()
+
+def test_batch_stats_count_writes_saved():
+    server, port = start_server(batch_window=0.05)
+    alice = TestClient(port, 'alice')
+    bob = TestClient(port, 'bob')
+    for i in range(20):
+        alice.send({'type': 'message', 'content': f'message {i}', 'room': 'General'})
+    wait_for(lambda: len([m for m in bob.of_type('message') if 'seq' in m]) == 20)
+    bob.send({'type': 'stats'})
+    batching = bob.wait_type('stats')['batching']
+    assert batching['frames_sent'] > batching['batches_sent']
+    assert batching['writes_saved'] == batching['frames_sent'] - batching['batches_sent']
+    assert batching['average_batch_size'] > 1
+    assert 'chat_average_batch_size' in server.metrics_text()
+    alice.close()
+    bob.close()
+
+def metric_value(text, name):
+    return next(float(line.split()[1]) for line in text.splitlines() if line.startswith(name + ' '))
+
+def test_stats_report_compression():
+    server, port = start_server()
+    alice = TestClient(port, 'alice', compression=['zlib'])
+    assert alice.reply.get('compression') == 'zlib'
+    alice.send({'type': 'message', 'content': 'compress me ' * 50, 'room': 'General'})
+    wait_for(lambda: [m for m in alice.of_type('message') if 'seq' in m])
+    alice.send({'type': 'stats'})
+    stats = alice.wait_type('stats')
+    assert [entry['username'] for entry in stats['compression']] == ['alice']
+    assert stats['compression'][0]['sent']['frames_compressed'] > 0
+    sent = metric_value(stats['text'], 'chat_compress_in_bytes_total')
+    assert sent > metric_value(stats['text'], 'chat_compress_out_bytes_total') > 0
+    alice.close()
+    wait_for(lambda: server.registry.client_count() == 0)
+    assert metric_value(server.metrics_text(), 'chat_compress_in_bytes_total') >= sent
+
+@pytest.mark.parametrize('mode', ['thread', 'asyncio'])
+def test_write_delay_is_observed_by_the_writer(mode):
+    server, port = start_server(mode)
+    alice = TestClient(port, 'alice')
+    alice.send({'type': 'message', 'content': 'hello', 'room': 'General'})
+    wait_for(lambda: [m for m in alice.of_type('message') if 'seq' in m])
+    wait_for(lambda: metric_value(server.metrics_text(), 'chat_write_delay_seconds_count') > 0)
+    assert metric_value(server.metrics_text(), 'chat_write_delay_seconds_sum') >= 0
+    alice.close()